@@ -1,20 +1,27 @@
 #!/usr/bin/python3
-"""DrawTime - a tool to render timing diagrams from textual descriptions."""
+"""DrawTime - a tool to render timing diagrams from textual descriptions.
 
+To keep one-off renders fast to start, modules are imported only by the modes
+that use them. In particular, rendering never imports the editor GUI, and
+rendering to SVG never imports Qt. The render cache and memory tracing are
+only imported when they are enabled.
+"""
+
+import argparse
 import sys
-from PyQt4 import QtGui
-import parse
-import render
-import gui
 
 
-def runGUI(app, filename=None):
+def runGUI(filename=None):
   """Starts the editor GUI, optionally loading a diagram description.
 
   Args:
-    app: The QApplication used to run the GUI.
     filename: An optional path of a diagram description (code) file to open.
   """
+  from PyQt4 import QtGui
+  import gui
+
+  app = QtGui.QApplication(sys.argv)
+  app.setApplicationName('DrawTime')
   editor = gui.Editor()
   editor.show()
   if filename:
@@ -28,46 +35,255 @@ def runGUI(app, filename=None):
   sys.exit(app.exec_())
 
 
-def runQuickRender(infile_name, outfile_name):
+def runQuickRender(infile_name, outfile_name, render_cache=None, stats=None,
+                   signals=None, window=(None, None), use_index=False):
   """Reads a diagram description are renders it to a file, then exits.
 
   Args:
-    infile_name: The path of a diagram description (code) file to read.
+    infile_name: The path of a diagram description (code) file to read, or of
+      a compiled diagram file or a VCD file.
     outfile_name: The path where the rendered diagram is to be written. The
       format of the output is determined from the extension of this file. Any
-      format supported by QImageWriter is supported. If the file exists, it is
-      silently overwritten.
+      format supported by QImageWriter is supported, as well as SVG, which is
+      written without Qt, and compiled diagrams (.dtc), which are not cached.
+      If the file exists, it is silently overwritten.
+    render_cache: An optional cache.RenderCache, from which the diagram is
+      copied if it was rendered before.
+    stats: An optional instrument.Stats to collect and print to stderr when
+      done.
+    signals: An optional list of patterns of the names of the signals to import
+      from a VCD file. See vcd.importVcd().
+    window: A tuple of the start and end of the time window to import from a
+      VCD file or load through an index, either of which may be None.
+    use_index: If True, the input is loaded through a time index kept next to
+      it, which is built if needed. See timeindex.loadWindow().
   """
-  with open(infile_name, encoding='utf8') as infile:
-    code = infile.read()
-    diagram = parse.parseTimingDescription(code)
-    renderer = render.Renderer()
-    renderer.draw(diagram)
-    renderer.save(outfile_name)
+  import instrument
+  import output
+  import parse
+  import vcd
+
+  if stats is None:
+    stats = instrument.DISABLED
+  if use_index:
+    import timeindex
+    diagram = timeindex.loadWindow(infile_name, *window, stats=stats)
+  elif vcd.isVcdPath(infile_name):
+    diagram = vcd.importVcd(infile_name, signals, *window, stats=stats)
+  else:
+    diagram = parse.loadTimingFile(infile_name, stats)
+  if output.needsQt(outfile_name):
+    import render
+    app = render.createHeadlessApplication()
+  cached = output.writeDiagram(diagram, outfile_name, render_cache,
+                               stats=stats)
+  if stats:
+    stats.stop()
+    if cached:
+      stats.count('cache_hits')
+    print(stats.summarize(), file=sys.stderr)
   sys.exit(0)
 
 
+def _parseWindow(text):
+  """Parses a time window given as START:END, where either may be omitted."""
+  start, separator, end = text.partition(':')
+  try:
+    if not separator:
+      raise ValueError(text)
+    return (int(start) if start.strip() else None,
+            int(end) if end.strip() else None)
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+        'invalid time window: {} (expected START:END)'.format(text))
+
+
+def runBatchRender(pattern, paths, jobs=None, keep_watching=False,
+                   render_cache=None, use_index=False):
+  """Renders many diagram descriptions in parallel, then exits.
+
+  Failures are reported per file and do not abort the rest of the batch. The
+  exit status is non-zero if any file failed.
+
+  Args:
+    pattern: A format string for the output paths, e.g. "out/{name}.png". See
+      batch.getOutputPath().
+    paths: A list of description files and directories containing them.
+    jobs: The number of worker processes. Defaults to the number of CPUs.
+    keep_watching: If True, after the batch is rendered, keeps watching the
+      paths and re-renders descriptions as they change, until interrupted.
+    render_cache: An optional cache.RenderCache, from which diagrams rendered
+      before are copied instead of being rendered again.
+    use_index: If True, descriptions are loaded through time indexes kept next
+      to them. Does not apply to re-renders while watching.
+  """
+  import batch
+
+  infile_names = batch.findDescriptions(paths)
+  failures = batch.renderFiles(infile_names, pattern, jobs, _reportRender,
+                               render_cache, use_index)
+  if failures:
+    print('{} of {} diagrams failed.'.format(len(failures), len(infile_names)),
+          file=sys.stderr)
+
+  if keep_watching:
+    import output
+    import watch
+    if output.needsQt(pattern):
+      import render
+      app = render.createHeadlessApplication()
+    print('Watching for changes. Press Ctrl+C to stop.')
+    try:
+      watch.watchFiles(paths, pattern, _reportRender,
+                       render_cache=render_cache)
+    except KeyboardInterrupt:
+      sys.exit(0)
+
+  sys.exit(1 if failures else 0)
+
+
+def _reportRender(infile_name, outfile_name, error):
+  """Prints the outcome of rendering a single file in a batch.
+
+  Args:
+    infile_name: The path of the description file.
+    outfile_name: The path of the rendered diagram.
+    error: An error message, or None if the file was rendered successfully.
+  """
+  if error:
+    print('{}: {}'.format(infile_name, error), file=sys.stderr)
+  else:
+    print('{} -> {}'.format(infile_name, outfile_name))
+
+
 def main():
-  """Decides whether to run the GUI or a simple one-off render.
+  """Decides whether to run the GUI, a simple one-off render or a batch render.
 
   If the program is run with no arguments, or only one argument is provided, the
   editor GUI is shown, and a file is loaded in the latter case.
 
   However, if two arguments are provided, the first is treated as the code to
   read and the second as the path where the output is to be stored. Note that
-  the output file is silently overwritten.
+  the output file is silently overwritten. Rendering images needs Qt, which on
+  X11 requires a display even though no window is shown (on servers, run under
+  a virtual one, e.g. with xvfb-run), while SVG output needs no Qt at all.
+  Giving an output path ending in .dtc compiles the code to a binary file
+  instead, which loads much faster than code when given as the input of later
+  renders.
+
+  The code file may also be a Value Change Dump (.vcd) from a simulator, in
+  which case --signals selects the signals to import by name, and --window the
+  range of times to import.
+
+  With --index, code files are loaded through a time index kept next to them
+  (e.g. example.dt.dti), built on first use and whenever the file changes. Only
+  the changes near the time window of the diagram, or that given by --window,
+  are then loaded, which speeds up rendering narrow windows of long captures.
+
+  With --batch, any number of description files or directories are rendered in
+  parallel, with output paths built from the given pattern. Adding --watch keeps
+  the program running and re-renders the descriptions as they change.
+
+  Rendered files are cached on disk, keyed by the parsed diagram, and copied
+  from the cache when the same diagram is rendered again, unless --no-cache is
+  given. The cache directory may be set with the DRAWTIME_CACHE variable.
+
+  With --stats, the time spent in each stage of a one-off render is printed,
+  along with counts of the primitives drawn, and with --trace-memory, the peak
+  memory allocated in each stage as well.
   """
-  app = QtGui.QApplication(sys.argv)
-  app.setApplicationName('DrawTime')
+  if getattr(sys, 'frozen', False):
+    # Only frozen executables need this, and it is not worth the import time
+    # of multiprocessing otherwise.
+    import multiprocessing
+    multiprocessing.freeze_support()
+
+  parser = argparse.ArgumentParser(
+      prog='drawtime',
+      usage='%(prog)s [--no-cache] [--stats [--trace-memory]] '
+            '[--index [--window START:END]] [code-file [diagram-file]]\n'
+            '       %(prog)s [--no-cache] [--stats [--trace-memory]] '
+            '[--signals PATTERN,...] [--window START:END] vcd-file diagram-file'
+            '\n'
+            '       %(prog)s --batch PATTERN [--jobs N] [--watch] [--no-cache] '
+            '[--index] code-file-or-dir...')
+  parser.add_argument('files', nargs='*', help=argparse.SUPPRESS)
+  parser.add_argument(
+      '--batch', metavar='PATTERN',
+      help='render all the given code files (and .dt files within given '
+           'directories) to paths built from PATTERN, where {name} is the '
+           'code file name without extension and {dir} is its directory')
+  parser.add_argument(
+      '--jobs', metavar='N', type=int,
+      help='the number of parallel processes used by --batch '
+           '(defaults to the number of CPUs)')
+  parser.add_argument(
+      '--watch', action='store_true',
+      help='with --batch, keep running and re-render code files as they change')
+  parser.add_argument(
+      '--no-cache', action='store_true',
+      help='always render, instead of copying diagrams rendered before from '
+           'the render cache')
+  parser.add_argument(
+      '--signals', metavar='PATTERN,...', type=lambda text: text.split(','),
+      help='the signals to import from a VCD code file, as shell-style '
+           'patterns of their full names, e.g. "top.cpu.*"')
+  parser.add_argument(
+      '--window', metavar='START:END', type=_parseWindow, default=(None, None),
+      help='the range of times to import from a VCD code file or to load '
+           'with --index (either end may be omitted)')
+  parser.add_argument(
+      '--index', action='store_true',
+      help='load code files through time indexes kept next to them, reading '
+           'only the changes within the time window')
+  parser.add_argument(
+      '--stats', action='store_true',
+      help='print the time spent in each stage of a one-off render')
+  parser.add_argument(
+      '--trace-memory', action='store_true',
+      help='with --stats, also print the peak memory use of each stage')
+  args = parser.parse_args()
+  render_cache = None
+  if not args.no_cache:
+    import cache
+    render_cache = cache.RenderCache()
+  stats = None
+  if args.stats:
+    import instrument
+    stats = instrument.Stats(trace_memory=args.trace_memory)
 
-  if len(sys.argv) == 1:
-    runGUI(app)
-  elif len(sys.argv) == 2:
-    runGUI(app, sys.argv[1])
-  elif len(sys.argv) == 3:
-    runQuickRender(*sys.argv[1:3])
+  if (args.stats or args.trace_memory) and (
+      args.batch or len(args.files) != 2):
+    parser.error('--stats requires a code file and a diagram file')
+  elif args.trace_memory and not args.stats:
+    parser.error('--trace-memory requires --stats')
+  elif args.signals and (
+      args.batch or args.index or len(args.files) != 2 or
+      not args.files[0].lower().endswith('.vcd')):
+    parser.error('--signals requires a VCD code file and a diagram file, and '
+                 'cannot be used with --index')
+  elif args.window != (None, None) and (
+      args.batch or len(args.files) != 2 or
+      not (args.index or args.files[0].lower().endswith('.vcd'))):
+    parser.error('--window requires a VCD code file or --index, and a '
+                 'diagram file')
+  elif args.index and not args.batch and len(args.files) != 2:
+    parser.error('--index requires --batch, or a code file and a diagram file')
+  elif args.batch:
+    if not args.files:
+      parser.error('--batch requires at least one code file or directory')
+    runBatchRender(args.batch, args.files, args.jobs, args.watch,
+                   render_cache, args.index)
+  elif args.watch:
+    parser.error('--watch requires --batch')
+  elif len(args.files) > 2:
+    parser.print_usage()
+  elif len(args.files) == 2:
+    runQuickRender(*args.files, render_cache=render_cache, stats=stats,
+                   signals=args.signals, window=args.window,
+                   use_index=args.index)
   else:
-    print('Usage:\npython3 drawtime [code-file [diagram-file]]')
+    runGUI(*args.files)
 
 
 if __name__ == '__main__':
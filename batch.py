@@ -0,0 +1,159 @@
+"""Batch rendering of many diagram descriptions across worker processes.
+
+render is imported only when the output format is drawn with Qt, so batches of
+SVG or compiled output never import Qt (see output.needsQt()).
+"""
+
+import multiprocessing
+import os
+import output
+import parse
+import timeindex
+
+
+# The extension of diagram description files searched for in directories.
+DESCRIPTION_EXTENSION = '.dt'
+
+# The QApplication of a worker process, created by _initWorker() if the output
+# format needs Qt.
+_app = None
+# The renderer reused by a worker process for all the images it renders, or
+# None if the output format needs no Qt.
+_renderer = None
+# The cache.RenderCache used by a worker process, or None.
+_render_cache = None
+# Whether a worker process loads descriptions through their time indexes.
+_use_index = False
+
+
+def findDescriptions(paths):
+  """Expands a list of files and directories into a list of description files.
+
+  Args:
+    paths: A list of paths. Files are included as-is, while directories are
+      searched recursively for files with DESCRIPTION_EXTENSION.
+
+  Returns:
+    A list of paths of description files.
+  """
+  infile_names = []
+  for path in paths:
+    if os.path.isdir(path):
+      for directory, subdirectories, filenames in os.walk(path):
+        subdirectories.sort()
+        infile_names += [os.path.join(directory, i) for i in sorted(filenames)
+                         if i.endswith(DESCRIPTION_EXTENSION)]
+    else:
+      infile_names.append(path)
+  return infile_names
+
+
+def getOutputPath(pattern, infile_name):
+  """Determines where the diagram rendered from a description is written.
+
+  Args:
+    pattern: A format string for the output path. The field {name} is replaced
+      with the name of the description file without its extension, and {dir}
+      with the directory containing it. E.g. "{dir}/{name}.png".
+    infile_name: The path of the description file.
+
+  Returns:
+    The path of the output file.
+  """
+  directory, filename = os.path.split(infile_name)
+  name = os.path.splitext(filename)[0]
+  return pattern.format(name=name, dir=directory or os.curdir)
+
+
+def renderFiles(infile_names, pattern, jobs=None, report=None,
+                render_cache=None, use_index=False):
+  """Renders description files in parallel across a pool of processes.
+
+  Each worker process creates a single QApplication and renderer, which are
+  reused for all the files it renders, unless the output paths name formats
+  written without Qt (see output.needsQt()). A file that fails to parse or
+  render does not abort the rest of the batch.
+
+  Args:
+    infile_names: A list of paths of description files to render.
+    pattern: A format string for the output paths. See getOutputPath().
+    jobs: The number of worker processes. Defaults to the number of CPUs.
+    report: An optional function called with the input path, output path and
+      error message (None on success) of each file as soon as it is done.
+    render_cache: An optional cache.RenderCache, from which diagrams rendered
+      before are copied instead of being rendered again.
+    use_index: If True, descriptions are loaded through time indexes kept next
+      to them. See timeindex.loadWindow().
+
+  Returns:
+    A list of (input path, error message) tuples for the files that failed.
+
+  Raises:
+    RuntimeError: If the workers need Qt and no display is available for them
+      to render with. See render.checkDisplay().
+  """
+  needs_qt = output.needsQt(pattern)
+  if needs_qt:
+    import render
+    # Checked before starting the pool, whose workers would otherwise fail to
+    # start over and over again.
+    render.checkDisplay()
+  tasks = [(i, getOutputPath(pattern, i)) for i in infile_names]
+  failures = []
+  with multiprocessing.Pool(
+      jobs, initializer=_initWorker,
+      initargs=(render_cache, use_index, needs_qt)) as pool:
+    for infile_name, outfile_name, error in pool.imap_unordered(
+        _renderFile, tasks):
+      if error:
+        failures.append((infile_name, error))
+      if report:
+        report(infile_name, outfile_name, error)
+  return failures
+
+
+def _initWorker(render_cache, use_index, needs_qt):
+  """Prepares a worker process for rendering, without showing any windows.
+
+  Args:
+    render_cache: The cache.RenderCache to use, or None.
+    use_index: Whether to load descriptions through their time indexes.
+    needs_qt: Whether the output format is drawn with Qt.
+  """
+  global _app, _renderer, _render_cache, _use_index
+  if needs_qt:
+    import render
+    _app = render.createHeadlessApplication()
+    _renderer = render.Renderer()
+  _render_cache = render_cache
+  _use_index = use_index
+
+
+def _renderFile(task):
+  """Renders a single description file in a worker process.
+
+  Args:
+    task: A tuple containing the input and output paths.
+
+  Returns:
+    A triple containing the input and output paths, and an error message or
+    None if the file was rendered successfully.
+  """
+  global _renderer
+  infile_name, outfile_name = task
+  try:
+    if _use_index:
+      diagram = timeindex.loadWindow(infile_name)
+    else:
+      diagram = parse.loadTimingFile(infile_name)
+    directory = os.path.dirname(outfile_name)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    output.writeDiagram(diagram, outfile_name, _render_cache, _renderer)
+  except Exception as e:
+    if _renderer is not None:
+      import render
+      # The renderer may be left half-way through an update.
+      _renderer = render.Renderer()
+    return infile_name, outfile_name, str(e) or type(e).__name__
+  return infile_name, outfile_name, None
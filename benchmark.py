@@ -0,0 +1,493 @@
+#!/usr/bin/python3
+"""Benchmarks of the parsing and rendering stages on synthetic diagrams.
+
+Each benchmark case generates a diagram description from a set of parameters,
+then times every stage of turning it into an image separately, over repeated
+runs. Results are written as JSON, and can be compared against the results of
+an earlier run to catch regressions. Example:
+
+  python3 benchmark.py --signals 10,100 --transitions 100,10000 -o new.json
+  python3 benchmark.py --signals 10,100 --compare old.json
+
+With --startup, the startup time of one-off renders from the command line is
+measured instead, and the modules they import are checked, so that rendering
+stays free of the editor GUI (and of Qt, for SVG output). With --highlight, the
+syntax highlighting tokenizer is compared with the sequential matching of the
+line patterns it replaced, and the editor's highlighter is timed on a whole
+document. Qt is only imported by the stage and highlighting benchmarks, so the
+startup benchmarks run without it.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import highlight
+import parse
+import svg
+
+
+# The number of times each stage is run per case by default.
+DEFAULT_REPEAT = 5
+
+# The default values of the parameters of generated descriptions. See
+# generateDescription() for their meaning.
+DEFAULT_PARAMETERS = {
+  'signals': 10,
+  'transitions': 100,
+  'label_length': 8,
+  'clock_cycles': 20,
+  'width': 800,
+  'height': 600,
+}
+
+# The time units between consecutive transitions of generated signals.
+TRANSITION_SPACING = 10
+
+# The factor by which a stage's median time must grow, compared to a previous
+# run, to be reported as a regression.
+DEFAULT_THRESHOLD = 1.2
+
+# The stages timed by runCase(), in order.
+STAGES = ('parse', 'load', 'draw_signals', 'compose', 'save', 'svg')
+
+# The stages timed by runHighlightCase(), in order.
+HIGHLIGHT_STAGES = ('sequential', 'single_pass', 'rehighlight')
+
+# The comment, block, property and change line patterns matched in turn by the
+# highlighter before it used highlight.tokenizeLine(), as a baseline for it.
+SEQUENTIAL_COMMENT_PATTERN = re.compile(r'^\s*#.*$')
+SEQUENTIAL_BLOCK_PATTERN = re.compile(
+    r'^\s*(style|time|(clock|line|bus)\s+(.+?))\s*(:)\s*$')
+SEQUENTIAL_PROPERTY_PATTERN = re.compile(r'^\s*({})\s*(=)\s*(.+?)\s*$'.format(
+    '|'.join(highlight.PROPERTY_NAMES)))
+SEQUENTIAL_CHANGE_PATTERN = re.compile(
+    r'^\s*([-\d]+)\s*(->)\s*(0|1|Z|\?|"(?:[^"]|\\.)*")\s*$')
+
+# The path of the program started by the startup benchmark, and of the
+# description it renders.
+PROGRAM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '__main__.pyw')
+EXAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data', 'example.dt')
+
+# The output formats of one-off renders measured by the startup benchmark by
+# default, and the top-level modules each must not import. The renders run with
+# the cache disabled and without --stats, so neither the cache nor memory
+# tracing may be loaded.
+STARTUP_FORBIDDEN_MODULES = {
+  'svg': ('cache', 'gui', 'PyQt4', 'tracemalloc'),
+  'png': ('cache', 'gui', 'tracemalloc'),
+}
+
+
+def generateDescription(signals, transitions, label_length, clock_cycles,
+                        width, height, seed=0):
+  """Generates the description of a synthetic diagram.
+
+  The first signal is a clock, and the rest alternate between lines and buses.
+  The time window spans all the transitions.
+
+  Args:
+    signals: The number of signals.
+    transitions: The number of changes of each line and bus.
+    label_length: The number of characters in each bus value.
+    clock_cycles: The number of clock cycles in the time window.
+    width: The width of the image in pixels.
+    height: The height of the image in pixels.
+    seed: The seed of the random values, so descriptions are reproducible.
+
+  Returns:
+    The description code.
+  """
+  generator = random.Random(seed)
+  end = max(transitions, 1) * TRANSITION_SPACING
+  lines = ['style:',
+           '  width = {}'.format(width),
+           '  height = {}'.format(height),
+           'time:',
+           '  start = 0',
+           '  end = {}'.format(end),
+           '  delay = 2',
+           'clock CLK:',
+           '  length = {}'.format(end / max(clock_cycles, 1)),
+           '  duty = 0.5',
+           '  offset = 0']
+
+  for index in range(1, signals):
+    if index % 2:
+      lines += ['line L{}:'.format(index), '  start = 0']
+      values = ['0', '1', 'Z']
+    else:
+      lines += ['bus B{}:'.format(index), '  start = ?']
+      values = ['"{}"'.format(''.join(
+          generator.choice('0123456789ABCDEF') for _ in range(label_length)))
+                for _ in range(16)] + ['Z', '?']
+    for change in range(transitions):
+      lines.append('  {} -> {}'.format(
+          change * TRANSITION_SPACING + generator.randrange(TRANSITION_SPACING),
+          generator.choice(values)))
+
+  return '\n'.join(lines) + '\n'
+
+
+def runCase(parameters, repeat=DEFAULT_REPEAT):
+  """Times each stage of parsing and rendering a generated diagram.
+
+  Every run uses a new renderer, so that no strips are reused between runs.
+  The compose stage is the rest of Renderer.draw() once the strips are drawn.
+  A QApplication must exist.
+
+  Args:
+    parameters: A dictionary of arguments for generateDescription().
+    repeat: The number of times each stage is run.
+
+  Returns:
+    A dictionary mapping the name of each stage to a list of times in seconds.
+  """
+  import render
+
+  code = generateDescription(**parameters)
+  times = {i: [] for i in STAGES}
+  handle, image_path = tempfile.mkstemp(suffix='.png')
+  os.close(handle)
+  svg_path = image_path[:-len('.png')] + '.svg'
+
+  def measure(stage, function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    times[stage].append(time.perf_counter() - start_time)
+    return result
+
+  try:
+    for _ in range(repeat):
+      diagram = measure('parse', parse.parseTimingDescription, code)
+      renderer = render.Renderer()
+      measure('load', renderer._loadDiagram, diagram)
+      measure('draw_signals', renderer._drawSignals,
+              renderer._layout.getKey())
+      measure('compose', renderer.draw, diagram)
+      measure('save', renderer.save, image_path)
+      measure('svg', svg.writeSvg, diagram, svg_path)
+  finally:
+    for path in image_path, svg_path:
+      if os.path.exists(path):
+        os.remove(path)
+
+  return times
+
+
+def runHighlightCase(parameters, repeat=DEFAULT_REPEAT):
+  """Times tokenizing every line of a generated diagram for highlighting.
+
+  The sequential stage matches each line against the line patterns in turn, as
+  the highlighter used to, and the single-pass stage uses
+  highlight.tokenizeLine() instead. The rehighlight stage highlights a document
+  holding the lines with gui.Highlighter, including the cost of applying the
+  formats. A QApplication must exist.
+
+  Args:
+    parameters: A dictionary of arguments for generateDescription().
+    repeat: The number of times each stage is run.
+
+  Returns:
+    A dictionary mapping the name of each stage to a list of times in seconds.
+
+  Raises:
+    ValueError: If the tokenizers disagree on a line.
+  """
+  from PyQt4 import QtGui
+  import gui
+
+  code = generateDescription(**parameters)
+  lines = code.splitlines()
+  for line in lines:
+    if highlight.tokenizeLine(line) != _tokenizeLineSequentially(line):
+      raise ValueError('Tokenizers disagree on line: {}'.format(line))
+
+  document = QtGui.QTextDocument()
+  document.setPlainText(code)
+  highlighter = gui.Highlighter(document)
+
+  def tokenizeAll(tokenize):
+    for line in lines:
+      tokenize(line)
+
+  stages = {
+    'sequential': lambda: tokenizeAll(_tokenizeLineSequentially),
+    'single_pass': lambda: tokenizeAll(highlight.tokenizeLine),
+    'rehighlight': highlighter.rehighlight,
+  }
+  times = {i: [] for i in HIGHLIGHT_STAGES}
+  for _ in range(repeat):
+    for stage in HIGHLIGHT_STAGES:
+      start_time = time.perf_counter()
+      stages[stage]()
+      times[stage].append(time.perf_counter() - start_time)
+  return times
+
+
+def _tokenizeLineSequentially(text):
+  """Tokenizes a line like highlight.tokenizeLine(), one pattern at a time."""
+  if SEQUENTIAL_COMMENT_PATTERN.match(text):
+    return ((0, len(text), highlight.COMMENT),)
+
+  match = SEQUENTIAL_BLOCK_PATTERN.match(text)
+  if match:
+    if match.group(2):
+      groups = ((2, highlight.BLOCK), (3, highlight.LABEL),
+                (4, highlight.OPERATOR))
+    else:
+      groups = ((1, highlight.BLOCK), (4, highlight.OPERATOR))
+  else:
+    match = SEQUENTIAL_PROPERTY_PATTERN.match(text)
+    groups = ((1, highlight.PROPERTY), (2, highlight.OPERATOR),
+              (3, highlight.VALUE))
+  if not match:
+    match = SEQUENTIAL_CHANGE_PATTERN.match(text)
+    groups = ((1, highlight.TIME), (2, highlight.OPERATOR),
+              (3, highlight.SIGNAL))
+  if not match:
+    return ()
+  return tuple((match.start(group), len(match.group(group)), kind)
+               for group, kind in groups)
+
+
+def runStartupCase(output_format, repeat=DEFAULT_REPEAT):
+  """Times one-off renders of the example description from the command line.
+
+  Each run starts a new interpreter, with the render cache disabled. One more
+  run lists the modules imported, using the interpreter's -X importtime option.
+
+  Args:
+    output_format: The extension of the rendered file, e.g. "svg".
+    repeat: The number of timed runs.
+
+  Returns:
+    A tuple containing a list of the times of the runs in seconds, and a set of
+    the names of the top-level modules imported.
+  """
+  handle, outfile_name = tempfile.mkstemp(suffix='.' + output_format)
+  os.close(handle)
+  command = [PROGRAM_PATH, '--no-cache', EXAMPLE_PATH, outfile_name]
+  times = []
+  try:
+    for _ in range(repeat):
+      start_time = time.perf_counter()
+      subprocess.check_call([sys.executable] + command)
+      times.append(time.perf_counter() - start_time)
+
+    output = subprocess.run([sys.executable, '-X', 'importtime'] + command,
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True).stderr
+  finally:
+    os.remove(outfile_name)
+
+  modules = set()
+  for line in output.splitlines():
+    if line.startswith('import time:') and line.count('|') == 2:
+      modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+  return times, modules
+
+
+def runStartupBenchmarks(formats, repeat=DEFAULT_REPEAT, report=None):
+  """Runs a startup case for each output format.
+
+  Args:
+    formats: A list of output formats, each a key of STARTUP_FORBIDDEN_MODULES.
+    repeat: The number of timed runs per format.
+    report: An optional function called with each case's result as it is done.
+
+  Returns:
+    A JSON-serializable dictionary like that of runBenchmarks(), with a single
+    "startup" stage per case. Each case also lists the forbidden modules that
+    were imported, if any.
+  """
+  cases = []
+  for output_format in formats:
+    times, modules = runStartupCase(output_format, repeat)
+    case = {
+      'parameters': {'format': output_format},
+      'stages': {'startup': _summarizeTimes(times)},
+      'forbidden_imports': sorted(
+          modules.intersection(STARTUP_FORBIDDEN_MODULES[output_format])),
+    }
+    cases.append(case)
+    if report:
+      report(case)
+  return _describeRun(repeat, cases)
+
+
+def runBenchmarks(sweep, repeat=DEFAULT_REPEAT, report=None,
+                  run_case=runCase):
+  """Runs a case for every combination of parameter values.
+
+  Args:
+    sweep: A dictionary mapping parameter names to lists of values. Parameters
+      not included take their values from DEFAULT_PARAMETERS.
+    repeat: The number of times each stage is run per case.
+    report: An optional function called with each case's result as it is done.
+    run_case: The function timing the stages of a case, e.g. runCase().
+
+  Returns:
+    A JSON-serializable dictionary describing the environment and the results,
+    with the minimum, median and mean time of each stage per case.
+  """
+  names = sorted(sweep)
+  cases = []
+  for values in itertools.product(*(sweep[i] for i in names)):
+    parameters = dict(DEFAULT_PARAMETERS)
+    parameters.update(zip(names, values))
+    times = run_case(parameters, repeat)
+    case = {
+      'parameters': parameters,
+      'stages': {stage: _summarizeTimes(samples)
+                 for stage, samples in times.items()},
+    }
+    cases.append(case)
+    if report:
+      report(case)
+  return _describeRun(repeat, cases)
+
+
+def findRegressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+  """Compares results against those of an earlier run.
+
+  Args:
+    results: The results of runBenchmarks().
+    baseline: The results of an earlier run of runBenchmarks().
+    threshold: The factor by which a median time must grow to be reported.
+
+  Returns:
+    A list of (parameters, stage, old median, new median) tuples, for the cases
+    present in both results whose stages became slower by the threshold.
+  """
+  old_cases = {_getCaseKey(i['parameters']): i for i in baseline['cases']}
+  regressions = []
+  for case in results['cases']:
+    old_case = old_cases.get(_getCaseKey(case['parameters']))
+    if not old_case:
+      continue
+    for stage, stats in case['stages'].items():
+      old_stats = old_case['stages'].get(stage)
+      if old_stats and stats['median'] > old_stats['median'] * threshold:
+        regressions.append((case['parameters'], stage,
+                            old_stats['median'], stats['median']))
+  return regressions
+
+
+def _summarizeTimes(samples):
+  """Returns the minimum, median and mean of a list of times."""
+  return {'min': min(samples),
+          'median': statistics.median(samples),
+          'mean': statistics.mean(samples)}
+
+
+def _describeRun(repeat, cases):
+  """Returns the results of a benchmark run, with a description of the host."""
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'repeat': repeat,
+    'cases': cases,
+  }
+
+
+def _getCaseKey(parameters):
+  """Returns a hashable key of the parameters of a case."""
+  return tuple(sorted(parameters.items()))
+
+
+def _reportCase(case):
+  """Prints a one-line summary of a case's median times to stderr."""
+  parameters = ' '.join('{}={}'.format(*i)
+                        for i in sorted(case['parameters'].items()))
+  stages = ' '.join('{}={:.2f}ms'.format(stage, stats['median'] * 1000)
+                    for stage, stats in case['stages'].items())
+  print('{}: {}'.format(parameters, stages), file=sys.stderr)
+  if case.get('forbidden_imports'):
+    print('  Imports forbidden modules: {}'.format(
+        ', '.join(case['forbidden_imports'])), file=sys.stderr)
+
+
+def main():
+  """Runs the benchmarks requested on the command line."""
+  parser = argparse.ArgumentParser(
+      description='Benchmark parsing and rendering of synthetic diagrams. '
+                  'Each parameter accepts a comma-separated list of values, '
+                  'and every combination is benchmarked.')
+  for name, default in sorted(DEFAULT_PARAMETERS.items()):
+    parser.add_argument(
+        '--' + name.replace('_', '-'), dest=name, metavar='N,...',
+        type=lambda text: [int(i) for i in text.split(',')],
+        default=[default], help='default: {}'.format(default))
+  parser.add_argument('--startup', action='store_true',
+                      help='measure the startup time of one-off renders from '
+                           'the command line instead')
+  parser.add_argument('--formats', metavar='FORMAT,...',
+                      type=lambda text: text.split(','),
+                      default=sorted(STARTUP_FORBIDDEN_MODULES),
+                      help='with --startup, the output formats to render '
+                           '(default: {})'.format(
+                               ','.join(sorted(STARTUP_FORBIDDEN_MODULES))))
+  parser.add_argument('--highlight', action='store_true',
+                      help='compare the syntax highlighting tokenizers on the '
+                           'lines of the generated diagrams instead')
+  parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                      help='runs per stage (default: {})'.format(
+                          DEFAULT_REPEAT))
+  parser.add_argument('-o', '--output', metavar='FILE',
+                      help='write the results as JSON to FILE')
+  parser.add_argument('--compare', metavar='FILE',
+                      help='compare the results with those in FILE, and exit '
+                           'with a non-zero status on regressions')
+  parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                      help='the slowdown factor reported as a regression '
+                           '(default: {})'.format(DEFAULT_THRESHOLD))
+  args = parser.parse_args()
+
+  if args.startup:
+    for output_format in args.formats:
+      if output_format not in STARTUP_FORBIDDEN_MODULES:
+        parser.error('unsupported format: {}'.format(output_format))
+    results = runStartupBenchmarks(args.formats, args.repeat, _reportCase)
+  elif args.highlight:
+    import render
+    app = render.createHeadlessApplication()
+    sweep = {i: getattr(args, i) for i in DEFAULT_PARAMETERS}
+    results = runBenchmarks(sweep, args.repeat, _reportCase, runHighlightCase)
+  else:
+    import render
+    app = render.createHeadlessApplication()
+    sweep = {i: getattr(args, i) for i in DEFAULT_PARAMETERS}
+    results = runBenchmarks(sweep, args.repeat, _reportCase)
+
+  if args.output:
+    with open(args.output, 'w', encoding='utf8') as outfile:
+      json.dump(results, outfile, indent=2)
+
+  if args.compare:
+    with open(args.compare, encoding='utf8') as infile:
+      regressions = findRegressions(results, json.load(infile), args.threshold)
+    for parameters, stage, old_median, new_median in regressions:
+      print('Regression in {} with {}: {:.2f}ms -> {:.2f}ms'.format(
+          stage, _getCaseKey(parameters), old_median * 1000,
+          new_median * 1000), file=sys.stderr)
+    if regressions:
+      sys.exit(1)
+
+  if any(i.get('forbidden_imports') for i in results['cases']):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
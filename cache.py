@@ -0,0 +1,224 @@
+"""An on-disk cache of rendered diagrams, keyed by their parsed contents."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import model
+
+
+# The directory used by default to store rendered diagrams. May be overridden by
+# the DRAWTIME_CACHE environment variable.
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'drawtime')
+
+# The default maximum total size of the cached files in bytes. When exceeded,
+# the least recently used files are evicted.
+DEFAULT_SIZE_LIMIT = 256 * 1024 * 1024
+
+# A number included in every key. Incremented whenever a change to the renderers
+# changes their output, to invalidate files rendered by older versions.
+KEY_VERSION = 1
+
+# The fraction of the size limit down to which files are evicted once it is
+# exceeded, so that a full cache is not scanned again on every store.
+EVICTION_TARGET = 0.9
+
+# The suffix of files being written to the cache, before they are moved into
+# place under their final name.
+TEMPORARY_SUFFIX = '.tmp'
+
+# The number of seconds for which temporary files are kept by eviction. Younger
+# ones may still be written by another process, while older ones are left over
+# from processes that were killed.
+TEMPORARY_GRACE_PERIOD = 3600
+
+
+def getDiagramKey(diagram, output_format):
+  """Computes the cache key of a rendered diagram.
+
+  The key is a hash of the parsed model rather than of the description, so it
+  does not depend on comments, whitespace or the order of properties. Changes
+  loaded from a compiled file are hashed by their source rather than their
+  contents (see model.Changes.getKey()), so that none of them are read.
+
+  Args:
+    diagram: The model.TimingDiagram to be rendered.
+    output_format: The format of the output, as the (case-insensitive)
+      extension of the output file, e.g. "png".
+
+  Returns:
+    A string of hexadecimal digits.
+  """
+  digest = hashlib.sha256()
+  digest.update(repr((
+      KEY_VERSION, output_format.lower().lstrip('.'), diagram.width,
+      diagram.height, diagram.margin, diagram.font_size, diagram.font_family,
+      diagram.background, diagram.foreground, diagram.start, diagram.end,
+      diagram.step, diagram.delay, len(diagram.signals))).encode('utf8'))
+
+  for signal in diagram.signals:
+    if isinstance(signal, model.Clock):
+      digest.update(repr(('clock', signal.name, signal.offset, signal.length,
+                          signal.duty)).encode('utf8'))
+    else:
+      changes = signal.changes
+      kind = 'line' if isinstance(signal, model.Line) else 'bus'
+      if changes.source is not None:
+        digest.update(repr((kind, signal.name, _normalizeValue(signal.start),
+                            changes.source)).encode('utf8'))
+        continue
+      table = tuple(_normalizeValue(i) for i in changes.table)
+      digest.update(repr((kind, signal.name, _normalizeValue(signal.start),
+                          len(changes), table)).encode('utf8'))
+      digest.update(bytes(changes.times))
+      digest.update(bytes(changes.codes))
+
+  return digest.hexdigest()
+
+
+def renderCached(render_cache, diagram, outfile_name, render):
+  """Renders a diagram to a file, copying it from a cache if possible.
+
+  Args:
+    render_cache: The RenderCache to use, or None to always render.
+    diagram: The model.TimingDiagram to render.
+    outfile_name: The path of the output file. Its extension determines the
+      output format.
+    render: A function called with the diagram and the output path to render
+      the diagram on a cache miss.
+
+  Returns:
+    True if the file was copied from the cache, False if it was rendered.
+  """
+  if render_cache is None:
+    render(diagram, outfile_name)
+    return False
+
+  key = getDiagramKey(diagram, os.path.splitext(outfile_name)[1])
+  if render_cache.fetch(key, outfile_name):
+    return True
+  render(diagram, outfile_name)
+  render_cache.store(key, outfile_name)
+  return False
+
+
+class RenderCache:
+  """A directory of rendered diagrams, shared by any number of processes.
+
+  Each file is stored under its key. Files are written to temporary names and
+  atomically renamed into place, so readers never see partial files, and files
+  evicted by one process while another reads them are treated as misses. The
+  modification time of a file records its last use, for LRU eviction.
+
+  Each process keeps an approximate total size of the cache, counted from a
+  scan of the directory and increased by the files it stores, so that the
+  directory is only scanned again when that total exceeds the size limit.
+  """
+
+  def __init__(self, directory=None, size_limit=DEFAULT_SIZE_LIMIT):
+    """Initializes the cache. The directory is created when first written.
+
+    Args:
+      directory: The directory holding the cached files. Defaults to the
+        DRAWTIME_CACHE environment variable, or DEFAULT_DIRECTORY.
+      size_limit: The maximum total size of the cached files in bytes.
+    """
+    self.directory = (directory or os.environ.get('DRAWTIME_CACHE') or
+                      DEFAULT_DIRECTORY)
+    self.size_limit = size_limit
+    self._size = None
+
+  def fetch(self, key, outfile_name):
+    """Copies a cached file to an output path, if it is cached.
+
+    Args:
+      key: The key of the file, from getDiagramKey().
+      outfile_name: The path to which the file is copied. If the file already
+        exists, it is silently overwritten.
+
+    Returns:
+      True if the file was cached and copied, False otherwise, including when
+      it could not be read or copied, in which case it is to be rendered.
+    """
+    path = self._getPath(key)
+    try:
+      shutil.copyfile(path, outfile_name)
+      os.utime(path)
+    except OSError:
+      return False
+    return True
+
+  def store(self, key, infile_name):
+    """Adds a copy of a rendered file to the cache, then evicts old files.
+
+    Errors are ignored, since a failure to cache must not fail a render.
+
+    Args:
+      key: The key of the file, from getDiagramKey().
+      infile_name: The path of the rendered file.
+    """
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      handle, temporary_name = tempfile.mkstemp(
+          suffix=TEMPORARY_SUFFIX, dir=self.directory)
+      try:
+        with open(infile_name, 'rb') as infile, open(handle, 'wb') as outfile:
+          shutil.copyfileobj(infile, outfile)
+          size = outfile.tell()
+        os.replace(temporary_name, self._getPath(key))
+      except BaseException:
+        os.remove(temporary_name)
+        raise
+      if self._size is not None:
+        self._size += size
+      if self._size is None or self._size > self.size_limit:
+        self.evict()
+    except OSError:
+      pass
+
+  def evict(self):
+    """Deletes the least recently used files if the size limit is exceeded.
+
+    Files are deleted until the total size is below EVICTION_TARGET of the
+    limit. Temporary files younger than TEMPORARY_GRACE_PERIOD are never
+    deleted, since other processes may still be writing them.
+    """
+    entries = []
+    total_size = 0
+    oldest_temporary = time.time() - TEMPORARY_GRACE_PERIOD
+    for entry in os.scandir(self.directory):
+      try:
+        if not entry.is_file():
+          continue
+        stat = entry.stat()
+      except OSError:
+        continue
+      total_size += stat.st_size
+      if (not entry.name.endswith(TEMPORARY_SUFFIX) or
+          stat.st_mtime < oldest_temporary):
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    if total_size > self.size_limit:
+      entries.sort()
+      for _, size, path in entries:
+        if total_size <= self.size_limit * EVICTION_TARGET:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        except OSError:
+          continue
+        total_size -= size
+    self._size = total_size
+
+  def _getPath(self, key):
+    """Returns the path of the file stored under a key."""
+    return os.path.join(self.directory, key)
+
+
+def _normalizeValue(value):
+  """Returns a representation of a signal value that is stable across runs."""
+  # A tuple cannot be confused with any value a signal can take.
+  return ('unknown',) if value is model.UNKNOWN else value
@@ -0,0 +1,589 @@
+"""A compact binary form of timing diagrams, loaded through a memory map.
+
+Compiled (.dtc) files hold a parsed model.TimingDiagram, so that large,
+machine-generated diagrams are parsed once rather than on every render. All
+integers and floats are stored little-endian. A file is laid out as follows:
+  1. A header (HEADER) holding the diagram's properties, the number of signals
+     and strings, and the offsets of the signal index and string table.
+  2. The columns of each line and bus signal: their change times as doubles,
+     their value codes, for buses, the string references of their distinct
+     values, and the columns of their time blocks (see below). Every column
+     starts at a multiple of 8 bytes.
+  3. The signal index, an entry (SIGNAL) per signal pointing at its columns.
+  4. The string table, holding every distinct signal name, font name and bus
+     value once: the end offset of each string, followed by their UTF-8 bytes.
+
+Strings are referenced by their index in the table, except for UNKNOWN and None,
+which have the negative references UNKNOWN_REFERENCE and NONE_REFERENCE.
+
+The time of a file is divided into fixed blocks, starting at the time of the
+earliest change. For each block a signal's changes reach, the index of its
+first change within the block and the value in effect at the start of the block
+are stored, coded like the start value of the signal.
+
+Loading a file maps it into memory without reading its columns. The changes of
+each signal are backed by views of the mapped file, and bus values are decoded
+only when looked up, so a render reads only the pages holding the changes within
+its time window. The changes are keyed by the identity of the file and the
+offsets of their columns (see model.Changes.getKey()), so caching their renders
+reads none of them either. A window of time may also be loaded by itself, in
+which case only the blocks it overlaps are part of the diagram.
+"""
+
+import array
+import bisect
+import collections.abc
+import math
+import mmap
+import os
+import struct
+import sys
+import instrument
+import model
+
+
+# The extension of compiled diagram files.
+COMPILED_EXTENSION = '.dtc'
+
+# The bytes with which every compiled file starts.
+MAGIC = b'DTC\0'
+
+# The version of the format. Incremented whenever the layout changes.
+FORMAT_VERSION = 2
+
+# The file header: the magic bytes, the format version, flags of the time
+# properties (see TIME_PROPERTIES), the style properties, the string reference
+# of the font family, the time properties, the number of signals, the number of
+# strings, the offset of the signal index, the offset of the string table, the
+# start and duration of the time blocks, and the modification time (in
+# nanoseconds) and size of the file the diagram was read from, or zeros.
+HEADER = struct.Struct('<4sHH6qi4x4dIIQQddqq')
+
+# An entry of the signal index: the kind of signal (see SIGNAL_KINDS), the
+# string reference of its name, its start value, the number of its distinct
+# values, the number of its changes, the offsets of its columns of times, codes
+# and values, the offset, length and duty of clocks, the number of time blocks
+# and the offset of their columns.
+SIGNAL = struct.Struct('<B3xiiIQQQQ3dQQ')
+
+# The number of changes of the densest signal in each time block, by default.
+BLOCK_CHANGES = 4096
+
+# The integer style properties stored in the header, in order.
+STYLE_PROPERTIES = ('width', 'height', 'margin', 'font_size', 'background',
+                    'foreground')
+
+# The time properties stored in the header as doubles, in order. The header
+# flags have a bit per property set if it was an integer, and a bit per property
+# (shifted by len(TIME_PROPERTIES)) set if it was None.
+TIME_PROPERTIES = ('start', 'end', 'step', 'delay')
+
+# The kinds of signals, indexed by their codes in the signal index.
+SIGNAL_KINDS = (model.Clock, model.Line, model.Bus)
+
+# The start values of line signals, indexed by their codes in the signal index.
+LINE_START_VALUES = model.LINE_VALUES + (model.UNKNOWN,)
+
+# The string references standing for UNKNOWN and None.
+UNKNOWN_REFERENCE = -1
+NONE_REFERENCE = -2
+
+# The array typecodes of the columns of times and of line and bus codes, and of
+# the string references of bus values.
+TIMES_TYPE = 'd'
+LINE_CODES_TYPE = 'B'
+BUS_CODES_TYPE = 'I'
+VALUES_TYPE = 'i'
+
+# The offsets of the string table and the indices of the first change of each
+# time block are unsigned 64-bit integers.
+STRING_OFFSETS_TYPE = 'Q'
+BLOCK_STARTS_TYPE = 'Q'
+
+
+class CompiledFormatError(ValueError):
+  """An error raised when a file is not a valid compiled diagram."""
+
+
+def isCompiledPath(path):
+  """Returns whether a path names a compiled file, judging by its extension."""
+  return path.lower().endswith(COMPILED_EXTENSION)
+
+
+def compileDiagram(diagram, filepath, stats=instrument.DISABLED,
+                   block_duration=None, source=(0, 0)):
+  """Writes a diagram to a compiled file.
+
+  Args:
+    diagram: The model.TimingDiagram to write.
+    filepath: The path of the compiled file. If the file already exists, it is
+      silently overwritten.
+    stats: An instrument.Stats in which the time spent is recorded.
+    block_duration: The duration of the time blocks. Defaults to one in which
+      the densest signal has about BLOCK_CHANGES changes per block.
+    source: The modification time in nanoseconds and size of the file the
+      diagram was read from, recorded to detect when it changes. See
+      readSource().
+  """
+  with stats.stage('compile'), open(filepath, 'wb') as outfile:
+    strings = _StringInterner()
+    grid = _getBlockGrid(diagram, block_duration)
+    outfile.write(bytes(HEADER.size))
+    entries = [_writeSignal(outfile, signal, strings, grid)
+               for signal in diagram.signals]
+
+    index_offset = _align(outfile)
+    for entry in entries:
+      outfile.write(SIGNAL.pack(*entry))
+    font_family = strings.intern(diagram.font_family)
+
+    strings_offset = _align(outfile)
+    encoded = [i.encode('utf8') for i in strings.strings]
+    offsets = array.array(STRING_OFFSETS_TYPE)
+    end = 0
+    for data in encoded:
+      end += len(data)
+      offsets.append(end)
+    _writeColumn(outfile, offsets)
+    outfile.writelines(encoded)
+
+    flags = 0
+    for bit, property in enumerate(TIME_PROPERTIES):
+      value = getattr(diagram, property)
+      if value is None:
+        flags |= 1 << (bit + len(TIME_PROPERTIES))
+      elif isinstance(value, int):
+        flags |= 1 << bit
+    outfile.seek(0)
+    outfile.write(HEADER.pack(
+        MAGIC, FORMAT_VERSION, flags,
+        *[getattr(diagram, i) for i in STYLE_PROPERTIES], font_family,
+        *[getattr(diagram, i) or 0 for i in TIME_PROPERTIES],
+        len(entries), len(encoded), index_offset, strings_offset, *grid,
+        *source))
+
+
+def readSource(path):
+  """Reads the modification time and size of the file a diagram was read from.
+
+  Args:
+    path: The path of the compiled file.
+
+  Returns:
+    The source recorded by compileDiagram(), or zeros if none was recorded.
+
+  Raises:
+    CompiledFormatError: If the file is not a valid compiled diagram.
+  """
+  with open(path, 'rb') as infile:
+    header = _unpackHeader(infile.read(HEADER.size))
+  return header[-2:]
+
+
+def loadDiagram(path, stats=instrument.DISABLED, window=None):
+  """Opens a compiled file and builds the diagram it holds.
+
+  The file is memory-mapped, and stays mapped for as long as the changes of any
+  of its signals are referenced. Only the header, the signal index and the
+  signal names are read up front. The source of the changes of each signal is
+  the path, size and modification time of the file, and the offset and range
+  of the signal's columns.
+
+  Args:
+    path: The path of the compiled file.
+    stats: An instrument.Stats in which the time spent is recorded.
+    window: An optional tuple of the start and end times to load, either of
+      which may be None to keep that of the diagram. If given, the diagram
+      shows the window, and the changes of each signal are limited to the time
+      blocks overlapping the window widened by the delay, plus the first change
+      after them. The start value of each signal is that in effect at the start
+      of its first block.
+
+  Returns:
+    A model.TimingDiagram whose line and bus changes are backed by the file.
+
+  Raises:
+    CompiledFormatError: If the file is not a valid compiled diagram.
+  """
+  with stats.stage('load_compiled'):
+    with open(path, 'rb') as infile:
+      try:
+        buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:
+        raise CompiledFormatError('Empty compiled diagram file.')
+      stat = os.fstat(infile.fileno())
+    identity = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    header = _unpackHeader(buffer)
+    flags = header[2]
+    style = header[3:3 + len(STYLE_PROPERTIES)]
+    font_family = header[3 + len(STYLE_PROPERTIES)]
+    times = header[4 + len(STYLE_PROPERTIES):-8]
+    (signal_count, string_count, index_offset, strings_offset, block_origin,
+     block_duration) = header[-8:-2]
+
+    strings = _StringTable(buffer, strings_offset, string_count)
+    diagram = model.TimingDiagram(**dict(zip(STYLE_PROPERTIES, style)))
+    diagram.font_family = strings.get(font_family)
+    for bit, (property, value) in enumerate(zip(TIME_PROPERTIES, times)):
+      if flags & (1 << (bit + len(TIME_PROPERTIES))):
+        value = None
+      elif flags & (1 << bit):
+        value = int(value)
+      setattr(diagram, property, value)
+
+    blocks = None
+    if window is not None:
+      start, end = window
+      if start is not None:
+        diagram.start = start
+      if end is not None:
+        diagram.end = end
+      blocks = _BlockRange(block_origin, block_duration,
+                           diagram.start - diagram.delay,
+                           diagram.end + diagram.delay)
+
+    for index in range(signal_count):
+      entry = _unpack(SIGNAL, buffer, index_offset + index * SIGNAL.size)
+      diagram.signals.append(
+          _readSignal(buffer, entry, strings, blocks, identity))
+
+  return diagram
+
+
+class _BlockRange:
+  """The range of time blocks overlapping a window of time."""
+
+  __slots__ = ('origin', 'duration', 'start', 'end')
+
+  def __init__(self, origin, duration, start, end):
+    """Initializes the range.
+
+    Args:
+      origin: The start time of the first block.
+      duration: The duration of each block.
+      start: The start of the window.
+      end: The end of the window.
+    """
+    self.origin = origin
+    self.duration = duration
+    self.start = start
+    self.end = end
+
+  def getBlocks(self, count):
+    """Returns the first and last block overlapping the window.
+
+    Args:
+      count: The number of blocks of a signal. Must be positive.
+
+    Returns:
+      A tuple of the indices of the first and last block, which are clamped to
+      the blocks of the signal.
+    """
+    def getBlock(time):
+      block = math.floor((time - self.origin) / self.duration)
+      return min(max(block, 0), count - 1)
+    return getBlock(self.start), getBlock(self.end)
+
+
+class _StringInterner:
+  """Assigns references to strings as they are written, storing each once."""
+
+  def __init__(self):
+    self.strings = []
+    self._references = {}
+
+  def intern(self, value):
+    """Returns the string reference of a string, UNKNOWN or None."""
+    if value is model.UNKNOWN:
+      return UNKNOWN_REFERENCE
+    elif value is None:
+      return NONE_REFERENCE
+    reference = self._references.get(value)
+    if reference is None:
+      reference = self._references[value] = len(self.strings)
+      self.strings.append(value)
+    return reference
+
+
+class _StringTable:
+  """The string table of a mapped compiled file, decoded on demand."""
+
+  def __init__(self, buffer, offset, count):
+    """Initializes the table.
+
+    Args:
+      buffer: The mapped file.
+      offset: The offset of the string table in the file.
+      count: The number of strings in the table.
+    """
+    self._buffer = buffer
+    self._ends = _readColumn(buffer, offset, count, STRING_OFFSETS_TYPE)
+    self._start = offset + len(self._ends) * self._ends.itemsize
+    self._strings = {}
+
+  def get(self, reference):
+    """Returns the string, UNKNOWN or None that a string reference stands for.
+
+    Raises:
+      CompiledFormatError: If the reference is out of range.
+    """
+    if reference == UNKNOWN_REFERENCE:
+      return model.UNKNOWN
+    elif reference == NONE_REFERENCE:
+      return None
+    elif not 0 <= reference < len(self._ends):
+      raise CompiledFormatError(
+          'Invalid string reference: {}'.format(reference))
+
+    value = self._strings.get(reference)
+    if value is None:
+      start = self._start + (self._ends[reference - 1] if reference else 0)
+      end = self._start + self._ends[reference]
+      if end > len(self._buffer):
+        raise CompiledFormatError('Truncated compiled diagram file.')
+      value = self._strings[reference] = str(self._buffer[start:end], 'utf8')
+    return value
+
+
+class _BusValues(collections.abc.Sequence):
+  """The distinct values of a compiled bus signal, decoded on demand."""
+
+  __slots__ = ('_strings', '_references')
+
+  def __init__(self, strings, references):
+    """Initializes the values.
+
+    Args:
+      strings: The _StringTable of the file.
+      references: A sequence of the string references of the values.
+    """
+    self._strings = strings
+    self._references = references
+
+  def __getitem__(self, index):
+    return self._strings.get(self._references[index])
+
+  def __len__(self):
+    return len(self._references)
+
+
+def _getBlockGrid(diagram, duration=None):
+  """Chooses the time blocks of a compiled file.
+
+  Args:
+    diagram: The model.TimingDiagram being compiled.
+    duration: The duration of the blocks, or None to choose one in which the
+      densest signal has about BLOCK_CHANGES changes per block.
+
+  Returns:
+    A tuple of the start time of the first block and the duration of blocks.
+  """
+  origin = last = None
+  most_changes = 0
+  for signal in diagram.signals:
+    if not isinstance(signal, model.Clock) and len(signal.changes):
+      times = signal.changes.times
+      origin = times[0] if origin is None else min(origin, times[0])
+      last = times[-1] if last is None else max(last, times[-1])
+      most_changes = max(most_changes, len(times))
+
+  if origin is None:
+    return 0, duration or 1
+  if duration is None:
+    duration = (last - origin or 1) * min(BLOCK_CHANGES / most_changes, 1)
+  return origin, duration
+
+
+def _writeSignal(outfile, signal, strings, grid):
+  """Writes the columns of a signal and builds its signal index entry.
+
+  Args:
+    outfile: The binary file being compiled.
+    signal: The model.Clock, model.Line or model.Bus to write.
+    strings: The _StringInterner of the file.
+    grid: A tuple of the start time of the first block and the duration of the
+      time blocks.
+
+  Returns:
+    A tuple of the fields of the signal's SIGNAL entry.
+  """
+  kind = SIGNAL_KINDS.index(type(signal))
+  name = strings.intern(signal.name)
+  if isinstance(signal, model.Clock):
+    return (kind, name, 0, 0, 0, 0, 0, 0,
+            signal.offset, signal.length, signal.duty, 0, 0)
+
+  changes = signal.changes
+  if isinstance(signal, model.Line):
+    # Lines built by the model always code their values as in LINE_VALUES.
+    if tuple(changes.table[:len(model.LINE_VALUES)]) != model.LINE_VALUES:
+      changes = model.Line(signal.name, signal.start, dict(changes)).changes
+    start = LINE_START_VALUES.index(signal.start)
+    codes_type = LINE_CODES_TYPE
+    values = array.array(VALUES_TYPE)
+    # The codes of line values are also their indices in LINE_START_VALUES.
+    coded_values = range(len(model.LINE_VALUES))
+  else:
+    start = strings.intern(signal.start)
+    codes_type = BUS_CODES_TYPE
+    values = array.array(VALUES_TYPE, map(strings.intern, changes.table))
+    coded_values = values
+
+  times = array.array(TIMES_TYPE, changes.times)
+  codes = array.array(codes_type, changes.codes)
+  times_offset = _writeColumn(outfile, times)
+  codes_offset = _writeColumn(outfile, codes)
+  values_offset = _writeColumn(outfile, values)
+
+  origin, duration = grid
+  block_starts = array.array(BLOCK_STARTS_TYPE)
+  block_values = array.array(VALUES_TYPE)
+  if times:
+    for block in range(math.floor((times[-1] - origin) / duration) + 1):
+      index = bisect.bisect_left(times, origin + block * duration)
+      block_starts.append(index)
+      block_values.append(coded_values[codes[index - 1]] if index else start)
+    block_starts.append(len(times))
+  blocks_offset = _writeColumn(outfile, block_starts)
+  _writeColumn(outfile, block_values)
+
+  return (kind, name, start, len(values), len(changes), times_offset,
+          codes_offset, values_offset, 0, 0, 0, len(block_values),
+          blocks_offset)
+
+
+def _readSignal(buffer, entry, strings, blocks=None, identity=None):
+  """Builds a signal from its signal index entry.
+
+  Args:
+    buffer: The mapped file.
+    entry: A tuple of the fields of the signal's SIGNAL entry.
+    strings: The _StringTable of the file.
+    blocks: An optional _BlockRange of the time blocks to load.
+    identity: An optional tuple identifying the contents of the file, from
+      which the source of the signal's changes is built. See model.Changes.
+
+  Returns:
+    A model.Clock, model.Line or model.Bus.
+
+  Raises:
+    CompiledFormatError: If the entry is invalid.
+  """
+  (kind, name, start, value_count, change_count, times_offset, codes_offset,
+   values_offset, offset, length, duty, block_count, blocks_offset) = entry
+  if kind >= len(SIGNAL_KINDS):
+    raise CompiledFormatError('Invalid signal kind: {}'.format(kind))
+  signal_type = SIGNAL_KINDS[kind]
+  name = strings.get(name)
+  if signal_type is model.Clock:
+    return model.Clock(name, offset, length, duty)
+
+  codes_type = (LINE_CODES_TYPE if signal_type is model.Line else
+                BUS_CODES_TYPE)
+  times = _readColumn(buffer, times_offset, change_count, TIMES_TYPE)
+  codes = _readColumn(buffer, codes_offset, change_count, codes_type)
+  begin, end = 0, change_count
+  if blocks is not None and block_count:
+    block_starts = _readColumn(buffer, blocks_offset, block_count + 1,
+                               BLOCK_STARTS_TYPE)
+    block_values = _readColumn(
+        buffer, blocks_offset + len(block_starts) * block_starts.itemsize,
+        block_count, VALUES_TYPE)
+    first, last = blocks.getBlocks(block_count)
+    begin = block_starts[first]
+    end = min(block_starts[last + 1] + 1, change_count)
+    if not begin <= end <= change_count:
+      raise CompiledFormatError('Invalid time blocks: {}'.format(name))
+    start = block_values[first]
+    times = times[begin:end]
+    codes = codes[begin:end]
+  source = None
+  if identity is not None:
+    source = identity + (times_offset, begin, end)
+
+  if signal_type is model.Line:
+    if not 0 <= start < len(LINE_START_VALUES):
+      raise CompiledFormatError('Invalid line start value: {}'.format(start))
+    changes = model.Changes(times, codes, model.LINE_VALUES, source)
+    return model.Line(name, LINE_START_VALUES[start], changes)
+
+  values = _BusValues(strings, _readColumn(buffer, values_offset, value_count,
+                                           VALUES_TYPE))
+  changes = model.Changes(times, codes, values, source)
+  return model.Bus(name, strings.get(start), changes)
+
+
+def _writeColumn(outfile, column):
+  """Writes an array at the next multiple of 8 bytes, and returns its offset."""
+  offset = _align(outfile)
+  if sys.byteorder != 'little':
+    column = array.array(column.typecode, column)
+    column.byteswap()
+  column.tofile(outfile)
+  return offset
+
+
+def _readColumn(buffer, offset, count, typecode):
+  """Returns a view of an array stored in a mapped file.
+
+  Args:
+    buffer: The mapped file.
+    offset: The offset of the array in the file.
+    count: The number of items in the array.
+    typecode: The array typecode of the items.
+
+  Returns:
+    A memoryview of the items, or on big-endian platforms, a byte-swapped copy.
+
+  Raises:
+    CompiledFormatError: If the array extends past the end of the file.
+  """
+  end = offset + count * array.array(typecode).itemsize
+  if end > len(buffer):
+    raise CompiledFormatError('Truncated compiled diagram file.')
+  column = memoryview(buffer)[offset:end].cast(typecode)
+  if sys.byteorder != 'little':
+    column = array.array(typecode, column)
+    column.byteswap()
+  return column
+
+
+def _unpackHeader(buffer):
+  """Unpacks and validates the header of a compiled file.
+
+  Args:
+    buffer: The file's contents, or at least their first HEADER.size bytes.
+
+  Returns:
+    A tuple of the fields of the HEADER.
+
+  Raises:
+    CompiledFormatError: If the file is not a valid compiled diagram.
+  """
+  if len(buffer) < HEADER.size:
+    raise CompiledFormatError('Truncated compiled diagram file.')
+  header = HEADER.unpack_from(buffer)
+  magic, version = header[:2]
+  if magic != MAGIC:
+    raise CompiledFormatError('Not a compiled diagram file.')
+  if version != FORMAT_VERSION:
+    raise CompiledFormatError(
+        'Unsupported compiled diagram version: {}'.format(version))
+  return header
+
+
+def _unpack(structure, buffer, offset):
+  """Unpacks a struct from a mapped file, checking that it is within bounds."""
+  if offset + structure.size > len(buffer):
+    raise CompiledFormatError('Truncated compiled diagram file.')
+  return structure.unpack_from(buffer, offset)
+
+
+def _align(outfile):
+  """Pads a binary file to a multiple of 8 bytes, and returns its position."""
+  position = outfile.tell()
+  padding = -position % 8
+  if padding:
+    outfile.write(bytes(padding))
+  return position + padding
@@ -1,8 +1,9 @@
 """A Qt GUI for editing and rendering DrawTime timing diagrams."""
 
-import re
 import time
 from PyQt4 import QtCore, QtGui
+import highlight
+import instrument
 import parse
 import render
 
@@ -22,12 +23,20 @@ PREVIEW_INSTANT = object()
 PREVIEW_DELAYED = object()
 # The value of Editor.preview_mode that represents no automatic preview.
 PREVIEW_MANUAL = object()
-# The length of time in seconds after an editing action before a delayed preview
-# is triggered. Fractions are supported if the time module provides them.
-PREVIEW_DELAY = 2
-# The number of milliseconds between ticks of the timer that checks whether a
-# delayed preview should be triggered.
-PREVIEW_TIMER_RESOLUTION = 50
+# The minimum and maximum number of milliseconds after the last editing action
+# before a delayed preview is triggered.
+PREVIEW_MIN_DELAY = 250
+PREVIEW_MAX_DELAY = 2000
+# The delay before a delayed preview is triggered, relative to the recent time
+# taken to parse and render a preview. Clamped to the bounds above.
+PREVIEW_DELAY_FACTOR = 4
+# The weight of the latest measurement in the moving average of the time taken
+# to parse and render a preview.
+PREVIEW_COST_WEIGHT = 0.3
+# The factor by which the canvas zooms in or out per step of the mouse wheel.
+ZOOM_STEP = 1.25
+# The maximum zoom level of the canvas.
+MAX_ZOOM = 4096
 
 
 class Editor(QtGui.QMainWindow):
@@ -39,6 +48,7 @@ class Editor(QtGui.QMainWindow):
     self.setupMenu()
     self.setupEditor()
     self.setupCanvas()
+    self.setupPreviewWorker()
     self.setupSize()
     self.statusBar()
     self.setWindowIcon(QtGui.QIcon(ICON_PATH))
@@ -46,8 +56,9 @@ class Editor(QtGui.QMainWindow):
     self.filepath = None
     self.saved = True
     self.preview_mode = PREVIEW_INSTANT
-    self.last_action_time = None
-    self.preview_timer = None
+    self.preview_generation = 0
+    self.preview_cost = None
+    self.preview_dropped = False
 
     self.markSaved()
 
@@ -90,6 +101,11 @@ class Editor(QtGui.QMainWindow):
     self.print_action.setShortcut('Ctrl+P')
     self.print_action.setEnabled(False)
 
+    self.stats_action = render_menu.addAction('Show &Statistics')
+    self.stats_action.setCheckable(True)
+    self.connect(self.stats_action, QtCore.SIGNAL('toggled(bool)'),
+                 self.toggleStats)
+
   def setupEditor(self):
     """Creates the editor with accessories and sets it as a centeral widget."""
     self.font = QtGui.QFont()
@@ -100,8 +116,7 @@ class Editor(QtGui.QMainWindow):
 
     self.editor = TabbedTextEdit()
     self.editor.setFont(self.font)
-    self.editor.setLineWrapMode(QtGui.QTextEdit.NoWrap)
-    self.editor.setAcceptRichText(False)
+    self.editor.setLineWrapMode(QtGui.QPlainTextEdit.NoWrap)
 
     self.error_selection = QtGui.QTextEdit.ExtraSelection()
     self.error_selection.format = QtGui.QTextCharFormat()
@@ -110,7 +125,7 @@ class Editor(QtGui.QMainWindow):
         QtGui.QTextFormat.FullWidthSelection, True)
     self.error_selection.cursor = self.editor.textCursor()
 
-    self.highlighter = Highlighter(self.editor)
+    self.highlighter = Highlighter(self.editor.document())
 
     self.setCentralWidget(self.editor)
     text_changed = QtCore.SIGNAL('textChanged()')
@@ -125,6 +140,25 @@ class Editor(QtGui.QMainWindow):
     self.dock.setWidget(self.canvas)
     self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.dock)
 
+  def setupPreviewWorker(self):
+    """Starts the thread that parses and renders previews in the background."""
+    self.preview_worker = PreviewWorker(self)
+    self.connect(self.preview_worker, QtCore.SIGNAL('previewReady'),
+                 self.showPreview)
+    self.connect(self.preview_worker, QtCore.SIGNAL('previewFailed'),
+                 self.showPreviewError)
+    self.preview_worker.start()
+    self.line_count = self.editor.document().blockCount()
+    self.document_revision = self.editor.document().revision()
+    self.connect(self.editor.document(),
+                 QtCore.SIGNAL('contentsChange(int, int, int)'),
+                 self.recordChange)
+
+    self.preview_timer = QtCore.QTimer(self)
+    self.preview_timer.setSingleShot(True)
+    self.connect(self.preview_timer, QtCore.SIGNAL('timeout()'),
+                 self.drawPreview)
+
   def setupSize(self):
     """Centers the main window and resize the dock to 45% width."""
     screen = QtGui.QDesktopWidget().availableGeometry()
@@ -147,7 +181,8 @@ class Editor(QtGui.QMainWindow):
       self.filepath = None
       self.editor.clear()
       self.markSaved()
-      self.canvas.loadDiagram(None)
+      self.preview_generation += 1
+      self.canvas.setImage(None)
 
   def showOpen(self):
     """Shows the file opening dialog.
@@ -218,11 +253,17 @@ class Editor(QtGui.QMainWindow):
     if is_on:
       self.live_preview_action.setChecked(False)
       self.preview_mode = PREVIEW_DELAYED
-      self.preview_timer = self.startTimer(PREVIEW_TIMER_RESOLUTION)
     elif self.preview_mode == PREVIEW_DELAYED:
       self.preview_mode = PREVIEW_MANUAL
-      if self.preview_timer:
-        self.killTimer(self.preview_timer)
+      self.preview_timer.stop()
+
+  def toggleStats(self, is_on):
+    """Toggles showing the time spent in each stage of a preview.
+
+    Args:
+      is_on: Whether statistics are collected and shown in the status bar.
+    """
+    self.preview_worker.collect_stats = is_on
 
   def drawAutoPreview(self):
     """Calls drawPreview() if preview mode is auto."""
@@ -230,31 +271,75 @@ class Editor(QtGui.QMainWindow):
       self.drawPreview()
 
   def drawPreview(self):
-    """Parses and draws the current diagram.
+    """Requests the current diagram to be parsed and drawn in the background.
 
-    Errors are reported via reportDiagramError() and clearDiagramError().
+    The result is delivered to showPreview() or showPreviewError(). Until then,
+    the status bar indicates that a preview is pending.
     """
     if self.dock.isHidden():
       self.dock.show()
 
     self.export_action.setEnabled(False)
     self.print_action.setEnabled(False)
-    
-    try:
-      diagram = parse.parseTimingDescription(self.editor.toPlainText())
-    except parse.TimingSyntaxError as e:
+
+    self.preview_generation += 1
+    self.preview_worker.request(self.preview_generation)
+    self.statusBar().showMessage('Rendering preview...')
+
+  def showPreview(self, generation, image, drawing, dirty_rects, elapsed,
+                  stats):
+    """Shows a preview produced by the preview worker.
+
+    Previews of requests superseded by a later one (or by clearing the editor)
+    are discarded.
+
+    Args:
+      generation: The number of the request that produced the preview.
+      image: The rendered QImage, or None if the diagram has no signals.
+      drawing: A tuple containing the diagram and its display lists, from
+        which the preview can be redrawn on other devices, or None.
+      dirty_rects: A list of QRects of the image changed since the last
+        preview delivered.
+      elapsed: The number of seconds taken to parse and render the preview.
+      stats: The instrument.Stats collected while preparing the preview, shown
+        in the status bar if enabled.
+    """
+    self.recordPreviewCost(elapsed)
+    if generation != self.preview_generation:
+      # The areas it changed are not repainted, so the next preview shown
+      # repaints the whole canvas.
+      self.preview_dropped = True
+      return
+
+    self.canvas.setImage(image, dirty_rects, drawing)
+    if self.preview_dropped:
+      self.canvas.update()
+      self.preview_dropped = False
+    self.export_action.setEnabled(image is not None)
+    self.print_action.setEnabled(image is not None)
+    self.clearDiagramError()
+    if stats:
+      self.statusBar().showMessage(stats.summarize())
+
+  def showPreviewError(self, generation, e, elapsed):
+    """Reports an error encountered by the preview worker.
+
+    Errors are reported via reportDiagramError() for syntax errors, and in the
+    status bar for other errors. Errors of superseded requests are ignored.
+
+    Args:
+      generation: The number of the request that failed.
+      e: The exception raised while parsing or rendering.
+      elapsed: The number of seconds spent before the error was raised.
+    """
+    self.recordPreviewCost(elapsed)
+    if generation != self.preview_generation:
+      return
+    if isinstance(e, parse.TimingSyntaxError):
       self.reportDiagramError(e)
     else:
-      try:
-        self.canvas.loadDiagram(diagram)
-        self.canvas.repaint()
-      except Exception as e:
-        self.canvas.loadDiagram(None)
-        self.statusBar().showMessage('Render error: {}.'.format(e))
-      else:
-        self.export_action.setEnabled(True)
-        self.print_action.setEnabled(True)
-        self.clearDiagramError()
+      self.canvas.setImage(None)
+      self.statusBar().showMessage('Render error: {}.'.format(e))
 
   def reportDiagramError(self, e):
     """Highlights an error line and shows the error message in the status bar.
@@ -264,9 +349,8 @@ class Editor(QtGui.QMainWindow):
     """
     self.statusBar().showMessage('Error: ' + e.message)
 
-    self.error_selection.cursor.setPosition(0)
-    self.error_selection.cursor.movePosition(
-        QtGui.QTextCursor.Down, QtGui.QTextCursor.MoveAnchor, e.line_number - 1)
+    block = self.editor.document().findBlockByNumber(e.line_number - 1)
+    self.error_selection.cursor.setPosition(block.position())
     self.error_selection.cursor.movePosition(
         QtGui.QTextCursor.Down, QtGui.QTextCursor.KeepAnchor)
     self.editor.setExtraSelections([self.error_selection])
@@ -286,10 +370,14 @@ class Editor(QtGui.QMainWindow):
     path = QtGui.QFileDialog.getSaveFileName(self, 'Save Diagram', '', filter)
 
     if path:
-      self.canvas.renderer.save(path)
+      self.canvas.save(path)
 
   def showPrint(self):
-    """Shows a printer selection dialog and prints the rendered image."""
+    """Shows a printer selection dialog and prints the rendered diagram.
+
+    The diagram is replayed from its display lists at the native resolution of
+    the printer, at the size it has on screen or shrunk to fit the page.
+    """
     printer = QtGui.QPrinter()
     dialog = QtGui.QPrintDialog(printer, self)
     dialog.setWindowTitle('Print Diagram')
@@ -298,8 +386,14 @@ class Editor(QtGui.QMainWindow):
       painter = QtGui.QPainter()
       is_printer_working = painter.begin(printer)
       if is_printer_working:
-        painter.drawImage(printer.pageRect().topLeft(),
-                          self.canvas.renderer.image)
+        diagram, display_lists = self.canvas.drawing
+        page = printer.pageRect()
+        scale = min(printer.logicalDpiX() / self.logicalDpiX(),
+                    page.width() / diagram.width,
+                    page.height() / diagram.height)
+        painter.translate(page.topLeft())
+        painter.scale(scale, scale)
+        render.Replayer(painter, diagram).paintDiagram(display_lists)
         painter.end()
       else:
         QtGui.QMessageBox.information(
@@ -350,22 +444,71 @@ class Editor(QtGui.QMainWindow):
         return True
     return self.saved
 
+  def recordChange(self, position, removed, added):
+    """Passes the lines affected by an edit of the document to the preview.
+
+    Only the lines spanned by the inserted text are read from the document, so
+    the preview worker never needs a copy of the whole text. Changes that only
+    affect formats, e.g. those made by the highlighter, replace as many
+    characters as they remove without changing the revision of the document,
+    and are ignored. Both halves of setPlainText() share a revision too, so the
+    revision alone is not enough.
+
+    Args:
+      position: The position in the document where the edit happened.
+      removed: The number of characters removed.
+      added: The number of characters added.
+    """
+    document = self.editor.document()
+    revision = document.revision()
+    if removed == added and revision == self.document_revision:
+      return
+    self.document_revision = revision
+
+    block = document.findBlock(position)
+    last = document.findBlock(
+        min(position + added, document.characterCount() - 1)).blockNumber()
+    first = block.blockNumber()
+    lines = [block.text()]
+    for _ in range(first, last):
+      block = block.next()
+      lines.append(block.text())
+
+    line_count = document.blockCount()
+    removed_lines = len(lines) - (line_count - self.line_count)
+    self.line_count = line_count
+    self.preview_worker.replaceLines(first, removed_lines, lines)
+
   def recordAction(self):
-    """Records the fact that an action occurred that can delay a preview."""
-    self.last_action_time = time.time()
+    """Records the fact that an action occurred that can delay a preview.
 
-  def timerEvent(self, _):
-    """Calls drawPreview() if preview mode is delayed and the delay has passed.
+    If preview mode is delayed, (re)starts the single-shot preview timer, so
+    that the preview is drawn once no actions occur for getPreviewDelay().
+    """
+    if self.preview_mode == PREVIEW_DELAYED:
+      self.preview_timer.start(self.getPreviewDelay())
 
-    Compares the current time to self.last_action_time and draws the preview if
-    it the difference is above PREVIEW_DELAYED. self.last_action_time is reset
-    to None on drawing.
+  def getPreviewDelay(self):
+    """Returns the number of milliseconds to wait before a delayed preview.
+
+    The delay is proportional to the recent time taken by previews, so cheap
+    diagrams are previewed quickly while expensive ones wait for a longer pause.
+    """
+    if self.preview_cost is None:
+      return PREVIEW_MAX_DELAY
+    delay = int(self.preview_cost * PREVIEW_DELAY_FACTOR * 1000)
+    return max(PREVIEW_MIN_DELAY, min(PREVIEW_MAX_DELAY, delay))
+
+  def recordPreviewCost(self, elapsed):
+    """Updates the moving average of the time taken to prepare previews.
+
+    Args:
+      elapsed: The number of seconds taken to parse and render a preview.
     """
-    if self.preview_mode == PREVIEW_DELAYED and self.last_action_time:
-      current_time = time.time()
-      if current_time - self.last_action_time >= PREVIEW_DELAY:
-        self.drawPreview()
-        self.last_action_time = None
+    if self.preview_cost is None:
+      self.preview_cost = elapsed
+    else:
+      self.preview_cost += PREVIEW_COST_WEIGHT * (elapsed - self.preview_cost)
 
   def keyPressEvent(self, event):
     """Triggers window closing when the user presses Escape."""
@@ -373,15 +516,19 @@ class Editor(QtGui.QMainWindow):
       self.close()
 
   def closeEvent(self, event):
-    """Ensures that on exit the current file is saved or can be discarded."""
+    """Ensures that on exit the current file is saved or can be discarded.
+
+    Stops the preview worker if the window is to be closed.
+    """
     if self.isSafeToReset():
+      self.preview_worker.stop()
       event.accept()
     else:
       event.ignore()
 
 
-class TabbedTextEdit(QtGui.QTextEdit):
-  """A QTextEdit that handles tabs as spaces and follows indents."""
+class TabbedTextEdit(QtGui.QPlainTextEdit):
+  """A QPlainTextEdit that handles tabs as spaces and follows indents."""
 
   def keyPressEvent(self, event):
     """Intercepts Tab and Enter key presses.
@@ -393,7 +540,7 @@ class TabbedTextEdit(QtGui.QTextEdit):
     to the current line, or larger by two spaces if the last line ended with a
     colon.
 
-    All other keys are passed on to QTextEdit's default keyPressEvent().
+    All other keys are passed on to QPlainTextEdit's default keyPressEvent().
 
     At the end of the event, emits a keyPressed() signal.
     """
@@ -417,31 +564,247 @@ class TabbedTextEdit(QtGui.QTextEdit):
     self.emit(QtCore.SIGNAL("keyPressed()"))
 
 
+class PreviewWorker(QtCore.QThread):
+  """A thread that parses and renders diagram previews in the background.
+
+  The worker holds its own copy of the description, split into lines, which
+  starts empty and is kept up to date by posting each edit of the document with
+  replaceLines(). Edits are applied before the next request is processed, so
+  only the blocks around the changed lines are extracted and parsed again.
+
+  Requests are posted with request(). If several requests arrive while a
+  preview is being prepared, only the latest is processed once it is done, and
+  the result of a request superseded while it was processed is discarded.
+
+  Results are reported through two signals:
+    previewReady(generation, image, drawing, dirty_rects, elapsed, stats):
+      The diagram was rendered into image (None if it has no signals).
+      drawing is a tuple of the diagram and its display lists (or None),
+      dirty_rects lists the areas changed since the last previewReady signal,
+      and stats is an instrument.Stats of the request if collect_stats is set.
+    previewFailed(generation, error, elapsed): Parsing or rendering raised
+      error.
+  In both, elapsed is the number of seconds spent on the request.
+  """
+
+  def __init__(self, parent=None):
+    super().__init__(parent)
+    self.parser = parse.IncrementalParser()
+    # An empty document holds a single empty line.
+    self.parser.setLines([''])
+    self.renderer = render.Renderer()
+    self.mutex = QtCore.QMutex()
+    self.condition = QtCore.QWaitCondition()
+    self.pending = None
+    self.edits = []
+    self.stopped = False
+    self.dirty_rects = []
+    self.collect_stats = False
+
+  def replaceLines(self, first, count, lines):
+    """Records an edit of the description, applied before the next preview.
+
+    Args:
+      first: The index of the first line replaced, counting from 0.
+      count: The number of lines replaced.
+      lines: A list of the lines replacing them.
+    """
+    self.mutex.lock()
+    self.edits.append((first, count, lines))
+    self.mutex.unlock()
+
+  def request(self, generation):
+    """Requests a preview, superseding any request not yet started.
+
+    Args:
+      generation: A number identifying the request, reported with its result.
+    """
+    self.mutex.lock()
+    self.pending = generation
+    self.condition.wakeOne()
+    self.mutex.unlock()
+
+  def stop(self):
+    """Stops the thread and waits for it to finish."""
+    self.mutex.lock()
+    self.stopped = True
+    self.condition.wakeOne()
+    self.mutex.unlock()
+    self.wait()
+
+  def run(self):
+    """Processes preview requests until stop() is called."""
+    while True:
+      self.mutex.lock()
+      while self.pending is None and not self.stopped:
+        self.condition.wait(self.mutex)
+      if self.stopped:
+        self.mutex.unlock()
+        return
+      generation = self.pending
+      edits = self.edits
+      self.pending = None
+      self.edits = []
+      self.mutex.unlock()
+
+      for edit in edits:
+        self.parser.replaceLines(*edit)
+
+      start_time = time.time()
+      stats = instrument.Stats() if self.collect_stats else instrument.DISABLED
+      try:
+        image, drawing = self.render(stats)
+      except Exception as e:
+        if not self.isSuperseded():
+          self.emit(QtCore.SIGNAL('previewFailed'),
+                    generation, e, time.time() - start_time)
+      else:
+        if not self.isSuperseded():
+          self.emit(QtCore.SIGNAL('previewReady'), generation, image, drawing,
+                    self.dirty_rects, time.time() - start_time, stats)
+          self.dirty_rects = []
+
+  def render(self, stats=instrument.DISABLED):
+    """Parses and renders the description held by the worker.
+
+    Args:
+      stats: An instrument.Stats in which the time spent is recorded.
+
+    Returns:
+      A tuple containing a copy of the rendered QImage and a tuple of the
+      diagram and its display lists, or a pair of None if the diagram has no
+      signals.
+    """
+    diagram = self.parser.parseLines(stats)
+    if not diagram.signals:
+      return None, None
+
+    try:
+      self.renderer.draw(diagram, stats)
+    except Exception:
+      # The renderer may be left half-way through an update.
+      self.renderer = render.Renderer()
+      raise
+    self.dirty_rects += self.renderer.dirty_rects
+    # A shallow copy; the renderer detaches from it when it next draws.
+    image = QtGui.QImage(self.renderer.image)
+    return image, (diagram, list(self.renderer.display_lists))
+
+  def isSuperseded(self):
+    """Returns whether a newer request is waiting to be processed."""
+    self.mutex.lock()
+    superseded = self.pending is not None
+    self.mutex.unlock()
+    return superseded
+
+
 class Canvas(QtGui.QWidget):
-  """A canvas drawn by the diagram renderer."""
+  """A canvas showing a rendered diagram image, which can be zoomed in on time.
+
+  At the default zoom level, the image rendered by the preview worker is shown.
+  When zoomed in, the time axis of the diagram is widened and only the part of
+  it in view is drawn, in tiles by a render.TileRenderer that keeps them for
+  reuse while panning. The labels and margins of the diagram stay in place.
+
+  Turning the mouse wheel zooms in or out around the pointer, dragging pans
+  along the time axis, and double-clicking restores the default zoom level.
+  """
 
   def __init__(self,  parent=None):
     super().__init__(parent)
-    self.renderer = render.Renderer()
+    self.image = None
+    self.drawing = None
+    self.zoom = 1
+    self.offset = 0
+    self.tiles = render.TileRenderer()
+    self.tiles_loaded = False
+    self.drag_start = None
 
   def isEmpty(self):
     """Returns whether the canvas has a valid diagram set."""
-    return self.renderer.image is not None
+    return self.image is not None
 
-  def loadDiagram(self, diagram):
-    """Loads a diagram into the widget.
+  def setImage(self, image, dirty_rects=(), drawing=None):
+    """Sets the diagram image shown by the widget.
 
     Args:
-      diagram: A model.TimingDiagram to be rendered on the canvas.
+      image: A QImage of the rendered diagram, or None to show no diagram.
+      dirty_rects: The areas of the image that changed since the last image
+        set. Ignored (and the whole canvas repainted) if the previous image was
+        None or of a different size, or if the canvas is zoomed in.
+      drawing: A tuple containing the diagram and the display lists of the
+        image, used to redraw it on other devices.
     """
-    if diagram and diagram.signals:
-      self.renderer.draw(diagram)
-      self.resize(self.renderer.image.size())
+    old_image = self.image
+    self.image = image
+    self.drawing = drawing
+    self.tiles_loaded = False
+    if self.zoom != 1 and drawing is not None:
+      self.loadTiles()
+      self.setOffset(self.offset)
+    if (image is None or old_image is None or image.size() != old_image.size()
+        or self.zoom != 1):
+      if image is not None:
+        self.resize(image.size())
+      self.update()
     else:
-      self.renderer.image = None
+      for rect in dirty_rects:
+        self.update(rect)
+
+  def loadTiles(self):
+    """Passes the shown diagram to the tile renderer, if not done already."""
+    if not self.tiles_loaded:
+      self.tiles.setDiagram(self.drawing[0])
+      self.tiles_loaded = True
+
+  def setZoom(self, zoom, anchor_x):
+    """Zooms the time axis in or out, keeping a point of it in place.
+
+    Args:
+      zoom: The new zoom level, clamped between 1 and MAX_ZOOM.
+      anchor_x: The X coordinate of the point of the canvas whose time is kept
+        in place. Clamped to the inner frame of the diagram.
+    """
+    zoom = max(1, min(MAX_ZOOM, zoom))
+    if self.drawing is None or zoom == self.zoom:
+      return
+    self.loadTiles()
+    frame = self.tiles.frame
+    anchor_x = max(frame.left(), min(frame.right(), anchor_x))
+    position = (anchor_x + self.offset - frame.left()) / self.zoom
+
+    self.zoom = zoom
+    self.tiles.setZoom(zoom)
+    self.setOffset(round(frame.left() + position * zoom - anchor_x))
+    self.update()
+
+  def setOffset(self, offset):
+    """Pans the time axis.
+
+    Args:
+      offset: The number of pixels by which the zoomed time axis is scrolled
+        to the left, clamped to the range that keeps the axis in view.
+    """
+    offset = max(0, min(self.tiles.extra_width, offset))
+    if offset != self.offset:
+      self.offset = offset
+      self.update()
+
+  def save(self, filepath):
+    """Saves the shown diagram image to a file.
+
+    Args:
+      filepath: The path to which the image is to be saved. The format of the
+        image is guessed from the extension. If the file already exists, it is
+        silently overwritten.
+    """
+    if self.image is None:
+      raise RuntimeError('No diagram loaded.')
+    if not self.image.save(filepath):
+      raise IOError('Failed to save image.')
 
   def paintEvent(self, event):
-    """Repaints the canvas from the self.renderer.image (if initialized).
+    """Repaints the canvas from self.image (if initialized).
 
     If no diagram or an invalid diagram is loaded, draws a message indicating
     that.
@@ -451,9 +814,12 @@ class Canvas(QtGui.QWidget):
     rect = QtCore.QRect(0, 0, size.width(), size.height())
     painter.fillRect(rect, QtCore.Qt.white)
 
-    if self.renderer.image:
+    if self.image and self.zoom != 1:
+      self.loadTiles()
+      self.tiles.paint(painter, event.rect(), self.offset)
+    elif self.image:
       dirty_rect = event.rect()
-      painter.drawImage(dirty_rect, self.renderer.image, dirty_rect)
+      painter.drawImage(dirty_rect, self.image, dirty_rect)
     else:
       painter.setPen(QtCore.Qt.black)
       painter.drawText(
@@ -465,24 +831,37 @@ class Canvas(QtGui.QWidget):
     """Reports the canvas's size, e.g. to containers."""
     return self.size()
 
+  def wheelEvent(self, event):
+    """Zooms in or out around the mouse pointer."""
+    self.setZoom(self.zoom * ZOOM_STEP ** (event.delta() / 120), event.x())
+
+  def mousePressEvent(self, event):
+    """Starts panning when the left mouse button is pressed."""
+    if event.button() == QtCore.Qt.LeftButton:
+      self.drag_start = event.x() + self.offset
+
+  def mouseMoveEvent(self, event):
+    """Pans the time axis along with the mouse while dragging."""
+    if self.drag_start is not None:
+      self.setOffset(self.drag_start - event.x())
+
+  def mouseReleaseEvent(self, event):
+    """Stops panning when the left mouse button is released."""
+    if event.button() == QtCore.Qt.LeftButton:
+      self.drag_start = None
+
+  def mouseDoubleClickEvent(self, event):
+    """Restores the default zoom level."""
+    self.setZoom(1, 0)
+
 
 class Highlighter(QtGui.QSyntaxHighlighter):
   """A highlighter for the DrawTime syntax."""
 
   def __init__(self, parent=None):
-    """Initializes syntax regexes and token styles."""
+    """Initializes token styles."""
     super().__init__(parent)
 
-    self.comment_pattern = re.compile(r'^\s*#.*$')
-    self.block_pattern = re.compile(
-        r'^\s*(style|time|(clock|line|bus)\s+(.+?))\s*(:)\s*$')
-    self.property_pattern = re.compile(r'^\s*({})\s*(=)\s*(.+?)\s*$'.format(
-        '|'.join(['width', 'height', 'margin', 'font_size', 'font_family',
-                  'background', 'foreground', 'step', 'start', 'end', 'delay',
-                  'length', 'offset', 'duty'])))
-    self.change_pattern = re.compile(
-        r'^\s*([-\d]+)\s*(->)\s*(0|1|Z|\?|"(?:[^"]|\\.)*")\s*$')
-
     self.block_format = QtGui.QTextCharFormat()
     self.block_format.setFontWeight(QtGui.QFont.Bold)
     self.block_format.setForeground(QtGui.QColor('#000080'))
@@ -502,53 +881,31 @@ class Highlighter(QtGui.QSyntaxHighlighter):
     self.signal_format = QtGui.QTextCharFormat()
     self.signal_format.setForeground(QtGui.QColor('#800000'))
 
+    self.formats = {
+      highlight.BLOCK: self.block_format,
+      highlight.LABEL: self.label_format,
+      highlight.COMMENT: self.comment_format,
+      highlight.PROPERTY: self.property_format,
+      highlight.OPERATOR: self.operator_format,
+      highlight.VALUE: self.value_format,
+      highlight.TIME: self.time_format,
+      highlight.SIGNAL: self.signal_format
+    }
+
   def highlightBlock(self, text):
     """Highlights a line of DrawTime code.
 
     For the purposes of highlighting, each line of DrawTime code can be
-    highlighted independently, and as such this method does not use the
-    QSyntaxHighlighter block state management utilities.
+    highlighted independently. The block state is left at its default, so
+    editing a line never causes the lines after it to be highlighted again.
 
-    All highlighting is done using setFormat.
+    Each line is scanned once by highlight.tokenizeLine(). All highlighting is
+    done using setFormat.
 
     Args:
       text: The contents of the line to highlight.
     """
-    if self.comment_pattern.match(text):
-      self.setFormat(0, len(text), self.comment_format)
-      return
-
-    block_line = self.block_pattern.match(text)
-    if block_line:
-      if block_line.group(2):
-        start, end = block_line.span(2)
-        self.setFormat(start, end - start, self.block_format)
-        start, end = block_line.span(3)
-        self.setFormat(start, end - start, self.label_format)
-      else:
-        start, end = block_line.span(1)
-        self.setFormat(start, end - start, self.block_format)
-      self.setFormat(block_line.span(4)[0], 1, self.operator_format)
-      return
-
-    property_line = self.property_pattern.match(text)
-    if property_line:
-      start, end = property_line.span(1)
-      self.setFormat(start, end - start, self.property_format)
+    formats = self.formats
+    for start, length, kind in highlight.tokenizeLine(text):
+      self.setFormat(start, length, formats[kind])
 
-      self.setFormat(property_line.span(2)[0], 1, self.operator_format)
-
-      start, end = property_line.span(3)
-      self.setFormat(start, end - start, self.value_format)
-      return
-
-    change_line = self.change_pattern.match(text)
-    if change_line:
-      start, end = change_line.span(1)
-      self.setFormat(start, end - start, self.time_format)
-
-      self.setFormat(change_line.span(2)[0], 2, self.operator_format)
-
-      start, end = change_line.span(3)
-      self.setFormat(start, end - start, self.signal_format)
-      return
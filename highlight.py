@@ -0,0 +1,76 @@
+"""A single-pass tokenizer of DrawTime code lines, for syntax highlighting.
+
+Each line is matched once against a single pattern combining the syntax of
+comments, block headers, properties and changes. The alternatives of the
+pattern are tried in the order in which separate patterns used to be, and the
+alternative that matched is identified by its last group, so no line is ever
+scanned twice. Lines are tokenized independently of each other.
+"""
+
+import re
+
+
+# The kinds of tokens, each highlighted with its own format.
+COMMENT = 'comment'
+BLOCK = 'block'
+LABEL = 'label'
+OPERATOR = 'operator'
+PROPERTY = 'property'
+VALUE = 'value'
+TIME = 'time'
+SIGNAL = 'signal'
+
+# The names of all the properties of every block type.
+PROPERTY_NAMES = ('width', 'height', 'margin', 'font_size', 'font_family',
+                  'background', 'foreground', 'step', 'start', 'end', 'delay',
+                  'length', 'offset', 'duty')
+
+# A pattern matching any highlighted line, with an alternative per kind of line.
+LINE_PATTERN = re.compile(
+    r'^\s*(?:'
+    r'(?P<comment>#.*)'
+    r'|(?P<keyword>style|time)\s*(?P<colon>:)\s*'
+    r'|(?P<signal_keyword>clock|line|bus)\s+(?P<label>.+?)\s*'
+    r'(?P<signal_colon>:)\s*'
+    r'|(?P<property>{})\s*(?P<equals>=)\s*(?P<value>.+?)\s*'
+    r'|(?P<time>[-\d]+)\s*(?P<arrow>->)\s*'
+    r'(?P<signal_value>0|1|Z|\?|"(?:[^"]|\\.)*")\s*'
+    r')$'.format('|'.join(PROPERTY_NAMES)))
+
+# The token groups of each non-comment alternative of LINE_PATTERN, in the order
+# in which they appear in a line, with the kinds of their tokens. Keyed by the
+# last group of the alternative.
+ALTERNATIVE_GROUPS = {
+  'colon': (('keyword', BLOCK), ('colon', OPERATOR)),
+  'signal_colon': (('signal_keyword', BLOCK), ('label', LABEL),
+                   ('signal_colon', OPERATOR)),
+  'value': (('property', PROPERTY), ('equals', OPERATOR), ('value', VALUE)),
+  'signal_value': (('time', TIME), ('arrow', OPERATOR),
+                   ('signal_value', SIGNAL)),
+}
+
+
+def tokenizeLine(text):
+  """Splits a line of DrawTime code into highlighted tokens.
+
+  Comment lines are a single token spanning the whole line, including any
+  leading whitespace. Lines that do not match any syntax have no tokens.
+
+  Args:
+    text: The contents of the line.
+
+  Returns:
+    A tuple of (start, length, kind) tuples, where kind is one of the token kind
+    constants of this module.
+  """
+  match = LINE_PATTERN.match(text)
+  if match is None:
+    return ()
+  elif match.lastgroup == 'comment':
+    return ((0, len(text), COMMENT),)
+
+  tokens = []
+  for group, kind in ALTERNATIVE_GROUPS[match.lastgroup]:
+    start, end = match.span(group)
+    tokens.append((start, end - start, kind))
+  return tuple(tokens)
@@ -0,0 +1,146 @@
+"""Per-stage timing, counting and memory instrumentation of renders.
+
+Instrumented functions accept an optional Stats object. When none is given,
+they use DISABLED, whose methods do nothing, so instrumentation costs little
+more than a method call per stage when it is off. Counters are incremented in
+bulk (e.g. once per batch of lines) rather than once per primitive.
+"""
+
+import collections
+import contextlib
+import time
+
+
+class Stats:
+  """Collects the wall time, call counts and memory peaks of render stages.
+
+  Stages may be nested, in which case the time of the inner stage is included
+  in that of the outer one as well.
+
+  Attributes:
+    times: An ordered dictionary mapping stage names to total seconds spent.
+    calls: A dictionary mapping stage and counter names to counts.
+    peaks: A dictionary mapping stage names to the largest amount of memory in
+      bytes allocated during the stage, on top of what was allocated when it
+      began. Only filled if memory tracing is enabled.
+  """
+
+  def __init__(self, trace_memory=False):
+    """Initializes empty statistics.
+
+    Args:
+      trace_memory: If True, memory peaks are traced with tracemalloc, which
+        slows down the traced code significantly. Tracing is started if it is
+        not already running, and stopped by stop(). tracemalloc is only
+        imported in that case.
+    """
+    self.times = collections.OrderedDict()
+    self.calls = collections.Counter()
+    self.peaks = {}
+    self.trace_memory = trace_memory
+    self._started_tracing = False
+    self._memory_stack = []
+    self._tracemalloc = None
+    if trace_memory:
+      import tracemalloc
+      self._tracemalloc = tracemalloc
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        self._started_tracing = True
+
+  def stop(self):
+    """Stops memory tracing, if it was started by this object."""
+    if self._started_tracing:
+      self._tracemalloc.stop()
+      self._started_tracing = False
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """Returns a context manager timing a stage and counting its calls.
+
+    Args:
+      name: The name of the stage.
+    """
+    if self.trace_memory:
+      self._enterMemoryFrame()
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start_time
+      self.times[name] = self.times.get(name, 0) + elapsed
+      self.calls[name] += 1
+      if self.trace_memory:
+        peak = self._exitMemoryFrame()
+        self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+  def count(self, name, number=1):
+    """Adds to a counter.
+
+    Args:
+      name: The name of the counter.
+      number: The amount to add.
+    """
+    self.calls[name] += number
+
+  def summarize(self):
+    """Returns a one-line, human-readable summary of the statistics."""
+    parts = []
+    for name, seconds in self.times.items():
+      part = '{} {:.1f}ms'.format(name, seconds * 1000)
+      if name in self.peaks:
+        part += ' ({:.1f}KiB)'.format(self.peaks[name] / 1024)
+      parts.append(part)
+    parts += ['{} {}'.format(name, number)
+              for name, number in sorted(self.calls.items())
+              if name not in self.times]
+    return ', '.join(parts)
+
+  def _enterMemoryFrame(self):
+    """Starts tracking the memory peak of a stage."""
+    current, peak = self._tracemalloc.get_traced_memory()
+    if self._memory_stack:
+      frame = self._memory_stack[-1]
+      frame[1] = max(frame[1], peak)
+    self._memory_stack.append([current, 0])
+    self._tracemalloc.reset_peak()
+
+  def _exitMemoryFrame(self):
+    """Stops tracking the memory peak of a stage and returns it.
+
+    Returns:
+      The peak traced memory during the stage, above that at its start.
+    """
+    peak = self._tracemalloc.get_traced_memory()[1]
+    start, inner_peak = self._memory_stack.pop()
+    peak = max(peak, inner_peak)
+    if self._memory_stack:
+      frame = self._memory_stack[-1]
+      frame[1] = max(frame[1], peak)
+    return max(peak - start, 0)
+
+
+class _DisabledStats:
+  """A stand-in for Stats that records nothing."""
+
+  def __bool__(self):
+    return False
+
+  def stop(self):
+    pass
+
+  def stage(self, name):
+    return _NULL_CONTEXT
+
+  def count(self, name, number=1):
+    pass
+
+  def summarize(self):
+    return ''
+
+
+# A reusable context manager that does nothing.
+_NULL_CONTEXT = contextlib.nullcontext()
+
+# The statistics used when instrumentation is disabled.
+DISABLED = _DisabledStats()
@@ -0,0 +1,672 @@
+"""Laying out timing diagrams as display lists of drawing primitives.
+
+The layout stage is independent of any drawing backend. It turns a diagram into
+display lists, which backends such as render.Renderer (onto Qt paint devices)
+and svg.SvgRenderer replay without repeating the layout.
+"""
+
+import array
+import collections
+import math
+import re
+import instrument
+import lod
+import model
+
+
+# The height of text rectangles, relative to font height.
+TEXT_HEIGHT = 1.2
+
+# A regular expression matching the overline markup in signal labels.
+MARKUP_REGEX = re.compile('(^|/)!')
+
+# The minimum width of a clock cycle in pixels. Clocks with narrower cycles are
+# drawn as a filled band rather than as individual edges.
+MIN_CLOCK_CYCLE_WIDTH = 1
+
+# The operations recorded in display lists. See DisplayList.
+OUTLINE_RECT = 'outline_rect'
+FILL_RECT = 'fill_rect'
+FILL_POLYGONS = 'fill_polygons'
+TEXT = 'text'
+LINES = 'lines'
+CLIP = 'clip'
+UNCLIP = 'unclip'
+
+
+class Rect:
+  """An immutable rectangle, with accessors named after those of QRectF."""
+
+  __slots__ = ('_left', '_top', '_width', '_height')
+
+  def __init__(self, left, top, width, height):
+    self._left = left
+    self._top = top
+    self._width = width
+    self._height = height
+
+  def __eq__(self, other):
+    return isinstance(other, Rect) and self.toTuple() == other.toTuple()
+
+  def __hash__(self):
+    return hash(self.toTuple())
+
+  def __repr__(self):
+    return 'Rect({}, {}, {}, {})'.format(*self.toTuple())
+
+  def left(self):
+    return self._left
+
+  def top(self):
+    return self._top
+
+  def width(self):
+    return self._width
+
+  def height(self):
+    return self._height
+
+  def right(self):
+    return self._left + self._width
+
+  def bottom(self):
+    return self._top + self._height
+
+  def centerY(self):
+    return self._top + self._height / 2
+
+  def toTuple(self):
+    """Returns the (left, top, width, height) of the rectangle."""
+    return self._left, self._top, self._width, self._height
+
+
+class DisplayList:
+  """An immutable sequence of drawing operations, to be replayed in order.
+
+  Each item is a tuple whose first element is one of the operation constants:
+    (OUTLINE_RECT, rect): Outline a Rect with a one pixel foreground line.
+    (FILL_RECT, rect): Fill a Rect with the foreground color.
+    (FILL_POLYGONS, fill, polygons): Fill a tuple of polygons, each a tuple of
+      (x, y) points, using the winding rule. The fill is one of 'unknown',
+      'value' or 'activity'.
+    (TEXT, text, rect): Draw a single line of text centered in a Rect.
+    (LINES, width, dashed, coordinates): Draw foreground lines of the given
+      width and style. The coordinates are an array with four numbers (x1, y1,
+      x2, y2) per line. Slanted lines are meant to be anti-aliased.
+    (CLIP, rect): Clip the following operations to a Rect.
+    (UNCLIP,): Remove the clipping set by the last CLIP operation.
+  Coordinates are in pixels of the diagram image.
+  """
+
+  __slots__ = ('items',)
+
+  def __init__(self, items):
+    self.items = tuple(items)
+
+  def __iter__(self):
+    return iter(self.items)
+
+  def __len__(self):
+    return len(self.items)
+
+
+class TextMetrics:
+  """Measures text for the layout. Backends with real fonts override this.
+
+  The base implementation estimates the size of text from the font size alone,
+  for backends that cannot measure fonts.
+  """
+
+  # The estimated width of a character and height of a line, relative to the
+  # font size in pixels.
+  CHARACTER_WIDTH = 0.6
+  LINE_HEIGHT = 1.15
+  # The number of pixels in a point, at the 96 DPI used by most viewers.
+  PIXELS_PER_POINT = 96 / 72
+
+  def __init__(self, font_family, font_size):
+    """Initializes the metrics of a font.
+
+    Args:
+      font_family: The family of the font.
+      font_size: The size of the font in points.
+    """
+    self.font_family = font_family
+    self.font_size = font_size
+
+  def height(self):
+    """Returns the height of the font in pixels."""
+    return math.ceil(self.font_size * self.PIXELS_PER_POINT * self.LINE_HEIGHT)
+
+  def width(self, text):
+    """Returns the width of a text string in pixels."""
+    return len(text) * self.font_size * self.PIXELS_PER_POINT * (
+        self.CHARACTER_WIDTH)
+
+  def layoutText(self, text, markup):
+    """Measures a text string and splits it into parts to be drawn.
+
+    Args:
+      text: The text to lay out.
+      markup: Whether to parse the text for overline markup. See
+        Layout._drawText() for the markup syntax.
+
+    Returns:
+      A triple containing the width and height of the text, and a tuple of the
+      parts to draw. Each part is a tuple containing its text, its horizontal
+      offset from the left of the whole text, its width, and whether it is to
+      have a line drawn over it.
+    """
+    if not markup:
+      width = self.width(text)
+      return width, self.height(), ((text, 0, width, False),)
+
+    parts = []
+    offset = 0
+    for part in text.partition('/'):
+      overline = part.startswith('!')
+      if overline: part = part[1:]
+
+      part_width = self.width(part)
+      parts.append((part, offset, part_width, overline))
+      offset += part_width
+
+    width = self.width(MARKUP_REGEX.sub(r'\1', text))
+    return width, self.height(), tuple(parts)
+
+
+class Layout:
+  """The layout of a single diagram, producing its display lists."""
+
+  def __init__(self, diagram, metrics, stats=instrument.DISABLED):
+    """Calculates the global layout of a diagram.
+
+    Args:
+      diagram: The model.TimingDiagram to lay out. It must have at least one
+        signal.
+      metrics: The TextMetrics of the diagram's font on the target backend.
+      stats: An instrument.Stats in which the time spent measuring text and
+        the numbers of primitives laid out are recorded.
+    """
+    self.diagram = diagram
+    self.metrics = metrics
+    self.stats = stats
+    self._lines = collections.defaultdict(lambda: array.array('d'))
+    self._items = []
+    self._window = (diagram.start, diagram.end)
+
+    margin = diagram.margin
+    self.outer_frame = Rect(
+        margin, margin, diagram.width - 2 * margin, diagram.height - 2 * margin)
+
+    label_widths = [self._getTextWidth(i.name + '  ') for i in diagram.signals]
+    assert len(label_widths) > 0, 'A diagram must have at least one signal.'
+    self.inner_frame = Rect(
+        margin + max(label_widths),
+        margin + self._getTextHeight() * TEXT_HEIGHT,
+        self.outer_frame.width() - max(label_widths),
+        self.outer_frame.height() - self._getTextHeight() * TEXT_HEIGHT)
+
+  def setWindow(self, start, end):
+    """Restricts the time range laid out by drawFrame() and drawSignal().
+
+    Only the columns, clock cycles and changes overlapping the window (and the
+    change in effect at its start) are laid out, at the coordinates they have in
+    the layout of the whole diagram, so a view of part of a diagram can be drawn
+    without visiting the rest of it. Parts laid out for adjacent windows line up
+    with each other, except where text centered outside a window extends into
+    it.
+
+    Args:
+      start: The start of the window, within the time range of the diagram.
+      end: The end of the window, within the time range of the diagram.
+    """
+    self._window = (start, end)
+
+  def getKey(self):
+    """Returns a hashable key of the global layout of the diagram.
+
+    The key covers every diagram property that affects how signals are drawn,
+    other than the signals themselves.
+    """
+    diagram = self.diagram
+    return (diagram.width, diagram.height, diagram.margin, diagram.font_size,
+            diagram.font_family, diagram.background, diagram.foreground,
+            diagram.start, diagram.end, diagram.step, diagram.delay,
+            len(diagram.signals), self.inner_frame.toTuple())
+
+  def getRowFrames(self):
+    """Returns a list of the Rects in which each signal is drawn, in order."""
+    frame = self.inner_frame
+    height = frame.height() / len(self.diagram.signals)
+    return [Rect(frame.left(), frame.top() + index * height,
+                 frame.width(), height)
+            for index in range(len(self.diagram.signals))]
+
+  def getRowExtent(self):
+    """Returns the height a row needs to fit both its signal and its label."""
+    return max(self.inner_frame.height() / len(self.diagram.signals),
+               self._getTextHeight() * TEXT_HEIGHT)
+
+  def drawFrame(self):
+    """Lays out the frame surrounding the diagram.
+
+    If the diagram defines a step length, also lays out and labels the columns
+    into which the diagram is divided.
+
+    Returns:
+      A DisplayList of the frame.
+    """
+    self._items.append((OUTLINE_RECT, self.outer_frame))
+    self._items.append((OUTLINE_RECT, self.inner_frame))
+
+    if self.diagram.step:
+      step = self.diagram.step
+      width = self.diagram.end - self.diagram.start
+      pixels_per_unit = self.inner_frame.width() / width
+      pixels_per_step = pixels_per_unit * step
+      last_index = math.ceil(self.diagram.end / step) - 1
+      window_start, window_end = self._window
+      first_index = 0
+      if window_start > self.diagram.start:
+        first_index = max(0, math.floor(window_start / step) - 1)
+      stop_index = min(last_index, math.ceil(window_end / step) + 1) + 1
+      for index in range(first_index, stop_index):
+        left = self._timeToPixels(index * step)
+        self._drawLine(left, self.inner_frame.top() + 1,
+                       left, self.inner_frame.bottom(),
+                       dashed=True)
+        if index != last_index:
+          center_x = left + pixels_per_step / 2
+          center_y = self.inner_frame.top() - self._getTextHeight() * 0.5
+          self._drawText('T{}'.format(index + 1), center_x, center_y)
+      self._flushLines()
+
+    return self._takeDisplayList()
+
+  def drawSignal(self, signal, frame):
+    """Lays out a signal and its label in the specified frame.
+
+    Args:
+      signal: The model.Clock, model.Line or model.Bus to lay out.
+      frame: The Rect where the signal is to be drawn, from getRowFrames().
+
+    Returns:
+      A DisplayList of the signal.
+    """
+    if isinstance(signal, model.Clock):
+      self._drawClockSignal(signal, frame)
+    elif isinstance(signal, model.Line):
+      self._drawLineSignal(signal, frame)
+    elif isinstance(signal, model.Bus):
+      self._drawBusSignal(signal, frame)
+    else:
+      raise TypeError('Invalid signal type: {}'.format(type(signal)))
+
+    self._drawText(signal.name,
+                   frame.left() - self._getTextWidth(signal.name + '  ') / 2,
+                   (frame.top() + frame.bottom()) / 2)
+    self._flushLines()
+    return self._takeDisplayList()
+
+  def _takeDisplayList(self):
+    """Returns a DisplayList of the recorded operations and clears them."""
+    display_list = DisplayList(self._items)
+    self._items = []
+    return display_list
+
+  def _drawClockSignal(self, clock, frame):
+    """Lays out a clock signal in the specified frame.
+
+    The edges of the clock are not expanded into changes. Instead, the cycles
+    overlapping the time window are computed from the clock's length, duty
+    cycle and offset, and the segments of a single cycle are repeated across
+    them. If a cycle is narrower than MIN_CLOCK_CYCLE_WIDTH, the clock is drawn
+    as a filled band to show that it toggles throughout.
+
+    Args:
+      clock: The model.Clock to lay out.
+      frame: The Rect where the signal is to be drawn.
+    """
+    diagram = self.diagram
+    pixels = self._timeDeltaToPixels
+
+    high = frame.top() + frame.height() * 0.3
+    low = frame.top() + frame.height() * 0.7
+    clip = Rect(frame.left() + 1, frame.top(),
+                frame.width() - 2, frame.height())
+
+    if pixels(clock.length) < MIN_CLOCK_CYCLE_WIDTH:
+      self._items.append(
+          (FILL_RECT, Rect(clip.left(), high, clip.width(), low - high)))
+      return
+
+    # Segments of one cycle, relative to its rising edge. The clock rises one
+    # "on" length before each offset and falls on it.
+    on_length = clock.duty * clock.length
+    half_delay = diagram.delay / 2
+    pattern = [
+      (pixels(-half_delay), low, pixels(half_delay), high),
+      (pixels(half_delay), high, pixels(on_length - half_delay), high),
+      (pixels(on_length - half_delay), high,
+       pixels(on_length + half_delay), low),
+      (pixels(on_length + half_delay), low,
+       pixels(clock.length - half_delay), low)
+    ]
+
+    first_rise = clock.offset - on_length
+    # The cycles whose segments may reach into the window. Transitions longer
+    # than a cycle reach beyond the cycles next to it.
+    margin = max(1, math.ceil(diagram.delay / clock.length))
+    window_start, window_end = self._window
+    first_cycle = (math.floor((window_start - first_rise) / clock.length) -
+                   margin)
+    last_cycle = math.ceil((window_end - first_rise) / clock.length) + margin
+
+    self._items.append((CLIP, clip))
+    self.stats.count('clock_cycles', last_cycle - first_cycle)
+    for cycle in range(first_cycle, last_cycle):
+      rise = first_rise + cycle * clock.length
+      x = self.inner_frame.left() + pixels(rise - diagram.start)
+      for x1, y1, x2, y2 in pattern:
+        self._drawLine(x + x1, y1, x + x2, y2, 2)
+    self._flushLines()
+    self._items.append((UNCLIP,))
+
+  def _drawBusSignal(self, bus, frame):
+    """Lays out a bus signal in the specified frame.
+
+    The segments of the bus are collected into one operation per fill style,
+    followed by their values. The lines outlining the segments are queued to be
+    recorded by _flushLines().
+
+    Args:
+      bus: The model.Bus to lay out.
+      frame: The Rect where the signal is to be drawn.
+    """
+    diagram = self.diagram
+
+    high = frame.top() + frame.height() * 0.3
+    middle = frame.top() + frame.height() * 0.5
+    low = frame.top() + frame.height() * 0.7
+    margin = self._timeDeltaToPixels(diagram.delay / 2)
+
+    start_time, start, changes = self._getVisibleChanges(bus, diagram.end)
+    polygons = collections.OrderedDict()
+    texts = []
+
+    if start_time is None:
+      last = (self._timeToPixels(diagram.start), start)
+    else:
+      last = (min(frame.right() - 1, self._timeToPixels(start_time)) + margin,
+              start)
+    for next_time, next_value in changes:
+      x, value = last
+      next_x = min(frame.right() - 1, self._timeToPixels(next_time)) + margin
+      if value is None:
+        self._drawLine(x + 1, middle, min(frame.right() - 1, next_x), middle, 2)
+      else:
+        points = [(x + margin, low),
+                  (x + margin, high)]
+        if x > frame.left():
+          points.insert(1, (x + 1, middle))
+        else:
+          points.insert(1, (x + 1, low))
+          points.insert(2, (x + 1, high))
+        if next_x - margin < frame.right() - 1:
+          points += [(next_x - margin, high),
+                     (next_x, middle),
+                     (next_x - margin, low)]
+        else:
+          points += [(next_x - margin - 1, high),
+                     (next_x - margin - 1, low)]
+
+        if value is model.UNKNOWN:
+          fill = 'unknown'
+        elif isinstance(value, str):
+          fill = 'value'
+        elif isinstance(value, lod.Activity):
+          fill = 'activity'
+        else:
+          raise TypeError('Invalid bus value: {}'.format(value))
+        polygons.setdefault(fill, []).append(tuple(points))
+
+        if isinstance(value, str):
+          center_x = (x + next_x + margin) / 2
+          top_margin = self._getTextHeight() * (TEXT_HEIGHT - 1) / 2
+          center_y = frame.centerY() - top_margin
+          texts.append((value, center_x, center_y))
+
+        if x > frame.left():
+          self._drawLine(x, middle, x + margin, high, 2)
+          self._drawLine(x, middle, x + margin, low, 2)
+        else:
+          self._drawLine(x + 1, high, x + margin, high, 2)
+          self._drawLine(x + 1, low, x + margin, low, 2)
+
+        self._drawLine(x + margin + 1, high, next_x - margin, high, 2)
+        self._drawLine(x + margin + 1, low, next_x - margin, low, 2)
+
+        if next_x - margin < frame.right() - 1:
+          self._drawLine(next_x - margin, high, next_x, middle, 2)
+          self._drawLine(next_x - margin, low, next_x, middle, 2)
+      last = (next_x, next_value)
+
+    for fill, fill_polygons in polygons.items():
+      self._items.append((FILL_POLYGONS, fill, tuple(fill_polygons)))
+      self.stats.count('polygons', len(fill_polygons))
+
+    for text, center_x, center_y in texts:
+      self._drawText(text, center_x, center_y, ignore_markup=True)
+
+  def _drawLineSignal(self, line, frame):
+    """Lays out a line signal in the specified frame.
+
+    Args:
+      line: The model.Line to lay out.
+      frame: The Rect where the signal is to be drawn.
+    """
+    diagram = self.diagram
+
+    levels = {
+      1: frame.top() + frame.height() * 0.3,
+      None: frame.top() + frame.height() * 0.5,
+      0: frame.top() + frame.height() * 0.7
+    }
+
+    def getRails(value):
+      if value == model.UNKNOWN:
+        return [levels[0], levels[1]]
+      else:
+        return [levels[value]]
+
+    start_time, start, changes = self._getVisibleChanges(
+        line, diagram.end + diagram.delay / 2)
+
+    if start_time is None:
+      last = (diagram.start - diagram.delay / 2, start)
+    else:
+      last = (start_time + diagram.delay / 2, start)
+    for time, value in changes:
+      last_time, last_value = last
+      last_x = self._timeToPixels(last_time)
+      time += diagram.delay / 2
+      x = self._timeToPixels(time)
+      x_minus_delay = self._timeToPixels(time - diagram.delay)
+      if isinstance(last_value, lod.Activity):
+        rails = [y for i in last_value.values for y in getRails(i)]
+        left = self._timeToPixels(last_time - diagram.delay)
+        self._items.append((FILL_RECT, Rect(
+            left, min(rails) - 1,
+            max(x - left, 1), max(rails) - min(rails) + 2)))
+      elif isinstance(value, lod.Activity):
+        for y in getRails(last_value):
+          self._drawLine(last_x + 1, y, x_minus_delay, y, 2)
+      elif last_value == model.UNKNOWN:
+        self._drawLine(last_x + 1, levels[0], x_minus_delay, levels[0], 2)
+        self._drawLine(last_x + 1, levels[1], x_minus_delay, levels[1], 2)
+        self._drawLine(x_minus_delay, levels[0], x, levels[value], 2)
+        self._drawLine(x_minus_delay, levels[1], x, levels[value], 2)
+      elif value == last_value:
+        self._drawLine(last_x + 1, levels[value], x, levels[value], 2)
+      else:
+        self._drawLine(last_x + 1, levels[last_value],
+                       x_minus_delay, levels[last_value],
+                       2)
+        self._drawLine(x_minus_delay, levels[last_value],
+                       x, levels[value],
+                       2)
+      last = (time, value)
+
+  def _getVisibleChanges(self, signal, end_time):
+    """Finds the changes of a line or bus signal that affect the time window.
+
+    The changes are located by binary search, so only those within the time
+    window [start - delay, end + delay] of the diagram are visited, along with
+    the change in effect at the start of the window and the first change after
+    its end. Those two are drawn clamped to the edges of the frame. If the
+    window was narrowed by setWindow(), the changes before the start of the
+    narrowed window are skipped instead, except for the one in effect there.
+
+    Runs of changes too dense to draw individually are replaced by changes to
+    lod.Activity values, so that the number of changes drawn is bounded by the
+    width of the diagram.
+
+    Args:
+      signal: The model.Line or model.Bus whose changes are to be found.
+      end_time: The time of a change appended to extend the last value to the
+        end of the diagram, used if the signal does not change after its end.
+
+    Returns:
+      A tuple containing the time from which the value of the signal before the
+      first returned change is drawn (or None to draw it from the start of the
+      diagram), that value, and a list of (time, value) pairs in chronological
+      order.
+    """
+    diagram = self.diagram
+    changes = signal.changes
+    window_start, window_end = self._window
+
+    first = max(changes.bisect(diagram.start - diagram.delay) - 1, 0)
+    last = min(changes.bisect(window_end + diagram.delay) + 1, len(changes))
+    start_time = None
+    if window_start > diagram.start:
+      window_first = changes.bisect(window_start - diagram.delay) - 1
+      if window_first > first:
+        first = window_first
+        start_time = changes.times[first - 1]
+    if first:
+      start = changes.table[changes.codes[first - 1]]
+    else:
+      start = signal.start
+
+    visible = list(lod.decimate(
+        changes.itemRange(first, last), diagram.start,
+        self._timeDeltaToPixels(1), start,
+        collect_values=isinstance(signal, model.Line)))
+    if not visible:
+      visible.append((end_time, start))
+    elif visible[-1][0] < diagram.end:
+      visible.append((end_time, visible[-1][1]))
+
+    return start_time, start, visible
+
+  def _drawLine(self, x1, y1, x2, y2, width=1, dashed=False):
+    """Queues a line between the two specified points.
+
+    Queued lines are recorded by _flushLines(), as one operation per style.
+
+    Args:
+      x1: The X coordinate of the first point.
+      y1: The Y coordinate of the first point.
+      x2: The X coordinate of the second point.
+      y2: The Y coordinate of the second point.
+      width: The width of the line.
+      dashed: If True, the line is drawn using a dashed style.
+    """
+    self._lines[width, dashed].extend((x1, y1, x2, y2))
+
+  def _flushLines(self):
+    """Records all the lines queued by _drawLine() and clears the queue."""
+    for (width, dashed), coordinates in self._lines.items():
+      self._items.append((LINES, width, dashed, coordinates))
+      self.stats.count('lines', len(coordinates) // 4)
+    self._lines.clear()
+
+  def _drawText(self, text, center_x, center_y, ignore_markup=False):
+    """Lays out the specified text at a specified point.
+
+    Args:
+      text: The text to draw. If ignore_markup is False, this text is parsed for
+        markup. If the text begins with an exclamation mark (!), a line will be
+        drawn above it. To draw the line only over part of the text, separate
+        the two parts by a forward slash (/) and prepend the one which is to
+        have a line drawn above it by an exclamation mark (!). Examples:
+          !ABCD -> will draw ABCD with a line over all of it.
+          AB!CD -> will draw AB!CD without any lines.
+          !AB/CD -> will draw AB/CD with a line over AB.
+          AB/!CD -> will draw AB/CD with a line over CD.
+          !AB/!CD -> will draw AB/CD with a line over both AB and CD
+          !AB/!CD/!EF -> will draw AB/CD/!EF with a line over AB and CD.
+      center_x: The X coordinate of the center of the text.
+      center_x: The Y coordinate of the center of the text.
+      ignore_markup: If True, the text is drawn as-is without any omissions or
+        extra lines.
+    """
+    with self.stats.stage('measure_text'):
+      width, height, parts = self.metrics.layoutText(
+          text, markup=not ignore_markup)
+    self.stats.count('texts', len(parts))
+    left = center_x - width / 2
+    top = center_y - height / 2
+
+    for part, offset, part_width, overline in parts:
+      rect = Rect(left + offset, top, part_width, height)
+      self._items.append((TEXT, part, rect))
+      if overline:
+        self._drawLine(rect.left(), rect.top(), rect.right(), rect.top())
+
+  def _timeToPixels(self, time):
+    """Converts a time instant to an X coordinate on the diagram image.
+
+    Args:
+      time: The time to convert.
+
+    Returns:
+      The absolute X coordinate on the diagram image corresponding to the
+      specified time.
+    """
+    offset = max(0, self._timeDeltaToPixels(time - self.diagram.start))
+    return min(self.inner_frame.right() - 1, self.inner_frame.left() + offset)
+
+  def _timeDeltaToPixels(self, time):
+    """Converts a time delta to a horizontal distance on the diagram image.
+
+    Args:
+      time: The time delta to convert.
+
+    Returns:
+      The horizontal distance represented by the specified time delta, in pixels
+      on the diagram image.
+    """
+    total_time = self.diagram.end - self.diagram.start
+    pixels_per_time_unit = self.inner_frame.width() / total_time
+    return time * pixels_per_time_unit
+
+  def _getTextWidth(self, text, strip_markup=True):
+    """Calculates the width of a given text string with the diagram's font.
+
+    Args:
+      text: The text to measure.
+      strip_markup: If true, removes markup from the specified text before
+        measuring.
+
+    Returns:
+      The width of the text, in pixels.
+    """
+    with self.stats.stage('measure_text'):
+      return self.metrics.layoutText(text, markup=strip_markup)[0]
+
+  def _getTextHeight(self):
+    """Returns the height of the diagram's font in pixels."""
+    return self.metrics.height()
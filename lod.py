@@ -0,0 +1,103 @@
+"""Level-of-detail reduction of signal changes too dense to draw one by one."""
+
+import itertools
+import math
+
+
+# The minimum number of changes falling within a single pixel column for that
+# column to be drawn as a block of activity rather than as individual changes.
+DENSE_COLUMN_CHANGES = 2
+
+
+class Activity:
+  """A signal value standing in for a run of changes too dense to draw.
+
+  The values attribute holds a frozenset of the values the signal takes within
+  the run, including the value it had before the run. If the values were not
+  collected, it is None.
+  """
+
+  __slots__ = ('values',)
+
+  def __init__(self, values):
+    self.values = values
+
+
+def decimate(changes, start, pixels_per_time_unit, initial,
+             collect_values=False):
+  """Replaces runs of densely packed changes with Activity values.
+
+  Changes are bucketed by the pixel column in which they fall. Adjacent columns
+  that each hold at least DENSE_COLUMN_CHANGES changes are merged into a run,
+  as long as they share the same set of values (when values are collected). A
+  run is replaced by two changes: one to an Activity value at the time of the
+  run's first change, and one to the value in effect after the run at the time
+  of its last change. Other changes are passed through unmodified.
+
+  Args:
+    changes: An iterable of (time, value) pairs in chronological order.
+    start: The time at the left edge of the first pixel column.
+    pixels_per_time_unit: The width of a single time unit in pixels.
+    initial: The value of the signal before the first change.
+    collect_values: If True, the Activity values record the set of values the
+      signal takes during their run.
+
+  Yields:
+    (time, value) pairs in chronological order.
+  """
+  def getColumn(change):
+    return math.floor((change[0] - start) * pixels_per_time_unit)
+
+  value = initial
+  run = None
+
+  for column, group in itertools.groupby(changes, getColumn):
+    head = list(itertools.islice(group, DENSE_COLUMN_CHANGES))
+    if len(head) < DENSE_COLUMN_CHANGES:
+      if run:
+        yield from _flushRun(*run)
+        run = None
+      yield from head
+      value = head[-1][1]
+      continue
+
+    values = None
+    if collect_values:
+      values = {value}
+      values.update(change_value for _, change_value in head)
+
+    last_time, value = head[-1]
+    for last_time, value in group:
+      if collect_values:
+        values.add(value)
+
+    if values is not None:
+      values = frozenset(values)
+    if run and run[1] == column - 1 and run[2] == values:
+      run[1] = column
+      run[3] = last_time
+      run[4] = value
+    else:
+      if run:
+        yield from _flushRun(*run)
+      run = [head[0][0], column, values, last_time, value]
+
+  if run:
+    yield from _flushRun(*run)
+
+
+def _flushRun(first_time, column, values, last_time, value):
+  """Yields the pair of changes that replace a run of dense columns.
+
+  Args:
+    first_time: The time of the first change in the run.
+    column: The last pixel column of the run.
+    values: The set of values taken during the run, or None.
+    last_time: The time of the last change in the run.
+    value: The value of the signal after the run.
+
+  Yields:
+    A change to an Activity value, followed by a change to the final value.
+  """
+  yield first_time, Activity(values)
+  yield last_time, value
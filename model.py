@@ -1,13 +1,20 @@
 """Structs to hold information about timing diagrams."""
 
-import collections
+import array
+import bisect
+import collections.abc
 import numbers
+import operator
 
 
 # An object to represent signals whose value is not known.
 UNKNOWN = object()
 
 
+# The values a line signal can change to, indexed by their codes in Changes.
+LINE_VALUES = (0, 1, None)
+
+
 class TimingDiagram:
   """The main timing diagram struct.
 
@@ -27,6 +34,10 @@ class TimingDiagram:
     delay: The length of time it takes each signal to complete a value change.
   """
 
+  __slots__ = ('width', 'height', 'margin', 'font_size', 'font_family',
+               'background', 'foreground', 'start', 'end', 'step', 'delay',
+               'signals')
+
   def __init__(self,
                width = 800,
                height = 600,
@@ -57,6 +68,178 @@ class TimingDiagram:
     self.signals = signals or []
 
 
+class Changes(collections.abc.Mapping):
+  """A compact, read-only mapping of signal change times to values.
+
+  Change times are kept in ascending order in a packed array of doubles, and
+  values are stored as small integer codes into a table of distinct values.
+  Iteration follows the order of change times.
+
+  Changes whose columns are views of a file may be given a source identifying
+  where they are stored. Such changes are keyed by their source (see getKey()),
+  so that keying them reads none of the file.
+  """
+
+  __slots__ = ('times', 'codes', 'table', 'source', '_hash')
+
+  def __init__(self, times, codes, table, source=None):
+    """Initializes the mapping from prebuilt columns.
+
+    Args:
+      times: A sorted sequence of unique change times, e.g. an array('d').
+      codes: A sequence of the same length as times, holding an index into
+        table for each change.
+      table: A sequence of the distinct values referenced by codes.
+      source: An optional hashable identifying the stored columns, which must
+        differ whenever their contents do, e.g. the path, size and modification
+        time of a file and the offsets of the columns within it.
+    """
+    self.times = times
+    self.codes = codes
+    self.table = table
+    self.source = source
+    self._hash = None
+
+  def __getitem__(self, time):
+    index = bisect.bisect_left(self.times, time)
+    if index == len(self.times) or self.times[index] != time:
+      raise KeyError(time)
+    return self.table[self.codes[index]]
+
+  def __iter__(self):
+    return iter(self.times)
+
+  def __len__(self):
+    return len(self.times)
+
+  def __contains__(self, time):
+    index = bisect.bisect_left(self.times, time)
+    return index != len(self.times) and self.times[index] == time
+
+  def __eq__(self, other):
+    if not isinstance(other, Changes):
+      return super().__eq__(other)
+    if self is other or (self.source is not None and
+                         self.source == other.source):
+      return True
+    if len(self.times) != len(other.times) or self.times != other.times:
+      return False
+    # The columns are compared directly, so that equal changes are told apart
+    # without decoding their values. The values are only compared when the
+    # changes were coded differently, e.g. when loaded from different formats.
+    if self.codes == other.codes and (
+        self.table is other.table or tuple(self.table) == tuple(other.table)):
+      return True
+    return all(map(operator.eq, self.values(), other.values()))
+
+  def __hash__(self):
+    # The mapping is read-only, so the hash is computed only once. Equal
+    # changes may be coded differently, so only their times are hashed, which
+    # needs no values to be decoded.
+    if self._hash is None:
+      self._hash = hash(bytes(self.times))
+    return self._hash
+
+  def __repr__(self):
+    return '{}({})'.format(type(self).__name__, dict(self.items()))
+
+  def items(self):
+    return _ChangeItems(self)
+
+  def values(self):
+    return _ChangeValues(self)
+
+  def bisect(self, time):
+    """Returns the number of changes that occur at or before a given time.
+
+    Args:
+      time: The time to look up.
+
+    Returns:
+      The index of the first change after time, found by binary search.
+    """
+    return bisect.bisect_right(self.times, time)
+
+  def itemRange(self, start=0, stop=None):
+    """Iterates over (time, value) pairs of the changes with indices in a range.
+
+    The columns are sliced rather than skipped through, so the cost depends
+    only on the number of changes in the range.
+
+    Args:
+      start: The index of the first change to include.
+      stop: The index after the last change to include. Defaults to the number
+        of changes.
+
+    Returns:
+      An iterator of (time, value) pairs in chronological order.
+    """
+    times, codes = self.times, self.codes
+    if start != 0 or stop is not None:
+      times, codes = times[start:stop], codes[start:stop]
+    return zip(times, map(self.table.__getitem__, codes))
+
+  def getKey(self):
+    """Returns a hashable key of the changes, for caching what is drawn of them.
+
+    Changes with a source are keyed by it, which takes constant time. Others
+    are their own key, which hashes and compares their columns.
+    """
+    return self if self.source is None else self.source
+
+
+class _ChangeItems(collections.abc.ItemsView):
+  """An items view of Changes that iterates the columns directly."""
+
+  def __iter__(self):
+    return self._mapping.itemRange()
+
+
+class _ChangeValues(collections.abc.ValuesView):
+  """A values view of Changes that iterates the columns directly."""
+
+  def __iter__(self):
+    changes = self._mapping
+    return map(changes.table.__getitem__, changes.codes)
+
+
+def _buildChanges(changes, table, codes_type, validate):
+  """Packs a dictionary of changes into a Changes mapping.
+
+  Args:
+    changes: A dictionary mapping change times to values.
+    table: A list of distinct values, pre-populated with the values that must
+      have fixed codes. Extended in place with any newly encountered values.
+    codes_type: The array typecode used to store value codes.
+    validate: A function called with each (time, value) pair before storing.
+
+  Returns:
+    A Changes object holding the supplied changes.
+  """
+  times = array.array('d')
+  codes = array.array(codes_type)
+  value_codes = {value: code for code, value in enumerate(table)}
+  last_time = None
+
+  for time, value in sorted(changes.items(), key=lambda change: change[0]):
+    if not isinstance(time, numbers.Number):
+      raise TypeError('A line change time must be a number. '
+                      'Got {}'.format(repr(time)))
+    validate(time, value)
+    if time == last_time:
+      raise ValueError('Duplicate line change time: {}'.format(time))
+
+    code = value_codes.get(value)
+    if code is None:
+      code = value_codes[value] = len(table)
+      table.append(value)
+    times.append(time)
+    codes.append(code)
+    last_time = time
+
+  return Changes(times, codes, table)
+
+
 class Line:
   """A named line signal that has a start value and a series of changes.
 
@@ -64,9 +247,13 @@ class Line:
 
   The changes are provided as a dictionary mapping time instants to values which
   the signal takes at those times. Values to which a line can change are 0, 1
-  and None (floating).
+  and None (floating). They are stored as a read-only Changes mapping, with
+  values coded as indices into LINE_VALUES. A prebuilt Changes object may also
+  be supplied, in which case it is used as-is.
   """
 
+  __slots__ = ('name', 'start', 'changes')
+
   def __init__(self, name, start, changes):
     self.name = name
 
@@ -75,18 +262,18 @@ class Line:
                       'Got {}.'.format(repr(start)))
     self.start = start
 
-    self.changes = collections.OrderedDict()
-    for time, value in sorted(changes.items()):
-      if not isinstance(time, numbers.Number):
-        raise TypeError('A line change time must be a number. '
-                        'Got {}'.format(repr(time)))
-      elif value not in {0, 1, None}:
-        raise TypeError('A line change value must be be one of: {0, 1, None}. '
-                        'Got {}.'.format(repr(value)))
-      elif time in self.changes:
-        raise ValueError('Duplicate line change time: {}'.format(time))
+    if isinstance(changes, Changes):
+      self.changes = changes
+    else:
+      self.changes = _buildChanges(
+          changes, list(LINE_VALUES), 'B', self._validateChange)
 
-      self.changes[time] = value
+  @staticmethod
+  def _validateChange(time, value):
+    """Verifies that a line change value is valid."""
+    if value not in {0, 1, None}:
+      raise TypeError('A line change value must be be one of: {0, 1, None}. '
+                      'Got {}.'.format(repr(value)))
 
 
 class Bus:
@@ -96,21 +283,20 @@ class Bus:
 
   The changes are provided as a dictionary mapping time instants to values which
   the signal takes at those times. Values to which a buscan change are UNKNOWN,
-  None (floating) and arbitrary strings.
+  None (floating) and arbitrary strings. They are stored as a read-only Changes
+  mapping, with each distinct value stored only once. A prebuilt Changes object
+  may also be supplied, in which case it is used as-is.
   """
 
+  __slots__ = ('name', 'start', 'changes')
+
   def __init__(self, name, start, changes):
     self.name = name
     self.start = start
-    self.changes = collections.OrderedDict()
-    for time, value in sorted(changes.items()):
-      if not isinstance(time, numbers.Number):
-        raise TypeError('A line change time must be a number. '
-                        'Got {}'.format(repr(time)))
-      elif time in self.changes:
-        raise ValueError('Duplicate line change time: {}'.format(time))
-
-      self.changes[time] = value
+    if isinstance(changes, Changes):
+      self.changes = changes
+    else:
+      self.changes = _buildChanges(changes, [], 'I', lambda time, value: None)
 
 
 class Clock:
@@ -120,6 +306,8 @@ class Clock:
   in the 1 position per cycle), and an offset from which the signal starts.
   """
 
+  __slots__ = ('name', 'offset', 'length', 'duty')
+
   def __init__(self, name, offset, length, duty):
     self.name = name
     self.offset = offset
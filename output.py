@@ -0,0 +1,58 @@
+"""Writing diagrams to files, in the format named by the output path.
+
+Compiled diagrams (.dtc) and SVG documents are written without Qt, so only
+paths naming raster images need a QApplication (see render.checkDisplay()).
+render is imported only when an image is drawn, so writing the other formats
+never imports Qt, and cache only when a render cache is given.
+"""
+
+import compiled
+import instrument
+import svg
+
+
+def needsQt(path):
+  """Returns whether writing to a path draws an image with Qt.
+
+  Args:
+    path: An output path, or a pattern of output paths ending in an extension.
+  """
+  return not (compiled.isCompiledPath(path) or svg.isSvgPath(path))
+
+
+def writeDiagram(diagram, outfile_name, render_cache=None, renderer=None,
+                 stats=instrument.DISABLED):
+  """Writes a diagram to a file, copying it from a cache if possible.
+
+  Compiled diagrams are always written, and never cached. Any other format is
+  rendered: SVG by svg.writeSvg(), and any format supported by QImageWriter by
+  a render.Renderer, which requires a QApplication.
+
+  Args:
+    diagram: The model.TimingDiagram to write.
+    outfile_name: The path of the output file. Its extension determines the
+      format. If the file exists, it is silently overwritten.
+    render_cache: An optional cache.RenderCache, from which the diagram is
+      copied if it was rendered before.
+    renderer: The render.Renderer drawing images, reused across calls by
+      callers that write many. Defaults to a new one.
+    stats: An instrument.Stats in which the time spent is recorded.
+
+  Returns:
+    True if the file was copied from the cache, False if it was written.
+  """
+  if compiled.isCompiledPath(outfile_name):
+    compiled.compileDiagram(diagram, outfile_name, stats)
+    return False
+  elif svg.isSvgPath(outfile_name):
+    write = lambda *args: svg.writeSvg(*args, stats=stats)
+  else:
+    if renderer is None:
+      import render
+      renderer = render.Renderer()
+    write = lambda *args: renderer.drawToFile(*args, stats=stats)
+  if render_cache is None:
+    write(diagram, outfile_name)
+    return False
+  import cache
+  return cache.renderCached(render_cache, diagram, outfile_name, write)
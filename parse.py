@@ -1,8 +1,11 @@
 """A parser for DrawTime timing diagram descriptions."""
 
 import ast
+import compiled
+import instrument
 import model
 import re
+import vcd
 
 
 # Error messages for various syntax errors.
@@ -81,27 +84,335 @@ class TimingSyntaxError(ValueError):
     super().__init__(formatted)
 
 
-def parseTimingDescription(code):
+def parseTimingDescription(code, stats=instrument.DISABLED):
   """Parses diagram description code and constructs a diagram object.
 
   Args:
     code: A string containing the raw diagram description code.
+    stats: An instrument.Stats in which the time spent is recorded.
 
   Returns:
     A model.TimingDiagram represented by the supplied code.
   """
-  lines = [i.strip() for i in code.splitlines()]
-  numbered_lines = [(number + 1, line)
-                    for number, line in enumerate(lines)
-                    if line and not line.startswith('#')]
-  return _parseBlocks(*_exractBlocks(numbered_lines))
+  with stats.stage('parse'):
+    return _parseBlocks(*_exractBlocks(_numberLines(code.splitlines())))
+
+
+def parseTimingFile(path, stats=instrument.DISABLED):
+  """Parses a diagram description file and constructs a diagram object.
+
+  Unlike parseTimingDescription(), the file is read lazily line by line and
+  each signal is built as soon as its block ends, so only one block is held in
+  memory at a time. The file is read twice: the first pass checks the block
+  structure and collects the (small) time and style blocks, and the second
+  builds the signals. This way the same errors are reported, in the same order,
+  as by parseTimingDescription().
+
+  Args:
+    path: The path of the diagram description file to parse.
+    stats: An instrument.Stats in which the time spent is recorded.
+
+  Returns:
+    A model.TimingDiagram represented by the code in the file.
+  """
+  with stats.stage('parse'):
+    time_lines = []
+    style_lines = []
+    with open(path, encoding='utf8') as infile:
+      for _ in _iterBlocks(_numberLines(infile), time_lines, style_lines):
+        pass
+
+    diagram = _parseBlocks(time_lines, style_lines, [])
+    with open(path, encoding='utf8') as infile:
+      for signal_type, signal_name, signal_lines in _iterBlocks(
+          _numberLines(infile), [], []):
+        diagram.signals.append(
+            _parseSignalBlock(signal_type, signal_name, signal_lines))
+
+  return diagram
+
+
+def loadTimingFile(path, stats=instrument.DISABLED):
+  """Reads a diagram from a file, in the format given by its extension.
+
+  Compiled (.dtc) files are loaded with compiled.loadDiagram(), VCD (.vcd) files
+  are imported whole with vcd.importVcd(), and any other file is parsed as a
+  diagram description.
+
+  Args:
+    path: The path of the file to read.
+    stats: An instrument.Stats in which the time spent is recorded.
+
+  Returns:
+    The model.TimingDiagram held in the file.
+  """
+  if compiled.isCompiledPath(path):
+    return compiled.loadDiagram(path, stats)
+  elif vcd.isVcdPath(path):
+    return vcd.importVcd(path, stats=stats)
+  return parseTimingFile(path, stats)
+
+
+class IncrementalParser:
+  """A parser that reuses the results of unchanged blocks between calls.
+
+  Intended for repeatedly parsing successive versions of the same description,
+  e.g. during live preview. Each block is fingerprinted by its type, name and
+  the text of its lines. If a block's fingerprint matches one seen in the last
+  successful parse, the block is not parsed again and the model objects built
+  for it are reused.
+
+  The lines of the description are held split into segments, each starting at
+  a block header, which keep their lines stripped and fingerprinted. A
+  description can be parsed whole with parse(), or edited a few lines at a time
+  with replaceLines() and then parsed with parseLines(), in which case only the
+  segments around the replaced lines are split again. Blocks are only cached
+  once they parse without errors, so the errors raised (and their line numbers)
+  are the same as those of parseTimingDescription().
+  """
+
+  def __init__(self):
+    self._cache = {}
+    self._segments = [_Segment([])]
+
+  def parse(self, code, stats=instrument.DISABLED):
+    """Parses diagram description code and constructs a diagram object.
+
+    Args:
+      code: A string containing the raw diagram description code.
+      stats: An instrument.Stats in which the time spent and the number of
+        reused blocks are recorded.
+
+    Returns:
+      A model.TimingDiagram represented by the supplied code.
+    """
+    self.setLines(code.splitlines())
+    return self.parseLines(stats)
+
+  def setLines(self, lines):
+    """Replaces the whole description held by the parser.
+
+    Args:
+      lines: A list of the raw lines of the description.
+    """
+    self._segments = _splitSegments(lines, True)
+
+  def replaceLines(self, first, count, lines):
+    """Replaces a range of lines of the description held by the parser.
+
+    Args:
+      first: The index of the first line replaced, counting from 0.
+      count: The number of lines replaced, which may be 0 to insert lines.
+      lines: A list of the raw lines replacing them.
+    """
+    segments = self._segments
+    index = 0
+    base = 0
+    while (index + 1 < len(segments) and
+           base + len(segments[index].lines) <= first):
+      base += len(segments[index].lines)
+      index += 1
+    # Removing a header merges its lines into the segment before it.
+    if index > 0:
+      index -= 1
+      base -= len(segments[index].lines)
+
+    stop = index
+    end = base
+    while stop < len(segments) and (end <= first or end < first + count):
+      end += len(segments[stop].lines)
+      stop += 1
+
+    region = [line for i in segments[index:stop] for line in i.lines]
+    region[first - base:first - base + count] = lines
+    segments[index:stop] = _splitSegments(region, index == 0)
+
+  def parseLines(self, stats=instrument.DISABLED):
+    """Parses the description held by the parser.
+
+    Args:
+      stats: An instrument.Stats in which the time spent and the number of
+        reused blocks are recorded.
+
+    Returns:
+      A model.TimingDiagram represented by the description.
+    """
+    with stats.stage('parse'):
+      time_parts, style_parts, signal_blocks = self._extractBlocks()
+      cache = {}
+      try:
+        diagram = model.TimingDiagram()
+        for property, value in self._lookup(
+            cache, ('style',), style_parts, _parseStyleLines, stats).items():
+          setattr(diagram, property, value)
+        for property, value in self._lookup(
+            cache, ('time',), time_parts, _parseTimeLines, stats).items():
+          setattr(diagram, property, value)
+        for (signal_type, signal_name), signal_parts in signal_blocks:
+          diagram.signals.append(self._lookup(
+              cache, (signal_type, signal_name), signal_parts,
+              lambda lines: _parseSignalBlock(signal_type, signal_name, lines),
+              stats))
+      except TimingSyntaxError:
+        # Keep the blocks parsed so far, so that only the erroneous block needs
+        # to be parsed again once it is fixed.
+        self._cache.update(cache)
+        raise
+      self._cache = cache
+    return diagram
+
+  def _extractBlocks(self):
+    """Groups the segments into blocks, checking them as _iterBlocks() does.
+
+    Returns:
+      A triple containing the parts of the time block, the parts of the style
+      block, and a list of signal blocks, each a tuple of the signal type and
+      name, and the parts of the block. Parts are tuples of the number of the
+      line preceding a segment and the segment.
+
+    Raises:
+      TimingSyntaxError: If the blocks are malformed.
+    """
+    time_parts = []
+    style_parts = []
+    signal_blocks = []
+    current_parts = None
+    base = 0
+
+    for segment in self._segments:
+      if segment.header is None:
+        if segment.content:
+          index, line = segment.content[0]
+          raise TimingSyntaxError('orphan_line', (base + index + 1, line))
+        base += len(segment.lines)
+        continue
+
+      index, line = segment.header
+      numbered_line = (base + index + 1, line)
+      if current_parts is not None and not any(
+          part.content for _, part in current_parts):
+        raise TimingSyntaxError('empty_block', numbered_line)
+      if len(line) == 1:
+        raise TimingSyntaxError('orphan_colon', numbered_line)
+      block_type, *block_args = line[:-1].split(None, 1)
+
+      if block_type == 'time':
+        if block_args:
+          raise TimingSyntaxError('time_args', numbered_line)
+        current_parts = time_parts
+      elif block_type == 'style':
+        if block_args:
+          raise TimingSyntaxError('style_args', numbered_line)
+        current_parts = style_parts
+      elif block_type in ('clock', 'line', 'bus'):
+        if not block_args:
+          raise TimingSyntaxError('signal_args', numbered_line)
+        current_parts = []
+        signal_blocks.append(((block_type, block_args[0]), current_parts))
+      else:
+        raise TimingSyntaxError('unknown_block', numbered_line)
+
+      current_parts.append((base, segment))
+      base += len(segment.lines)
+
+    if current_parts is not None and not any(
+        part.content for _, part in current_parts):
+      raise TimingSyntaxError('empty_block', numbered_line)
+    return time_parts, style_parts, signal_blocks
+
+  def _lookup(self, cache, header, parts, parser, stats):
+    """Returns the parsed result of a block, parsing it only if not cached.
+
+    Args:
+      cache: The dictionary collecting the blocks used by the current parse.
+      header: A tuple identifying the type (and name) of the block.
+      parts: A list of tuples of the number of the line preceding a segment and
+        the segment, holding the lines of the block.
+      parser: A function that takes a list of the numbered lines of the block
+        and parses them.
+      stats: An instrument.Stats counting the reused blocks.
+
+    Returns:
+      The result of parser(numbered_lines), possibly from an earlier call.
+    """
+    fingerprint = header
+    for _, segment in parts:
+      fingerprint += segment.fingerprint
+    if fingerprint in self._cache:
+      result = self._cache[fingerprint]
+      stats.count('reused_blocks')
+    else:
+      result = parser([(base + index + 1, line) for base, segment in parts
+                       for index, line in segment.content])
+    cache[fingerprint] = result
+    return result
+
+
+class _Segment:
+  """A run of lines of a description, starting at a block header.
+
+  Only the first segment of a description has no header. It holds any lines
+  preceding the first header.
+  """
+
+  __slots__ = ('lines', 'header', 'content', 'fingerprint')
+
+  def __init__(self, lines):
+    """Strips and indexes lines, skipping blanks and comments.
+
+    Args:
+      lines: A list of raw lines. Only the first may be a block header.
+    """
+    self.lines = lines
+    self.content = [(index, line) for index, line in _numberLines(lines, 0)]
+    if self.content and self.content[0][1].endswith(':'):
+      self.header = self.content.pop(0)
+    else:
+      self.header = None
+    self.fingerprint = tuple(line for _, line in self.content)
+
+
+def _splitSegments(lines, leading):
+  """Splits lines into segments, starting a segment at each block header.
+
+  Args:
+    lines: A list of raw lines of diagram description code.
+    leading: Whether the lines start the description, in which case the lines
+      before the first header form a segment of their own (even if there are
+      none). Otherwise the first line must be a header.
+
+  Returns:
+    A list of _Segment objects holding the lines.
+  """
+  starts = [index for index, line in _numberLines(lines, 0)
+            if line.endswith(':')]
+  if leading or not starts or starts[0] != 0:
+    starts.insert(0, 0)
+  starts.append(len(lines))
+  return [_Segment(lines[start:end]) for start, end in zip(starts, starts[1:])]
+
+
+def _numberLines(lines, start=1):
+  """Strips and numbers lines, skipping blanks and comments.
+
+  Args:
+    lines: An iterable of raw lines of diagram description code.
+    start: The number of the first line.
+
+  Yields:
+    Tuples, each containing a line number and its stripped text.
+  """
+  for number, line in enumerate(lines, start):
+    line = line.strip()
+    if line and not line.startswith('#'):
+      yield number, line
 
 
 def _exractBlocks(numbered_lines):
   """Groups code lines into time, style and signal blocks.
 
   Args:
-    numbered_lines: A list of tuples, each containing a line number and its
+    numbered_lines: An iterable of tuples, each containing a line number and its
       text. Line numbers are used solely for error reporting.
 
   Returns:
@@ -115,7 +426,29 @@ def _exractBlocks(numbered_lines):
   """
   time_lines = []
   style_lines = []
-  signal_blocks = []
+  signal_blocks = list(_iterBlocks(numbered_lines, time_lines, style_lines))
+  return time_lines, style_lines, signal_blocks
+
+
+def _iterBlocks(numbered_lines, time_lines, style_lines):
+  """Groups code lines into blocks, yielding signal blocks as they end.
+
+  Only the lines of the signal block currently being read are held, so the
+  input can be consumed lazily.
+
+  Args:
+    numbered_lines: An iterable of tuples, each containing a line number and its
+      text. Line numbers are used solely for error reporting.
+    time_lines: A list to which the numbered lines contained in the time code
+      block are appended.
+    style_lines: A list to which the numbered lines contained in the style code
+      block are appended.
+
+  Yields:
+    A tuple for each signal block, containing the signal type, its name, and a
+    list of numbered lines from the input.
+  """
+  signal_block = None
   current_block = None
 
   for numbered_line in numbered_lines:
@@ -139,9 +472,14 @@ def _exractBlocks(numbered_lines):
         if not block_args:
           raise TimingSyntaxError('signal_args', numbered_line)
         current_block = []
-        signal_blocks.append((block_type, block_args[0], current_block))
       else:
         raise TimingSyntaxError('unknown_block', numbered_line)
+
+      if signal_block:
+        yield signal_block
+        signal_block = None
+      if block_type in SIGNAL_TYPES:
+        signal_block = (block_type, block_args[0], current_block)
     else:
       if current_block is None:
         raise TimingSyntaxError('orphan_line', numbered_line)
@@ -150,7 +488,8 @@ def _exractBlocks(numbered_lines):
   if current_block == []:
     raise TimingSyntaxError('empty_block', numbered_line)
 
-  return time_lines, style_lines, signal_blocks
+  if signal_block:
+    yield signal_block
 
 
 def _parseBlocks(time_lines, style_lines, signal_blocks):
@@ -167,6 +506,30 @@ def _parseBlocks(time_lines, style_lines, signal_blocks):
   """
   diagram = model.TimingDiagram()
 
+  for property, value in _parseStyleLines(style_lines).items():
+    setattr(diagram, property, value)
+
+  for property, value in _parseTimeLines(time_lines).items():
+    setattr(diagram, property, value)
+
+  for signal_type, signal_name, signal_lines in signal_blocks:
+    diagram.signals.append(
+        _parseSignalBlock(signal_type, signal_name, signal_lines))
+
+  return diagram
+
+
+def _parseStyleLines(style_lines):
+  """Parses the lines of the style block.
+
+  Args:
+    style_lines: A list of numbered lines contained in the style block.
+
+  Returns:
+    A dictionary mapping model.TimingDiagram style properties to their values.
+  """
+  properties = {}
+
   for number, line in style_lines:
     property, _, value = _splitLine(number, line)
     if property not in STYLE_PROPERTIES:
@@ -180,52 +543,77 @@ def _parseBlocks(time_lines, style_lines, signal_blocks):
         raise TimingSyntaxError('bad_color', (number, line))
       value = int(value, 16)
 
-    setattr(diagram, property, value)
+    properties[property] = value
+
+  return properties
+
+
+def _parseTimeLines(time_lines):
+  """Parses the lines of the time block.
+
+  Args:
+    time_lines: A list of numbered lines contained in the time block.
+
+  Returns:
+    A dictionary mapping model.TimingDiagram time properties to their values.
+  """
+  properties = {}
 
   for number, line in time_lines:
     property, _, value = _splitLine(number, line)
     if property not in TIME_PROPERTIES:
       raise TimingSyntaxError('time_prop', (number, line))
-    setattr(diagram, property, _parseInt(value, number, line))
+    properties[property] = _parseInt(value, number, line)
 
-  for signal_type, signal_name, signal_lines in signal_blocks:
-    properties = {}
-    changes = {}
+  return properties
 
-    for number, line in signal_lines:
-      target, operation, value = _splitLine(number, line, True)
-      if operation == '->':
-        if signal_type == 'clock':
-          raise TimingSyntaxError('clock_change', (number, line))
 
-        time = _parseFloat(target, number, line)
-        if time in changes:
-          raise TimingSyntaxError('change_dupe', (number, line))
+def _parseSignalBlock(signal_type, signal_name, signal_lines):
+  """Parses the lines of a signal block and constructs a signal object.
 
-        value = _parseSignalValue(value, signal_type, number, line)
-        if signal_type == 'line' and value == model.UNKNOWN:
-          raise TimingSyntaxError('line_unknown', (number, line))
+  Args:
+    signal_type: The type of the signal: clock, line or bus.
+    signal_name: The name of the signal.
+    signal_lines: A list of numbered lines contained in the signal block.
 
-        changes[time] = value
-      else:
-        if target not in SIGNAL_PROPERTIES[signal_type]:
-          raise TimingSyntaxError('signal_prop', (number, line))
+  Returns:
+    A model.Clock, model.Line or model.Bus represented by the supplied block.
+  """
+  properties = {}
+  changes = {}
 
-        if target == 'start':
-          properties[target] = _parseSignalValue(
-              value, signal_type, number, line)
-        else:
-          properties[target] = _parseFloat(value, number, line)
+  for number, line in signal_lines:
+    target, operation, value = _splitLine(number, line, True)
+    if operation == '->':
+      if signal_type == 'clock':
+        raise TimingSyntaxError('clock_change', (number, line))
 
-    if not properties.keys() == SIGNAL_PROPERTIES[signal_type]:
-      raise TimingSyntaxError('missing_prop', signal_lines[-1])
+      time = _parseFloat(target, number, line)
+      if time in changes:
+        raise TimingSyntaxError('change_dupe', (number, line))
 
-    if signal_type != 'clock':
-      properties['changes'] = changes
+      value = _parseSignalValue(value, signal_type, number, line)
+      if signal_type == 'line' and value == model.UNKNOWN:
+        raise TimingSyntaxError('line_unknown', (number, line))
 
-    diagram.signals.append(SIGNAL_TYPES[signal_type](signal_name, **properties))
+      changes[time] = value
+    else:
+      if target not in SIGNAL_PROPERTIES[signal_type]:
+        raise TimingSyntaxError('signal_prop', (number, line))
 
-  return diagram
+      if target == 'start':
+        properties[target] = _parseSignalValue(
+            value, signal_type, number, line)
+      else:
+        properties[target] = _parseFloat(value, number, line)
+
+  if not properties.keys() == SIGNAL_PROPERTIES[signal_type]:
+    raise TimingSyntaxError('missing_prop', signal_lines[-1])
+
+  if signal_type != 'clock':
+    properties['changes'] = changes
+
+  return SIGNAL_TYPES[signal_type](signal_name, **properties)
 
 
 def _splitLine(line_number, line, allow_change=False):
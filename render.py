@@ -1,25 +1,67 @@
 """A Qt renderer for timing diagrams."""
 
-import re
+import collections
+import copy
+import functools
+import math
+import os
+import sys
+import threading
 from PyQt4 import QtGui,  QtCore
+import instrument
+import layout
 import model
 
 
-# The height of text rectangles, relative to font height.
-TEXT_HEIGHT = 1.2
-
 # The color of the background of bus segments representing unknown values.
 UNKNOWN_BACKGROUND = QtCore.Qt.gray
 
+# The maximum number of text layouts kept by _layoutText() per thread. The cache
+# is shared by all renderers of a thread and persists across calls to
+# Renderer.draw().
+TEXT_CACHE_SIZE = 4096
+
+# The maximum number of font metrics kept by _getFontMetrics() per thread.
+FONT_CACHE_SIZE = 16
+
+# The number of pixels by which signal strips extend beyond their rows, to fit
+# line widths and anti-aliasing.
+STRIP_PADDING = 2
+
+# The width and height of the tiles drawn by a TileRenderer, in pixels.
+TILE_SIZE = 256
+
+# The maximum number of tiles kept by a TileRenderer, across zoom levels.
+TILE_CACHE_SIZE = 256
+
+# The number of pixels by which the time window laid out for a tile extends
+# beyond it on each side, so that text centered just outside the tile is drawn
+# across its edges.
+TILE_MARGIN = 64
+
+# The environment variable naming the X11 display, which Qt 4 connects to even
+# when rendering without windows.
+DISPLAY_VARIABLE = 'DISPLAY'
+
+# The caches of _getFontMetrics() and _layoutText() for each thread, created by
+# _getThreadCache().
+_thread_caches = threading.local()
+
 
 class Renderer:
   """A Qt-based renderer for timing diagrams."""
 
   def __init__(self):
     self.image = None
+    self.dirty_rects = []
+    self.display_lists = []
     self.painter = QtGui.QPainter()
+    self._layout_key = None
+    self._rows = []
+    self._strips = {}
+    self._stats = instrument.DISABLED
 
-  def save(self, filepath):
+  def save(self, filepath, stats=instrument.DISABLED):
     """Saves the last drawn diagram to an image file.
 
     This can be called only after a successful call to Renderer.draw().
@@ -28,397 +70,603 @@ class Renderer:
       filepath: The path to which the image is to be saved. The format of the
         image is guessed from the extension. If the file already exists, it is
         silently overwritten.
+      stats: An instrument.Stats in which the time spent encoding the image is
+        recorded.
     """
     if self.image:
-      result = self.image.save(filepath)
+      with stats.stage('encode'):
+        result = self.image.save(filepath)
       if not result:
         raise IOError('Failed to save image.')
     else:
       raise RuntimeError('No diagram loaded.')
 
-  def draw(self, diagram):
+  def drawToFile(self, diagram, filepath, stats=instrument.DISABLED):
+    """Draws a diagram and saves it to an image file.
+
+    Args:
+      diagram: The diagram to draw.
+      filepath: The path to which the image is to be saved. See save().
+      stats: An instrument.Stats in which the time spent is recorded.
+    """
+    self.draw(diagram, stats)
+    self.save(filepath, stats)
+
+  def draw(self, diagram, stats=instrument.DISABLED):
     """Draws the specified diagram, saving the result to self.image.
 
+    The diagram is first laid out into display lists, which are kept in
+    self.display_lists as (vertical offset, layout.DisplayList) pairs so that
+    they can be replayed onto other devices with a Replayer. Each signal's
+    display list is rasterized into its own strip, and both are cached by the
+    signal's contents and the global layout of the diagram. If the layout did
+    not change since the last call, only the rows whose strips changed are
+    recomposed onto the existing image. The areas of the image that were
+    updated are stored in self.dirty_rects.
+
     Args:
       diagram: The diagram to draw.
+      stats: An instrument.Stats in which the time spent in each stage is
+        recorded: loading, laying out, rasterizing and composing.
     """
     if not diagram:
       raise ValueError('No diagram provided.')
 
-    self._loadDiagram(diagram)
+    self._stats = stats
+    with stats.stage('load'):
+      self._loadDiagram(diagram)
+    layout_key = self._layout.getKey()
+    with stats.stage('layout'):
+      frame_list = self._layout.drawFrame()
+    rows = self._drawSignals(layout_key)
+    self.display_lists = [(0, frame_list)]
+    self.display_lists += [(top, display_list)
+                           for _, display_list, _, top in rows]
+
+    if layout_key != self._layout_key:
+      self.dirty_rects = [self.image.rect()]
+    else:
+      self.dirty_rects = [
+          QtCore.QRect(0, top, strip.width(), strip.height())
+          for (key, _, strip, top), (old_key, _, _, _) in zip(rows, self._rows)
+          if key != old_key]
+    self._layout_key = layout_key
+    self._rows = rows
+
+    if not self.dirty_rects:
+      return
+
+    with stats.stage('compose'):
+      self._compose(frame_list, rows)
+
+  def _compose(self, frame_list, rows):
+    """Repaints the dirty areas of the image from the frame and the strips.
 
+    Args:
+      frame_list: The display list of the frame.
+      rows: The rows returned by _drawSignals().
+    """
     self.painter.begin(self.image)
     try:
-      self.painter.setFont(self._font)
-      self.painter.setRenderHint(QtGui.QPainter.TextAntialiasing)
-
-      self.painter.fillRect(
-          QtCore.QRect(QtCore.QPoint(0, 0), self.image.size()), self._background)
-      self._drawFrame()
-      self._drawSignals()
+      for rect in self.dirty_rects:
+        self.painter.setClipRect(rect)
+        self.painter.fillRect(rect, self._replayer.background)
+        self._replayer.replay(frame_list)
+        for _, _, strip, top in rows:
+          if top < rect.bottom() and top + strip.height() > rect.top():
+            self.painter.drawImage(0, top, strip)
     finally:
       self.painter.end()
 
   def _loadDiagram(self, diagram):
-    """Fills data members with properties calculated from a diagram.
-
-    Used to initialize global diagram setting used by drawing methods.
+    """Prepares the layout and the drawing style of a diagram.
 
     Args:
       diagram: The diagram to load.
     """
-    self.image = QtGui.QImage(
-        diagram.width, diagram.height, QtGui.QImage.Format_ARGB32)
-
-    self._font = QtGui.QFont(diagram.font_family, diagram.font_size)
+    if (self.image is None or self.image.width() != diagram.width or
+        self.image.height() != diagram.height):
+      self.image = QtGui.QImage(
+          diagram.width, diagram.height, QtGui.QImage.Format_ARGB32)
+      self._layout_key = None
 
     self._diagram = diagram
-    self._background = QtGui.QColor('#' + hex(diagram.background)[2:].zfill(6))
-    self._color = QtGui.QColor('#' + hex(diagram.foreground)[2:].zfill(6))
-
-    margin = diagram.margin
-    self._outer_frame = QtCore.QRectF(
-        margin, margin, diagram.width - 2 * margin, diagram.height - 2 * margin)
-
-    label_widths = [self._getTextWidth(i.name + '  ') for i in diagram.signals]
-    assert len(label_widths) > 0, 'A diagram must have at least one signal.'
-    self._inner_frame = QtCore.QRectF(
-        margin + max(label_widths),
-        margin + self._getTextHeight() * TEXT_HEIGHT,
-        self._outer_frame.width() - max(label_widths),
-        self._outer_frame.height() - self._getTextHeight() * TEXT_HEIGHT)
-
-  def _drawFrame(self):
-    """Draws the frame surrounding the loaded diagram.
-
-    If the diagram defines a step length, also draws and labels the columns into
-    which the diagram is divided.
+    self._layout = layout.Layout(
+        diagram, QtTextMetrics(diagram.font_family, diagram.font_size),
+        self._stats)
+    self._replayer = Replayer(self.painter, diagram)
+
+  def _drawSignals(self, layout_key):
+    """Lays out and draws the signals defined in the loaded diagram into strips.
+
+    Each signal is laid out relative to the top of a transparent strip image
+    spanning the full width of the diagram and the height of its row, and
+    drawn, along with its label, into the strip. Display lists and strips from
+    the previous call are reused when the signal, the layout and the position
+    of the row within its strip are unchanged.
+
+    Args:
+      layout_key: The key of the global layout, from layout.Layout.getKey().
+
+    Returns:
+      A list containing a tuple for each signal, in order, with the cache key of
+      its strip, its strip-relative display list, the strip QImage and the Y
+      coordinate of its top.
     """
-    old_pen = self.painter.pen()
-    self.painter.setPen(QtGui.QPen(self._color))
-    self.painter.drawRect(self._outer_frame)
-    self.painter.drawRect(self._inner_frame)
-    self.painter.setPen(old_pen)
-
-    if self._diagram.step:
-      width = self._diagram.end - self._diagram.start
-      pixels_per_unit = self._inner_frame.width() / width
-      pixels_per_step = pixels_per_unit * self._diagram.step
-      stops = [self._timeToPixels(i)
-               for i in range(0, self._diagram.end, self._diagram.step)]
-      for index, left in enumerate(stops):
-        self._drawLine(left, self._inner_frame.top() + 1,
-                       left, self._inner_frame.bottom(),
-                       dashed=True)
-        if index != len(stops) - 1:
-          center_x = left + pixels_per_step / 2
-          center_y = self._inner_frame.top() - self._getTextHeight() * 0.5
-          self._drawText('T{}'.format(index + 1), center_x, center_y)
-
-  def _drawSignals(self):
-    """Draws the signals defined in the loaded diagram, in order."""
-    frame = self._inner_frame.translated(0, 0)  # Copy.
-    frame.setHeight(frame.height() / len(self._diagram.signals))
-    for signal in self._diagram.signals:
-      if isinstance(signal, model.Clock):
-        signal = self._clockToLine(signal)
-
-      if isinstance(signal, model.Line):
-        self._drawLineSignal(signal, frame)
-      elif isinstance(signal, model.Bus):
-        self._drawBusSignal(signal, frame)
+    half_height = STRIP_PADDING + self._layout.getRowExtent() / 2
+
+    strips = {}
+    rows = []
+    for signal, frame in zip(self._diagram.signals,
+                             self._layout.getRowFrames()):
+      center = frame.centerY()
+      top = math.floor(center - half_height)
+      bottom = math.ceil(center + half_height)
+
+      key = (layout_key, frame.top() - top, _getSignalKey(signal))
+      cached = strips.get(key, self._strips.get(key))
+      if cached is None:
+        with self._stats.stage('layout'):
+          display_list = self._layout.drawSignal(signal, layout.Rect(
+              frame.left(), frame.top() - top, frame.width(), frame.height()))
+        with self._stats.stage('rasterize'):
+          strip = QtGui.QImage(self._diagram.width, bottom - top,
+                               QtGui.QImage.Format_ARGB32_Premultiplied)
+          strip.fill(0)
+          self.painter.begin(strip)
+          try:
+            self._replayer.replay(display_list)
+          finally:
+            self.painter.end()
+        cached = (display_list, strip)
       else:
-        raise TypeError('Invalid signal type: {}'.format(type(signal)))
+        self._stats.count('reused_strips')
+
+      strips[key] = cached
+      rows.append((key, cached[0], cached[1], top))
 
-      self._drawText(signal.name,
-                     frame.left() - self._getTextWidth(signal.name + '  ') / 2,
-                     (frame.top() + frame.bottom()) / 2)
+    self._strips = strips
+    return rows
 
-      frame.moveTop(frame.top() + frame.height())
 
-  def _drawBusSignal(self, bus, frame):
-    """Draws a bus signal in the specified frame.
+class TileRenderer:
+  """A Qt-based renderer of diagrams zoomed in on time, drawn in tiles.
+
+  At a zoom level, the inner frame of the diagram (its time axis) is widened by
+  the zoom factor, while its labels, margins and height are kept. The widened
+  diagram is drawn in square tiles of TILE_SIZE pixels, and only the columns,
+  clock cycles and changes within the time range of a tile (and the rows it
+  overlaps) are laid out for it. Tiles are kept in a bounded LRU cache keyed by
+  the global layout and the contents of the signals they show, so panning over
+  tiles drawn before and editing the signals of other rows reuse them.
+  """
+
+  def __init__(self):
+    self.diagram = None
+    self.zoom = 1
+    self.extra_width = 0
+    self.frame = None
+    self.painter = QtGui.QPainter()
+    self._tiles = collections.OrderedDict()
+    self._stats = instrument.DISABLED
+
+  def setDiagram(self, diagram, stats=instrument.DISABLED):
+    """Sets the diagram drawn, keeping the zoom level.
 
     Args:
-      bus: The model.Bus to draw.
-      frame: The QRect where the signal is to be drawn.
+      diagram: The diagram to draw. It must have at least one signal.
+      stats: An instrument.Stats in which the time spent and the numbers of
+        tiles drawn and reused are recorded.
     """
-    diagram = self._diagram
-
-    high = frame.top() + frame.height() * 0.3
-    middle = frame.top() + frame.height() * 0.5
-    low = frame.top() + frame.height() * 0.7
-    margin = self._timeDeltaToPixels(diagram.delay / 2)
-
-    changes = bus.changes.copy()
-    if changes:
-      last_time, last_value = changes.popitem()
-      changes[last_time] = last_value
-      if last_time < diagram.end:
-        changes[diagram.end] = last_value
-    else:
-      changes[diagram.end] = bus.start
-
-    last = (self._timeToPixels(diagram.start), bus.start)
-    for next_time, next_value in changes.items():
-      x, value = last
-      next_x = min(frame.right() - 1, self._timeToPixels(next_time)) + margin
-      if value is None:
-        self._drawLine(x + 1, middle, min(frame.right() - 1, next_x), middle, 2)
-      else:
-        points = [(x + margin, low),
-                  (x + margin, high)]
-        if x > frame.left():
-          points.insert(1, (x + 1, middle))
-        else:
-          points.insert(1, (x + 1, low))
-          points.insert(2, (x + 1, high))
-        if next_x - margin < frame.right() - 1:
-          points += [(next_x - margin, high),
-                     (next_x, middle),
-                     (next_x - margin, low)]
-        else:
-          points += [(next_x - margin - 1, high),
-                     (next_x - margin - 1, low)]
-        points = [QtCore.QPointF(*i) for i in points]
-
-        old_pen = self.painter.pen()
-        old_brush = self.painter.brush()
-        self.painter.setPen(QtCore.Qt.NoPen)
-        self.painter.setRenderHint(QtGui.QPainter.Antialiasing)
-
-        if value is model.UNKNOWN:
-          self.painter.setBrush(QtGui.QBrush(UNKNOWN_BACKGROUND))
-          self.painter.drawConvexPolygon(*points)
-        elif isinstance(value, str):
-          self.painter.setBrush(QtGui.QBrush(self._background))
-          self.painter.drawConvexPolygon(*points)
-        else:
-          raise TypeError('Invalid bus value: {}'.format(value))
-
-        self.painter.setPen(old_pen)
-        self.painter.setBrush(old_brush)
-        self.painter.setRenderHint(QtGui.QPainter.Antialiasing, False)
-
-        if isinstance(value, str):
-          center_x = (x + next_x + margin) / 2
-          top_margin = self._getTextHeight() * (TEXT_HEIGHT - 1) / 2
-          center_y = frame.center().y() - top_margin
-          self._drawText(value, center_x, center_y, ignore_markup=True)
-
-        if x > frame.left():
-          self._drawLine(x, middle, x + margin, high, 2)
-          self._drawLine(x, middle, x + margin, low, 2)
-        else:
-          self._drawLine(x + 1, high, x + margin, high, 2)
-          self._drawLine(x + 1, low, x + margin, low, 2)
-
-        self._drawLine(x + margin + 1, high, next_x - margin, high, 2)
-        self._drawLine(x + margin + 1, low, next_x - margin, low, 2)
-
-        if next_x - margin < frame.right() - 1:
-          self._drawLine(next_x - margin, high, next_x, middle, 2)
-          self._drawLine(next_x - margin, low, next_x, middle, 2)
-      last = (next_x, next_value)
-
-  def _drawLineSignal(self, line, frame):
-    """Draws a line signal in the specified frame.
+    self.diagram = diagram
+    self._stats = stats
+    self._metrics = QtTextMetrics(diagram.font_family, diagram.font_size)
+    self.frame = layout.Layout(diagram, self._metrics, stats).inner_frame
+    self._signal_keys = [_getSignalKey(i) for i in diagram.signals]
+    self.setZoom(self.zoom)
+
+  def setZoom(self, zoom):
+    """Sets the zoom level, by which the time axis of the diagram is widened.
+
+    After this, self.extra_width holds the number of pixels by which the zoomed
+    diagram is wider than the diagram.
 
     Args:
-      line: The model.Line to draw.
-      frame: The QRect where the signal is to be drawn.
+      zoom: The zoom factor, at least 1.
     """
-    diagram = self._diagram
+    self.zoom = zoom
+    self.extra_width = round(self.frame.width() * (zoom - 1))
+    zoomed = copy.copy(self.diagram)
+    zoomed.width += self.extra_width
+    self._zoomed = zoomed
+    self._layout = layout.Layout(zoomed, self._metrics, self._stats)
+    self._layout_key = self._layout.getKey()
+    self._rows = []
+    half_height = STRIP_PADDING + self._layout.getRowExtent() / 2
+    for frame in self._layout.getRowFrames():
+      self._rows.append((frame, math.floor(frame.centerY() - half_height),
+                         math.ceil(frame.centerY() + half_height)))
+    self._replayer = Replayer(self.painter, zoomed)
+
+  def paint(self, painter, rect, offset):
+    """Paints part of the zoomed diagram onto a device the size of the diagram.
+
+    The labels and the margins of the diagram are painted in place, and the
+    inner frame shows the part of the zoomed time axis starting offset pixels
+    to the right of its start.
 
-    levels = {
-      1: frame.top() + frame.height() * 0.3,
-      None: frame.top() + frame.height() * 0.5,
-      0: frame.top() + frame.height() * 0.7
-    }
+    Args:
+      painter: An active QPainter on the device.
+      rect: The QRect of the device to paint.
+      offset: The number of pixels by which the time axis is scrolled, from 0 to
+        self.extra_width.
+    """
+    left = math.ceil(self.frame.left())
+    right = math.floor(self.frame.right())
+    regions = [
+      (QtCore.QRect(0, 0, left, self.diagram.height), 0),
+      (QtCore.QRect(left, 0, right - left, self.diagram.height), offset),
+      (QtCore.QRect(right, 0, self.diagram.width - right, self.diagram.height),
+       self.extra_width)
+    ]
+
+    painter.save()
+    for region, shift in regions:
+      region = region.intersected(rect)
+      if region.isEmpty():
+        continue
+      painter.setClipRect(region)
+      for column in range((region.left() + shift) // TILE_SIZE,
+                          (region.right() + shift) // TILE_SIZE + 1):
+        for row in range(region.top() // TILE_SIZE,
+                         region.bottom() // TILE_SIZE + 1):
+          painter.drawImage(column * TILE_SIZE - shift, row * TILE_SIZE,
+                            self.getTile(column, row))
+    painter.restore()
+
+  def getTile(self, column, row):
+    """Returns a tile of the zoomed diagram, drawing it if not cached.
 
-    if line.changes:
-      changes = line.changes.copy()
-      last_time, last_value = changes.popitem()
-      changes[last_time] = last_value
-      if last_time < diagram.end:
-        changes[diagram.end + diagram.delay / 2] = last_value
-    else:
-      changes = {diagram.end + diagram.delay / 2: line.start}
-
-    last = (diagram.start - diagram.delay / 2, line.start)
-    for time, value in changes.items():
-      last_time, last_value = last
-      last_x = self._timeToPixels(last_time)
-      time += diagram.delay / 2
-      x = self._timeToPixels(time)
-      x_minus_delay = self._timeToPixels(time - diagram.delay)
-      if last_value == model.UNKNOWN:
-        self._drawLine(last_x + 1, levels[0], x_minus_delay, levels[0], 2)
-        self._drawLine(last_x + 1, levels[1], x_minus_delay, levels[1], 2)
-        self._drawLine(x_minus_delay, levels[0], x, levels[value], 2)
-        self._drawLine(x_minus_delay, levels[1], x, levels[value], 2)
-      elif value == last_value:
-        self._drawLine(last_x + 1, levels[value], x, levels[value], 2)
-      else:
-        self._drawLine(last_x + 1, levels[last_value],
-                       x_minus_delay, levels[last_value],
-                       2)
-        self._drawLine(x_minus_delay, levels[last_value],
-                       x, levels[value],
-                       2)
-      last = (time, value)
+    Args:
+      column: The index of the tile from the left of the zoomed diagram.
+      row: The index of the tile from its top.
 
-  def _drawLine(self, x1, y1, x2, y2, width=1, dashed=False):
-    """Draws a line between the two specified points.
+    Returns:
+      A QImage of TILE_SIZE by TILE_SIZE pixels, with its top left corner at
+      (column * TILE_SIZE, row * TILE_SIZE) in the zoomed diagram.
+    """
+    left = column * TILE_SIZE
+    top = row * TILE_SIZE
+    rows = [index for index, (_, row_top, row_bottom) in enumerate(self._rows)
+            if row_top < top + TILE_SIZE and row_bottom > top]
+    key = (self._layout_key, column, row,
+           tuple(self._signal_keys[i] for i in rows))
+    tile = self._tiles.get(key)
+    if tile is not None:
+      self._tiles.move_to_end(key)
+      self._stats.count('reused_tiles')
+      return tile
+
+    frame = self._layout.inner_frame
+    diagram = self._zoomed
+    def getTime(x):
+      time = diagram.start + ((x - frame.left()) / frame.width() *
+                              (diagram.end - diagram.start))
+      return min(diagram.end, max(diagram.start, time))
+    self._layout.setWindow(getTime(left - TILE_MARGIN),
+                           getTime(left + TILE_SIZE + TILE_MARGIN))
+
+    with self._stats.stage('layout'):
+      display_lists = [self._layout.drawFrame()]
+      for index in rows:
+        display_lists.append(self._layout.drawSignal(
+            diagram.signals[index], self._rows[index][0]))
+    with self._stats.stage('rasterize'):
+      tile = QtGui.QImage(TILE_SIZE, TILE_SIZE,
+                          QtGui.QImage.Format_ARGB32_Premultiplied)
+      self.painter.begin(tile)
+      try:
+        self.painter.fillRect(tile.rect(), self._replayer.background)
+        self.painter.translate(-left, -top)
+        for display_list in display_lists:
+          self._replayer.replay(display_list)
+      finally:
+        self.painter.end()
+    self._stats.count('tiles')
+
+    self._tiles[key] = tile
+    if len(self._tiles) > TILE_CACHE_SIZE:
+      self._tiles.popitem(last=False)
+    return tile
+
+
+class Replayer:
+  """Replays display lists onto a QPainter, in the style of a diagram.
+
+  A Replayer can paint onto any device the painter is begun on, e.g. a QImage
+  or a QPrinter at its native resolution. Display lists, and the text drawn
+  from them, are in pixels of the screen, so on devices of other resolutions
+  the painter is to be scaled by the ratio of their resolutions.
+  """
+
+  def __init__(self, painter, diagram):
+    """Prepares the pens, brushes and font used to draw a diagram.
 
-    If the line is slanted (neither horizontal nor vertical) it is drawn with
-    anti-aliasing enabled.
+    Args:
+      painter: The QPainter to draw with. It must be active while replaying.
+      diagram: The model.TimingDiagram whose style is used.
+    """
+    self.painter = painter
+    self.diagram = diagram
+    # The font is sized in pixels of the screen, whose metrics the layout was
+    # measured with, rather than in points, which devices of other resolutions
+    # would scale on top of the painter's transform.
+    self.font = QtGui.QFont(diagram.font_family)
+    self.font.setPixelSize(QtGui.QFontInfo(QtGui.QFont(
+        diagram.font_family, diagram.font_size)).pixelSize())
+    self.background = QtGui.QColor(
+        '#' + hex(diagram.background)[2:].zfill(6))
+    self.color = QtGui.QColor('#' + hex(diagram.foreground)[2:].zfill(6))
+    self._brushes = {
+      'unknown': QtGui.QBrush(UNKNOWN_BACKGROUND),
+      'value': QtGui.QBrush(self.background),
+      'activity': QtGui.QBrush(self.color, QtCore.Qt.BDiagPattern)
+    }
+    self._pens = {}
+
+  def paintDiagram(self, display_lists):
+    """Paints a whole diagram, including its background.
 
     Args:
-      x1: The X coordinate of the first point.
-      y1: The Y coordinate of the first point.
-      x2: The X coordinate of the second point.
-      y2: The Y coordinate of the second point.
-      width: The width of the line.
-      dashed: If True, the line is drawn using a dashed style.
+      display_lists: A list of (vertical offset, layout.DisplayList) pairs, as
+        kept in Renderer.display_lists.
     """
-    old_pen = self.painter.pen()
+    self.painter.fillRect(
+        QtCore.QRectF(0, 0, self.diagram.width, self.diagram.height),
+        self.background)
+    for offset, display_list in display_lists:
+      self.painter.save()
+      self.painter.translate(0, offset)
+      self.replay(display_list)
+      self.painter.restore()
+
+  def replay(self, display_list):
+    """Draws the operations of a display list, in order.
 
-    self.painter.setRenderHint(QtGui.QPainter.Antialiasing,
-                               x1 != x2 and y1 != y2)
+    Args:
+      display_list: The layout.DisplayList to draw.
+    """
+    painter = self.painter
+    painter.save()
+    painter.setFont(self.font)
+    painter.setRenderHint(QtGui.QPainter.TextAntialiasing)
+    alignment = QtCore.Qt.TextSingleLine | QtCore.Qt.AlignCenter
 
-    new_pen = QtGui.QPen(self._color)
-    new_pen.setWidth(width)
-    if dashed:
-      new_pen.setStyle(QtCore.Qt.CustomDashLine)
-      new_pen.setDashPattern([4, 4])
-    else:
-      new_pen.setStyle(QtCore.Qt.SolidLine)
+    for item in display_list:
+      operation = item[0]
+      if operation == layout.LINES:
+        self._drawLines(*item[1:])
+      elif operation == layout.TEXT:
+        painter.setPen(self.color)
+        painter.drawText(_toQRectF(item[2]), alignment, item[1])
+      elif operation == layout.FILL_POLYGONS:
+        path = QtGui.QPainterPath()
+        path.setFillRule(QtCore.Qt.WindingFill)
+        for polygon in item[2]:
+          path.addPolygon(
+              QtGui.QPolygonF([QtCore.QPointF(*i) for i in polygon]))
+          path.closeSubpath()
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.fillPath(path, self._brushes[item[1]])
+        painter.setRenderHint(QtGui.QPainter.Antialiasing, False)
+      elif operation == layout.FILL_RECT:
+        painter.fillRect(_toQRectF(item[1]), self.color)
+      elif operation == layout.OUTLINE_RECT:
+        painter.setPen(QtGui.QPen(self.color))
+        painter.setBrush(QtCore.Qt.NoBrush)
+        painter.drawRect(_toQRectF(item[1]))
+      elif operation == layout.CLIP:
+        painter.save()
+        painter.setClipRect(_toQRectF(item[1]))
+      elif operation == layout.UNCLIP:
+        painter.restore()
+      else:
+        raise ValueError('Invalid display list operation: {}'.format(operation))
 
-    self.painter.setPen(new_pen)
-    self.painter.drawLine(x1, y1, x2, y2)
+    painter.restore()
 
-    self.painter.setPen(old_pen)
-    self.painter.setRenderHint(QtGui.QPainter.Antialiasing, False)
+  def _drawLines(self, width, dashed, coordinates):
+    """Draws the lines of a single display list operation.
 
-  def _drawText(self, text, center_x, center_y, ignore_markup=False):
-    """Draws the specified text at a specified point.
+    Horizontal and vertical lines are drawn with a single drawLines() call,
+    while slanted lines are drawn as a single anti-aliased path.
 
     Args:
-      text: The text to draw. If ignore_markup is False, this text is parsed for
-        markup. If the text begins with an exclamation mark (!), a line will be
-        drawn above it. To draw the line only over part of the text, separate
-        the two parts by a forward slash (/) and prepend the one which is to
-        have a line drawn above it by an exclamation mark (!). Examples:
-          !ABCD -> will draw ABCD with a line over all of it.
-          AB!CD -> will draw AB!CD without any lines.
-          !AB/CD -> will draw AB/CD with a line over AB.
-          AB/!CD -> will draw AB/CD with a line over CD.
-          !AB/!CD -> will draw AB/CD with a line over both AB and CD
-          !AB/!CD/!EF -> will draw AB/CD/!EF with a line over AB and CD.
-      center_x: The X coordinate of the center of the text.
-      center_x: The Y coordinate of the center of the text.
-      ignore_markup: If True, the text is drawn as-is without any omissions or
-        extra lines.
+      width: The width of the lines.
+      dashed: If True, the lines are drawn using a dashed style.
+      coordinates: A sequence with four numbers (x1, y1, x2, y2) per line.
     """
-    if ignore_markup:
-      clean_text = text
-    else:
-      clean_text = re.sub('(^|/)!', r'\1', text)
+    lines = []
+    slants = QtGui.QPainterPath()
+    for index in range(0, len(coordinates), 4):
+      x1, y1, x2, y2 = coordinates[index:index + 4]
+      if x1 != x2 and y1 != y2:
+        slants.moveTo(x1, y1)
+        slants.lineTo(x2, y2)
+      else:
+        lines.append(QtCore.QLineF(x1, y1, x2, y2))
 
-    alignment = QtCore.Qt.TextSingleLine | QtCore.Qt.AlignCenter
-    metrics = self.painter.fontMetrics()
-    width = metrics.width(clean_text)
-    height = metrics.height()
-    rect = QtCore.QRectF(
-        center_x - width / 2, center_y - height / 2, width, height)
-
-    if ignore_markup:
-      self.painter.drawText(rect, alignment, text)
-    else:
-      for part in text.partition('/'):
-        overline = part.startswith('!')
-        if overline: part = part[1:]
+    self.painter.setPen(self._getPen(width, dashed))
+    if lines:
+      self.painter.drawLines(lines)
+    if not slants.isEmpty():
+      self.painter.setBrush(QtCore.Qt.NoBrush)
+      self.painter.setRenderHint(QtGui.QPainter.Antialiasing)
+      self.painter.drawPath(slants)
+      self.painter.setRenderHint(QtGui.QPainter.Antialiasing, False)
 
-        rect.setWidth(metrics.width(part))
-        self.painter.drawText(rect, alignment, part)
-        if overline:
-          self._drawLine(rect.left(), rect.top(), rect.right(), rect.top())
-        rect.moveLeft(rect.right())
+  def _getPen(self, width, dashed):
+    """Returns a pen in the foreground color of the diagram.
 
-  def _timeToPixels(self, time):
-    """Converts a time instant to an X coordinate on the diagram image.
+    Pens are created once per Replayer and reused.
 
     Args:
-      time: The time to convert.
+      width: The width of the pen.
+      dashed: If True, the pen uses a dashed style.
 
     Returns:
-      The absolute X coordinate on the diagram image corresponding to the
-      specified time.
+      A QPen with the requested style.
     """
-    offset = max(0, self._timeDeltaToPixels(time - self._diagram.start))
-    return min(self._inner_frame.right() - 1, self._inner_frame.left() + offset)
+    if (width, dashed) not in self._pens:
+      pen = QtGui.QPen(self.color)
+      pen.setWidth(width)
+      if dashed:
+        pen.setStyle(QtCore.Qt.CustomDashLine)
+        pen.setDashPattern([4, 4])
+      else:
+        pen.setStyle(QtCore.Qt.SolidLine)
+      self._pens[width, dashed] = pen
+    return self._pens[width, dashed]
 
-  def _timeDeltaToPixels(self, time):
-    """Converts a time delta to a horizontal distance on the diagram image.
 
-    Args:
-      time: The time delta to convert.
+class QtTextMetrics(layout.TextMetrics):
+  """Measures text with the metrics of a Qt font."""
 
-    Returns:
-      The horizontal distance represented by the specified time delta, in pixels
-      on the diagram image.
-    """
-    total_time = self._diagram.end - self._diagram.start
-    pixels_per_time_unit = self._inner_frame.width() / total_time
-    return time * pixels_per_time_unit
+  def height(self):
+    """Returns the height of the font in pixels."""
+    return _getFontMetrics(self.font_family, self.font_size).height()
 
-  def _getTextWidth(self, text, strip_markup=True):
-    """Calculates the width of a given text string with the current font.
+  def width(self, text):
+    """Returns the width of a text string in pixels."""
+    return _getFontMetrics(self.font_family, self.font_size).width(text)
 
-    Args:
-      text: The text to measure.
-      strip_markup: If true, removes markup from the specified text before
-        measuring.
+  def layoutText(self, text, markup):
+    """Measures a text string and splits it into parts to be drawn.
 
-    Returns:
-      The width of the text, in pixels.
+    See layout.TextMetrics.layoutText(). Results are cached by _layoutText().
     """
-    if strip_markup:
-      text = re.sub('(^|/)!', r'\1', text)
-    return QtGui.QFontMetrics(self._font).width(text)
+    return _layoutText(self.font_family, self.font_size, text, markup)
 
-  def _getTextHeight(self):
-    """Returns the height of the current font in pixels."""
-    return QtGui.QFontMetrics(self._font).height()
 
-  def _clockToLine(self, clock):
-    """Converts a clock signal to a line signal for rendering.
+def checkDisplay():
+  """Checks that a display is available for rendering with Qt.
 
-    Calculates all the changes to the clock's value that will be visible in the
-    diagram and recreates them as a line signal.
+  Qt 4 has no offscreen platform, and text can only be measured and drawn with
+  a QApplication that has its GUI enabled, which on X11 connects to a display
+  even if no windows are shown. On hosts without one, run DrawTime under a
+  virtual display, e.g. with xvfb-run.
 
-    Args:
-      clock: The model.Clock to convert.
+  Raises:
+    RuntimeError: If running on X11 with no display set, where Qt would
+      otherwise abort the process.
+  """
+  if ((sys.platform.startswith('linux') or 'bsd' in sys.platform) and
+      not os.environ.get(DISPLAY_VARIABLE)):
+    raise RuntimeError(
+        'Rendering images requires a display, but {} is not set. Run under a '
+        'virtual display (e.g. xvfb-run), or render to SVG.'.format(
+            DISPLAY_VARIABLE))
 
-    Returns:
-      A model.Line that contains all the clock changes visible within the loaded
-      diagram.
-    """
-    on_length = clock.duty * clock.length
-    off_length = clock.length - on_length
-    line = model.Line(clock.name, 0, {})
-
-    time = -(-clock.offset % clock.length)
-    active = False
-    while time < self._diagram.end:
-      time += on_length if active else off_length
-      active = not active
-      if time <= self._diagram.start:
-        line.start = int(active)
-      else:
-        line.changes[time] = int(active)
 
-    line.changes.popitem()
+def createHeadlessApplication():
+  """Creates the QApplication needed for rendering, without showing windows.
+
+  See checkDisplay() for the display this requires.
+
+  Returns:
+    The QApplication, which must be kept referenced while rendering.
+
+  Raises:
+    RuntimeError: If no display is available.
+  """
+  checkDisplay()
+  app = QtGui.QApplication(sys.argv[:1])
+  app.setApplicationName('DrawTime')
+  return app
+
+
+def _toQRectF(rect):
+  """Converts a layout.Rect to a QRectF."""
+  return QtCore.QRectF(*rect.toTuple())
+
+
+def _getSignalKey(signal):
+  """Returns a hashable key of the contents of a signal.
+
+  Args:
+    signal: The model.Clock, model.Line or model.Bus to describe.
+
+  Returns:
+    A tuple that compares equal for signals that are drawn identically.
+  """
+  if isinstance(signal, model.Clock):
+    return (type(signal), signal.name,
+            signal.offset, signal.length, signal.duty)
+  else:
+    return (type(signal), signal.name, signal.start, signal.changes.getKey())
+
+
+def _getThreadCache(name, function, maxsize):
+  """Returns an LRU-cached version of a function for the current thread.
+
+  Fonts and their metrics are only reentrant, so the editor and its preview
+  worker must not share the objects cached while measuring text. Each thread
+  gets its own cache instead, created on first use.
+
+  Args:
+    name: The name under which the cache is kept for the thread.
+    function: The function to cache.
+    maxsize: The maximum number of results kept by the cache.
+
+  Returns:
+    The cached function.
+  """
+  cached = getattr(_thread_caches, name, None)
+  if cached is None:
+    cached = functools.lru_cache(maxsize=maxsize)(function)
+    setattr(_thread_caches, name, cached)
+  return cached
+
+
+def _getFontMetrics(font_family, font_size):
+  """Returns the metrics of a font, cached for the current thread.
+
+  Args:
+    font_family: The family of the font.
+    font_size: The size of the font in points.
+
+  Returns:
+    A QFontMetrics for the specified font.
+  """
+  cached = _getThreadCache('font_metrics', _createFontMetrics, FONT_CACHE_SIZE)
+  return cached(font_family, font_size)
+
+
+def _createFontMetrics(font_family, font_size):
+  """Returns the metrics of a font. See _getFontMetrics()."""
+  return QtGui.QFontMetrics(QtGui.QFont(font_family, font_size))
+
+
+def _layoutText(font_family, font_size, text, markup):
+  """Measures a text string with a Qt font and splits it into parts to draw.
+
+  Results are kept in a bounded LRU cache per thread, so labels and bus values
+  repeated within or across diagrams are only measured once by each thread.
+
+  Args:
+    font_family: The family of the font used to draw the text.
+    font_size: The size of the font used to draw the text, in points.
+    text: The text to lay out.
+    markup: Whether to parse the text for overline markup.
+
+  Returns:
+    The triple returned by layout.TextMetrics.layoutText().
+  """
+  cached = _getThreadCache('text_layouts', _measureText, TEXT_CACHE_SIZE)
+  return cached(font_family, font_size, text, markup)
+
 
-    return line
+def _measureText(font_family, font_size, text, markup):
+  """Measures and splits a text string. See _layoutText()."""
+  metrics = QtTextMetrics(font_family, font_size)
+  return layout.TextMetrics.layoutText(metrics, text, markup)
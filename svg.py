@@ -0,0 +1,166 @@
+"""A Qt-free renderer writing timing diagrams as SVG documents."""
+
+import html
+import instrument
+import layout
+
+
+# The extension of SVG files.
+SVG_EXTENSION = '.svg'
+
+# The color of the background of bus segments representing unknown values.
+UNKNOWN_BACKGROUND = '#a0a0a4'
+
+# The spacing in pixels between the hatch lines filling bus activity.
+HATCH_SPACING = 8
+
+
+def isSvgPath(path):
+  """Returns whether a path names an SVG file, judging by its extension."""
+  return path.lower().endswith(SVG_EXTENSION)
+
+
+def writeSvg(diagram, filepath, stats=instrument.DISABLED):
+  """Renders a diagram to an SVG file.
+
+  Args:
+    diagram: The model.TimingDiagram to render.
+    filepath: The path to which the SVG document is to be written. If the file
+      already exists, it is silently overwritten.
+    stats: An instrument.Stats in which the time spent is recorded.
+  """
+  with stats.stage('svg'), open(filepath, 'w', encoding='utf8') as outfile:
+    SvgRenderer(outfile).draw(diagram, stats)
+
+
+class SvgRenderer:
+  """Renders timing diagrams to SVG, with the layout of render.Renderer.
+
+  Without Qt, fonts cannot be measured, so text is laid out with the estimated
+  metrics of layout.TextMetrics. The document is written to the output file as
+  it is laid out, one signal at a time, so the whole document is never held in
+  memory.
+  """
+
+  def __init__(self, outfile):
+    """Initializes the renderer.
+
+    Args:
+      outfile: A text file object to which SVG documents are written.
+    """
+    self.outfile = outfile
+
+  def draw(self, diagram, stats=instrument.DISABLED):
+    """Writes the specified diagram to the output file as an SVG document.
+
+    Args:
+      diagram: The diagram to draw.
+      stats: An instrument.Stats in which the numbers of primitives laid out
+        are recorded.
+    """
+    if not diagram:
+      raise ValueError('No diagram provided.')
+
+    diagram_layout = layout.Layout(
+        diagram, layout.TextMetrics(diagram.font_family, diagram.font_size),
+        stats)
+    self._background = _formatColor(diagram.background)
+    self._color = _formatColor(diagram.foreground)
+    self._fills = {
+      'unknown': UNKNOWN_BACKGROUND,
+      'value': self._background,
+      'activity': 'url(#activity)'
+    }
+    self._clip_count = 0
+    write = self.outfile.write
+
+    write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    write('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+          'width="{0}" height="{1}" viewBox="0 0 {0} {1}">\n'.format(
+              diagram.width, diagram.height))
+    write('<defs><pattern id="activity" patternUnits="userSpaceOnUse" '
+          'width="{0}" height="{0}"><path d="M0 {0}L{0} 0" stroke="{1}"/>'
+          '</pattern></defs>\n'.format(HATCH_SPACING, self._color))
+    write('<rect width="100%" height="100%" fill="{}"/>\n'.format(
+        self._background))
+    write('<g font-family={} font-size="{}pt" fill="{}" '
+          'text-anchor="middle" dominant-baseline="central">\n'.format(
+              _quoteAttribute(diagram.font_family), diagram.font_size,
+              self._color))
+
+    self.replay(diagram_layout.drawFrame())
+    for signal, frame in zip(diagram.signals, diagram_layout.getRowFrames()):
+      write('<g>\n')
+      self.replay(diagram_layout.drawSignal(signal, frame))
+      write('</g>\n')
+
+    write('</g>\n</svg>\n')
+
+  def replay(self, display_list):
+    """Writes the operations of a display list as SVG elements, in order.
+
+    Args:
+      display_list: The layout.DisplayList to write.
+    """
+    write = self.outfile.write
+    for item in display_list:
+      operation = item[0]
+      if operation == layout.LINES:
+        _, width, dashed, coordinates = item
+        path = ''.join(
+            'M{} {}L{} {}'.format(*map(_formatNumber,
+                                       coordinates[index:index + 4]))
+            for index in range(0, len(coordinates), 4))
+        write('<path fill="none" stroke="{}" stroke-width="{}"{} '
+              'd="{}"/>\n'.format(
+                  self._color, width,
+                  ' stroke-dasharray="4 4"' if dashed else '', path))
+      elif operation == layout.TEXT:
+        _, text, rect = item
+        if text:
+          write('<text x="{}" y="{}" xml:space="preserve">{}</text>\n'.format(
+              _formatNumber(rect.left() + rect.width() / 2),
+              _formatNumber(rect.centerY()), html.escape(text, quote=False)))
+      elif operation == layout.FILL_POLYGONS:
+        _, fill, polygons = item
+        path = ''.join(
+            'M' + 'L'.join('{} {}'.format(_formatNumber(x), _formatNumber(y))
+                           for x, y in polygon) + 'Z'
+            for polygon in polygons)
+        write('<path fill="{}" d="{}"/>\n'.format(self._fills[fill], path))
+      elif operation == layout.FILL_RECT:
+        write('<rect {}/>\n'.format(_formatRect(item[1])))
+      elif operation == layout.OUTLINE_RECT:
+        write('<rect {} fill="none" stroke="{}"/>\n'.format(
+            _formatRect(item[1]), self._color))
+      elif operation == layout.CLIP:
+        self._clip_count += 1
+        write('<clipPath id="clip{0}"><rect {1}/></clipPath>\n'
+              '<g clip-path="url(#clip{0})">\n'.format(
+                  self._clip_count, _formatRect(item[1])))
+      elif operation == layout.UNCLIP:
+        write('</g>\n')
+      else:
+        raise ValueError('Invalid display list operation: {}'.format(operation))
+
+
+def _formatColor(color):
+  """Formats a color given as a 24-bit integer as an SVG hex color."""
+  return '#' + hex(color)[2:].zfill(6)
+
+
+def _quoteAttribute(text):
+  """Escapes and quotes a string as an attribute value."""
+  return '"{}"'.format(html.escape(text))
+
+
+def _formatRect(rect):
+  """Formats a layout.Rect as the attributes of an SVG rect element."""
+  return 'x="{}" y="{}" width="{}" height="{}"'.format(
+      *map(_formatNumber, rect.toTuple()))
+
+
+def _formatNumber(number):
+  """Formats a coordinate compactly, rounded to hundredths of a pixel."""
+  text = '{:.2f}'.format(number).rstrip('0').rstrip('.')
+  return '0' if text == '-0' else text
@@ -0,0 +1,71 @@
+"""Tests of batch rendering from the command line.
+
+Run from the directory of the program with:
+  python3 -m unittest
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+# The path of the program run by the tests, and of the description it renders.
+PROGRAM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '__main__.pyw')
+EXAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data', 'example.dt')
+
+# The package installed ahead of the real PyQt4 to make importing it fail.
+BLOCKED_PYQT = 'raise ImportError("PyQt4 is blocked by the test")\n'
+
+
+class BatchTest(unittest.TestCase):
+  """Tests of --batch, run in a separate interpreter."""
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+
+  def runBatch(self, pattern, block_qt=False):
+    """Runs a batch render of the example description.
+
+    Args:
+      pattern: The pattern of the output paths, relative to the temporary
+        directory of the test.
+      block_qt: If True, importing PyQt4 fails in the program and its workers.
+
+    Returns:
+      The completed subprocess.CompletedProcess.
+    """
+    environment = dict(os.environ)
+    if block_qt:
+      blocker = os.path.join(self.directory.name, 'blocked', 'PyQt4')
+      os.makedirs(blocker)
+      with open(os.path.join(blocker, '__init__.py'), 'w') as outfile:
+        outfile.write(BLOCKED_PYQT)
+      environment['PYTHONPATH'] = os.pathsep.join(
+          filter(None, [os.path.dirname(blocker),
+                        environment.get('PYTHONPATH')]))
+    command = [sys.executable, PROGRAM_PATH, '--no-cache', '--batch',
+               os.path.join(self.directory.name, pattern), EXAMPLE_PATH]
+    return subprocess.run(command, env=environment, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+  def testSvgWithoutQt(self):
+    result = self.runBatch('out/{name}.svg', block_qt=True)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    with open(os.path.join(self.directory.name, 'out', 'example.svg'),
+              encoding='utf8') as infile:
+      self.assertIn('<svg', infile.read())
+
+  def testCompiledWithoutQt(self):
+    result = self.runBatch('{name}.dtc', block_qt=True)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    self.assertTrue(
+        os.path.getsize(os.path.join(self.directory.name, 'example.dtc')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+"""Tests of watching files and re-rendering them as they change.
+
+Run from the directory of the program with:
+  python3 -m unittest
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import watch
+
+
+# The number of seconds between scans of the watched files in the tests.
+INTERVAL = 0.02
+
+# The number of seconds to wait for a watched file to be rendered.
+TIMEOUT = 10
+
+# A value change dump, as written by a simulator. The field {value} is replaced
+# by the value of the bus at its last change.
+VCD_TEMPLATE = """$timescale 1ns $end
+$scope module top $end
+$var wire 1 ! clk $end
+$var wire 8 " data [7:0] $end
+$upscope $end
+$enddefinitions $end
+#0
+0!
+b00000000 "
+#10
+1!
+b{value:08b} "
+#20
+0!
+"""
+
+
+class _StopWatching(Exception):
+  """Raised by the tests to stop watch.watchFiles() after a render."""
+
+
+class WatchTest(unittest.TestCase):
+  """Tests of watch.watchFiles(), run in a separate thread."""
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+
+  def watchOnce(self, path, pattern, change):
+    """Watches a file, changes it, and waits for it to be rendered again.
+
+    Args:
+      path: The path of the watched file.
+      pattern: The pattern of the output paths. See batch.getOutputPath().
+      change: A function called once the file is watched, which changes it.
+
+    Returns:
+      The error message reported for the render, or None if it succeeded.
+    """
+    reports = queue.Queue()
+
+    def report(infile_name, outfile_name, error):
+      reports.put(error)
+      raise _StopWatching()
+
+    def run():
+      try:
+        watch.watchFiles([path], pattern, report, INTERVAL)
+      except _StopWatching:
+        pass
+
+    # The first snapshot is taken when watching starts, so the file is only
+    # changed after the first scan has had time to complete.
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    time.sleep(INTERVAL * 5)
+    change()
+    error = reports.get(timeout=TIMEOUT)
+    thread.join(TIMEOUT)
+    return error
+
+  def testVcdInput(self):
+    path = os.path.join(self.directory.name, 'dump.vcd')
+    with open(path, 'w', encoding='utf8') as outfile:
+      outfile.write(VCD_TEMPLATE.format(value=1))
+
+    def change():
+      with open(path, 'w', encoding='utf8') as outfile:
+        outfile.write(VCD_TEMPLATE.format(value=0xa5) + '#30\n1!\n')
+
+    pattern = os.path.join(self.directory.name, '{name}.svg')
+    self.assertIsNone(self.watchOnce(path, pattern, change))
+    with open(os.path.join(self.directory.name, 'dump.svg'),
+              encoding='utf8') as infile:
+      document = infile.read()
+    self.assertIn('>top.data<', document)
+    self.assertIn('>A5<', document)
+
+
+if __name__ == '__main__':
+  unittest.main()
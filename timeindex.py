@@ -0,0 +1,85 @@
+"""Time indexes kept next to diagram files, for loading windows of captures.
+
+The index of a description (or VCD) file is a compiled diagram stored beside
+it, at its path with INDEX_SUFFIX appended, which records the modification time
+and size of the file it was built from. The file is parsed only when its index
+is missing or out of date. Otherwise only the time blocks of the index that
+overlap the window being rendered are loaded, along with the value of each
+signal at the start of the window. See compiled.py for the block layout.
+"""
+
+import os
+import tempfile
+import compiled
+import instrument
+import parse
+
+
+# The suffix appended to the path of a file to name its index.
+INDEX_SUFFIX = '.dti'
+
+
+def getIndexPath(path):
+  """Returns the path of the index of a file."""
+  return path + INDEX_SUFFIX
+
+
+def loadWindow(path, start=None, end=None, stats=instrument.DISABLED):
+  """Loads the changes of a diagram file within a window of time.
+
+  The index of the file is built or rebuilt first if needed. If it cannot be
+  written, e.g. because the directory is read-only, the whole file is loaded.
+  Compiled files are indexed already, so they are loaded directly.
+
+  Args:
+    path: The path of a description, VCD or compiled file.
+    start: The start of the window. Defaults to that of the diagram.
+    end: The end of the window. Defaults to that of the diagram.
+    stats: An instrument.Stats in which the time spent is recorded.
+
+  Returns:
+    A model.TimingDiagram showing the window, holding the changes of the time
+    blocks that the window overlaps.
+  """
+  if compiled.isCompiledPath(path):
+    return compiled.loadDiagram(path, stats, (start, end))
+
+  index_path = getIndexPath(path)
+  stat = os.stat(path)
+  source = (stat.st_mtime_ns, stat.st_size)
+  try:
+    if compiled.readSource(index_path) == source:
+      return compiled.loadDiagram(index_path, stats, (start, end))
+  except (OSError, compiled.CompiledFormatError):
+    pass
+
+  diagram = parse.loadTimingFile(path, stats)
+  try:
+    _writeIndex(diagram, index_path, source, stats)
+  except OSError:
+    if start is not None:
+      diagram.start = start
+    if end is not None:
+      diagram.end = end
+    return diagram
+  return compiled.loadDiagram(index_path, stats, (start, end))
+
+
+def _writeIndex(diagram, index_path, source, stats):
+  """Compiles the index of a file, replacing any earlier one atomically.
+
+  Args:
+    diagram: The model.TimingDiagram read from the file.
+    index_path: The path of the index.
+    source: The modification time in nanoseconds and size of the file.
+    stats: An instrument.Stats in which the time spent is recorded.
+  """
+  handle, temporary_name = tempfile.mkstemp(
+      suffix=INDEX_SUFFIX, dir=os.path.dirname(index_path) or os.curdir)
+  os.close(handle)
+  try:
+    compiled.compileDiagram(diagram, temporary_name, stats, source=source)
+    os.replace(temporary_name, index_path)
+  except BaseException:
+    os.remove(temporary_name)
+    raise
@@ -0,0 +1,352 @@
+"""Streaming import of Value Change Dump (VCD) files into timing diagrams.
+
+The dump is read one line at a time, and only the changes of the selected
+signals within the selected time window are kept, packed into the columns of
+model.Changes as they are read. Reading stops at the first timestamp after the
+window, so memory use depends on the selection rather than on the size of the
+dump.
+
+Single-bit variables become model.Line signals, and wider variables (as well as
+real and string variables) become model.Bus signals. Times are in the units of
+the dump's timescale.
+"""
+
+import array
+import fnmatch
+import instrument
+import model
+
+
+# The extension of VCD files.
+VCD_EXTENSION = '.vcd'
+
+# The scalar values of single-bit variables, mapped to model values.
+SCALAR_VALUES = {
+  '0': 0,
+  '1': 1,
+  'x': model.UNKNOWN,
+  'X': model.UNKNOWN,
+  'z': None,
+  'Z': None,
+}
+
+# The separator between the scopes and the name of a signal in its full name.
+SCOPE_SEPARATOR = '.'
+
+# The header keywords whose contents are skipped up to their $end.
+IGNORED_SECTIONS = {'$comment', '$date', '$version', '$timescale'}
+
+# The keywords that may appear among the value changes, and are skipped.
+SIMULATION_KEYWORDS = {'$dumpvars', '$dumpall', '$dumpon', '$dumpoff', '$end'}
+
+
+class VcdSyntaxError(ValueError):
+  """A syntax error encountered while reading a VCD file.
+
+  Takes a message and the number of the line where the error occurred.
+  """
+
+  def __init__(self, message, line_number):
+    self.message = message
+    self.line_number = line_number
+    super().__init__('{}\nLine {}'.format(message, line_number))
+
+
+def isVcdPath(path):
+  """Returns whether a path names a VCD file, judging by its extension."""
+  return path.lower().endswith(VCD_EXTENSION)
+
+
+def importVcd(path, signals=None, start=None, end=None, delay=0,
+              stats=instrument.DISABLED):
+  """Reads a VCD file into a timing diagram.
+
+  Changes at or before the start of the time window are folded into the start
+  values of the signals, and changes after its end are not read. Lines cannot
+  change to an unknown value, so unknown (x) values of single-bit variables
+  after the start of the window are drawn as floating instead.
+
+  Args:
+    path: The path of the VCD file.
+    signals: An optional list of shell-style patterns, e.g. "top.cpu.*". Only
+      the variables whose full names (their scopes and name, separated by
+      SCOPE_SEPARATOR) match any of them are imported. Defaults to all.
+    start: The start of the time window. Defaults to the first timestamp.
+    end: The end of the time window. Defaults to the last timestamp.
+    delay: The delay of the diagram, i.e. the time each change takes to draw.
+    stats: An instrument.Stats in which the time spent is recorded.
+
+  Returns:
+    A model.TimingDiagram holding the selected signals in declaration order.
+
+  Raises:
+    VcdSyntaxError: If the file is not a valid VCD file.
+  """
+  with stats.stage('import_vcd'), open(path, encoding='utf8',
+                                       errors='replace') as infile:
+    tokens = _tokenize(infile)
+    builders, identifiers = _readDefinitions(tokens, signals)
+    window = [start, end]
+    last_time = _readChanges(tokens, identifiers, window)
+
+  start, end = window
+  if start is None:
+    start = 0
+  if end is None:
+    end = last_time if last_time is not None and last_time > start else start
+  if end <= start:
+    end = start + 1
+  return model.TimingDiagram(start=start, end=end, delay=delay,
+                             signals=[i.build() for i in builders])
+
+
+class _SignalBuilder:
+  """Collects the changes of a signal into columns as a dump is read."""
+
+  __slots__ = ('signal_type', 'name', 'width', 'start', 'times', 'codes',
+               'table', '_value_codes')
+
+  def __init__(self, signal_type, name, width):
+    """Initializes a signal with an unknown start value and no changes.
+
+    Args:
+      signal_type: Either model.Line or model.Bus.
+      name: The full name of the signal.
+      width: The number of bits of the variable, or 0 if it is not a vector.
+    """
+    self.signal_type = signal_type
+    self.name = name
+    self.width = width
+    self.start = model.UNKNOWN
+    self.times = array.array('d')
+    if signal_type is model.Line:
+      self.codes = array.array('B')
+      self.table = list(model.LINE_VALUES)
+    else:
+      self.codes = array.array('I')
+      self.table = []
+    self._value_codes = {value: code for code, value in enumerate(self.table)}
+
+  def change(self, time, value, window_start):
+    """Records a change of value.
+
+    Args:
+      time: The time of the change. Must not precede earlier changes.
+      value: The new value, as a model value.
+      window_start: The start of the time window.
+    """
+    if time <= window_start:
+      self.start = value
+      return
+    if value is model.UNKNOWN and self.signal_type is model.Line:
+      value = None
+
+    code = self._value_codes.get(value)
+    if code is None:
+      code = self._value_codes[value] = len(self.table)
+      self.table.append(value)
+    if self.times and self.times[-1] == time:
+      self.codes[-1] = code
+    elif code != (self.codes[-1] if self.codes else
+                  self._value_codes.get(self.start)):
+      self.times.append(time)
+      self.codes.append(code)
+
+  def build(self):
+    """Returns the signal, as a model.Line or model.Bus."""
+    return self.signal_type(self.name, self.start,
+                            model.Changes(self.times, self.codes, self.table))
+
+
+def _tokenize(infile):
+  """Splits a file into whitespace-separated tokens.
+
+  Args:
+    infile: A text file object.
+
+  Yields:
+    Tuples containing a line number and a token.
+  """
+  for number, line in enumerate(infile, 1):
+    for token in line.split():
+      yield number, token
+
+
+def _readDefinitions(tokens, patterns):
+  """Reads the header of a dump, up to $enddefinitions.
+
+  Args:
+    tokens: An iterator of numbered tokens, advanced past the header.
+    patterns: A list of shell-style patterns of the full names of the signals
+      to import, or None to import all.
+
+  Returns:
+    A tuple containing a list of a _SignalBuilder per selected variable, in
+    declaration order, and a dictionary mapping the identifier codes of the
+    selected variables to lists of their builders.
+
+  Raises:
+    VcdSyntaxError: If the header is malformed.
+  """
+  builders = []
+  identifiers = {}
+  scopes = []
+  number = 0
+  for number, token in tokens:
+    if token == '$enddefinitions':
+      _readSection(tokens, number)
+      return builders, identifiers
+    elif token in IGNORED_SECTIONS:
+      _readSection(tokens, number)
+    elif token == '$scope':
+      arguments = _readSection(tokens, number)
+      if len(arguments) != 2:
+        raise VcdSyntaxError('Malformed $scope declaration.', number)
+      scopes.append(arguments[1])
+    elif token == '$upscope':
+      _readSection(tokens, number)
+      if not scopes:
+        raise VcdSyntaxError('$upscope without a matching $scope.', number)
+      scopes.pop()
+    elif token == '$var':
+      arguments = _readSection(tokens, number)
+      if len(arguments) < 4 or not arguments[1].isdigit():
+        raise VcdSyntaxError('Malformed $var declaration.', number)
+      var_type, width, identifier, reference = arguments[:4]
+      name = SCOPE_SEPARATOR.join(scopes + [reference])
+      if patterns is not None and not any(fnmatch.fnmatchcase(name, i)
+                                          for i in patterns):
+        continue
+      width = int(width)
+      if var_type in ('real', 'realtime', 'string'):
+        builder = _SignalBuilder(model.Bus, name, 0)
+      elif width == 1:
+        builder = _SignalBuilder(model.Line, name, 1)
+      else:
+        builder = _SignalBuilder(model.Bus, name, width)
+      builders.append(builder)
+      identifiers.setdefault(identifier, []).append(builder)
+    else:
+      raise VcdSyntaxError('Unexpected token in the header: {}'.format(token),
+                           number)
+  raise VcdSyntaxError('The header does not end with $enddefinitions.', number)
+
+
+def _readSection(tokens, number):
+  """Reads the tokens of a header section up to its $end.
+
+  Args:
+    tokens: An iterator of numbered tokens, advanced past the $end.
+    number: The number of the line where the section starts.
+
+  Returns:
+    A list of the tokens of the section, excluding $end.
+
+  Raises:
+    VcdSyntaxError: If the file ends before the section does.
+  """
+  arguments = []
+  for _, token in tokens:
+    if token == '$end':
+      return arguments
+    arguments.append(token)
+  raise VcdSyntaxError('A section does not end with $end.', number)
+
+
+def _readChanges(tokens, identifiers, window):
+  """Reads the value changes of a dump into the builders of selected variables.
+
+  Args:
+    tokens: An iterator of the numbered tokens following the header.
+    identifiers: A dictionary mapping the identifier codes of the selected
+      variables to lists of their _SignalBuilder objects.
+    window: A list holding the start and end of the time window, either of
+      which may be None. A missing start is set to the first timestamp.
+
+  Returns:
+    The last timestamp read within the window, or None if there was none.
+
+  Raises:
+    VcdSyntaxError: If a value change is malformed.
+  """
+  start, end = window
+  time = 0
+  last_time = None
+  for number, token in tokens:
+    kind = token[0]
+    if kind == '#':
+      try:
+        next_time = int(token[1:])
+      except ValueError:
+        raise VcdSyntaxError('Invalid timestamp: {}'.format(token), number)
+      if next_time < time:
+        raise VcdSyntaxError('Timestamps must not decrease.', number)
+      if end is not None and next_time > end:
+        break
+      time = last_time = next_time
+      if start is None:
+        start = window[0] = time
+      continue
+    elif kind in SCALAR_VALUES:
+      value = token[0]
+      identifier = token[1:]
+    elif kind in 'bBrRsS':
+      value = token[1:]
+      try:
+        identifier = next(tokens)[1]
+      except StopIteration:
+        raise VcdSyntaxError('A value change has no identifier.', number)
+    elif token in SIMULATION_KEYWORDS:
+      continue
+    elif token == '$comment':
+      _readSection(tokens, number)
+      continue
+    else:
+      raise VcdSyntaxError('Unexpected token: {}'.format(token), number)
+
+    builders = identifiers.get(identifier)
+    if not builders:
+      continue
+    if start is None:
+      start = window[0] = time
+    for builder in builders:
+      builder.change(time, _convertValue(kind, value, builder.width), start)
+  return last_time
+
+
+def _convertValue(kind, value, width):
+  """Converts a VCD value to the value of a model signal.
+
+  Bit vectors made of 0s and 1s become uppercase hexadecimal strings, vectors
+  that are entirely unknown or floating become UNKNOWN or None, and any other
+  vectors are kept in binary.
+
+  Args:
+    kind: The first character of the value change, identifying its kind.
+    value: The value, without the kind character for vectors, reals and strings.
+    width: The number of bits of the variable, or 0 if it is not a vector.
+
+  Returns:
+    The model value.
+  """
+  if kind in SCALAR_VALUES:
+    return SCALAR_VALUES[kind]
+  elif kind not in 'bB':
+    return value
+  elif width == 1:
+    return SCALAR_VALUES.get(value[-1:], model.UNKNOWN)
+
+  value = value.lower()
+  if len(value) < width:
+    # Vectors are extended to the left with zeros, or with their leftmost bit if
+    # it is x or z.
+    padding = value[0] if value[:1] in ('x', 'z') else '0'
+    value = padding * (width - len(value)) + value
+  bits = set(value)
+  if bits <= {'0', '1'}:
+    return '{:0{}X}'.format(int(value, 2), (len(value) + 3) // 4)
+  elif bits == {'x'}:
+    return model.UNKNOWN
+  elif bits == {'z'}:
+    return None
+  return value
@@ -0,0 +1,136 @@
+"""Watching diagram descriptions and re-rendering them as they change."""
+
+import os
+import time
+import batch
+import compiled
+import output
+import parse
+import vcd
+
+
+# The number of seconds between scans of the watched files.
+POLL_INTERVAL = 0.5
+
+
+class Watcher:
+  """Detects changes to description files by polling their metadata.
+
+  Directories are scanned recursively with os.scandir(), which on most
+  platforms provides file metadata without an extra system call per file.
+  """
+
+  def __init__(self, paths):
+    """Initializes the watcher and takes an initial snapshot.
+
+    Args:
+      paths: A list of description files and directories containing them.
+    """
+    self.paths = paths
+    self.snapshot = self.scan()
+
+  def scan(self):
+    """Returns the current signature of every watched description file.
+
+    Returns:
+      A dictionary mapping file paths to (modification time, size) tuples.
+    """
+    snapshot = {}
+    for path in self.paths:
+      if os.path.isdir(path):
+        self._scanDirectory(path, snapshot)
+      else:
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+  def _scanDirectory(self, path, snapshot):
+    """Recursively adds the description files in a directory to a snapshot.
+
+    Args:
+      path: The directory to scan.
+      snapshot: The dictionary to which signatures are added.
+    """
+    try:
+      entries = list(os.scandir(path))
+    except OSError:
+      return
+    for entry in entries:
+      try:
+        if entry.is_dir():
+          self._scanDirectory(entry.path, snapshot)
+        elif entry.name.endswith(batch.DESCRIPTION_EXTENSION):
+          stat = entry.stat()
+          snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+      except OSError:
+        continue
+
+
+def watchFiles(paths, pattern, report=None, interval=POLL_INTERVAL,
+               render_cache=None):
+  """Re-renders description files whenever they change, until interrupted.
+
+  A changed file is rendered only once it has stayed unchanged for a whole
+  polling interval, so bursts of saves result in a single render. A single
+  renderer (and with it the font caches of the thread) is kept for the whole
+  run, and each description keeps an incremental parser, so that re-parsing it
+  only parses its changed blocks. Compiled and VCD files are loaded whole by
+  parse.loadTimingFile() each time they change. A QApplication must exist if
+  the output format is drawn with Qt (see output.needsQt()).
+
+  Args:
+    paths: A list of description files and directories containing them.
+    pattern: A format string for the output paths. See batch.getOutputPath().
+    report: An optional function called with the input path, output path and
+      error message (None on success) of each file as soon as it is rendered.
+    interval: The number of seconds between scans of the watched files.
+    render_cache: An optional cache.RenderCache, from which diagrams rendered
+      before are copied instead of being rendered again.
+  """
+  watcher = Watcher(paths)
+  renderer = None
+  if output.needsQt(pattern):
+    import render
+    renderer = render.Renderer()
+  parsers = {}
+  pending = {}
+
+  while True:
+    time.sleep(interval)
+    snapshot = watcher.scan()
+
+    for path, signature in snapshot.items():
+      if signature != watcher.snapshot.get(path):
+        pending[path] = signature
+      elif path in pending:
+        del pending[path]
+        outfile_name = batch.getOutputPath(pattern, path)
+        try:
+          if compiled.isCompiledPath(path) or vcd.isVcdPath(path):
+            diagram = parse.loadTimingFile(path)
+          else:
+            parser = parsers.setdefault(path, parse.IncrementalParser())
+            with open(path, encoding='utf8') as infile:
+              diagram = parser.parse(infile.read())
+          directory = os.path.dirname(outfile_name)
+          if directory:
+            os.makedirs(directory, exist_ok=True)
+          output.writeDiagram(diagram, outfile_name, render_cache, renderer)
+        except Exception as e:
+          if renderer is not None:
+            # The renderer may be left half-way through an update.
+            renderer = render.Renderer()
+          error = str(e) or type(e).__name__
+        else:
+          error = None
+        if report:
+          report(path, outfile_name, error)
+
+    for path in set(parsers) - set(snapshot):
+      del parsers[path]
+    for path in set(pending) - set(snapshot):
+      del pending[path]
+    watcher.snapshot = snapshot